@@ -1,6 +1,7 @@
 import argparse
 import lib.hybrid_search as HS
 import lib.semantic_search as SS
+import lib.search_server as SearchServer
 
 
 def print_rag(result, response):
@@ -21,10 +22,16 @@ def print_answer(result, response):
     print("Answer:")
     print(response)
 
+def hybrid_search(args):
+    # The running search server when one is given, else a local HybridSearch.
+    client = SearchServer.connect(args.server)
+    if client is not None: return client
+    return HS.HybridSearch(SS.load_movies())
 
 
 def main():
     parser = argparse.ArgumentParser(description="Retrieval Augmented Generation CLI")
+    parser.add_argument("--server", type=str, help=f"Search server URL to query instead of loading the index (default ${SearchServer.SERVER_ENV})")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     rag_parser = subparsers.add_parser("rag", help="Perform RAG (search + generate answer)")
@@ -43,32 +50,16 @@ def main():
 
     match args.command:
         case "rag":
-            query = args.query
-            documents = SS.load_movies()
-            hs = HS.HybridSearch(documents)
-            result = hs.rrf_search(query) 
-            response = HS.llm_rag(query, result)      
+            result, response = hybrid_search(args).answer("rag", args.query)
             print_rag(result, response)   
         case "summarize":
-            query = args.query
-            documents = SS.load_movies()
-            hs = HS.HybridSearch(documents)
-            result = hs.rrf_search(query, limit=args.limit)
-            response = HS.llm_summarize(query, result)
+            result, response = hybrid_search(args).answer("summarize", args.query, args.limit)
             print_summary(result, response)
         case "citations":
-            query = args.query
-            documents = SS.load_movies()
-            hs = HS.HybridSearch(documents)
-            result = hs.rrf_search(query, limit=args.limit)
-            response = HS.llm_citations(query, result) 
+            result, response = hybrid_search(args).answer("citations", args.query, args.limit)
             print_answer(result, response)
         case "question":
-            question = args.question
-            documents = SS.load_movies()
-            hs = HS.HybridSearch(documents)
-            result = hs.rrf_search(question, limit=args.limit)
-            response = HS.llm_question(question, result) 
+            result, response = hybrid_search(args).answer("question", args.question, args.limit)
             print_answer(result, response)
         case _:
             parser.print_help()
@@ -2,11 +2,13 @@ import argparse
 import json
 import lib.hybrid_search as HS
 import lib.semantic_search as SS
+import lib.search_server as SearchServer
 
 
 def main():
     parser = argparse.ArgumentParser(description="Search Evaluation CLI")
     parser.add_argument("--limit", type=int, default=5, help="Number of results to evaluate (k for precision@k, recall@k)")
+    parser.add_argument("--server", type=str, help=f"Search server URL to query instead of loading the index (default ${SearchServer.SERVER_ENV})")
 
     args = parser.parse_args()
     limit = args.limit
@@ -15,12 +17,11 @@ def main():
         golden_dataset = json.load(f) # { "test_cases": [ { "query": "q", "relevant_docs": ["d1", "d2"] }, ] }
         test_cases = golden_dataset["test_cases"]
 
-    documents = SS.load_movies()
-    hs = HS.HybridSearch(documents)
+    hs = SearchServer.connect(args.server) or HS.HybridSearch(SS.load_movies())
     
     print(f"k={limit}")
-    for tc in test_cases:
-        result = hs.rrf_search(tc['query'], 60, limit)
+    results = hs.rrf_search_many([tc['query'] for tc in test_cases], 60, limit)
+    for tc, result in zip(test_cases, results):
         expected = tc['relevant_docs']
         received = [r['title'] for r in result.values()]
         intersection = list(set(expected) & set(received))
@@ -35,6 +36,14 @@ def main():
         print(f"  - Relevant: " + ", ".join(expected))
         print(f"  - Relevant Retrieved: " + ", ".join(intersection))
 
+    stats = hs.stats()
+    if stats["result_cache"] is not None:
+        cache = stats["result_cache"]
+        print(f"Result cache: {cache['hits']} hits, {cache['misses']} misses, {cache['size']}/{cache['max_entries']} entries")
+    if stats["query_cache"] is not None:
+        cache = stats["query_cache"]
+        print(f"Query embedding cache: {cache['hits']} hits, {cache['disk_hits']} from disk, {cache['misses']} misses")
+
 
 
 if __name__ == "__main__":
@@ -2,6 +2,8 @@ import time
 import argparse
 import lib.semantic_search as SS
 import lib.hybrid_search as HS
+import lib.model_registry as MR
+import lib.search_server as SearchServer
 
 
 def print_weighted_search(result):
@@ -29,6 +31,32 @@ def print_rrf_search(result, limit):
         if i == limit: break
         i += 1
 
+def print_missing_legs(result):
+    for leg in getattr(result, "missing_legs", []):
+        print(f"The {leg} leg timed out; results are from the other leg only\n")
+
+def local_options(args):
+    # Index and inference options the search server was started with; a
+    # client cannot change them.
+    options = {"--ann": args.ann, "--precision": args.precision != "float32", "--int8": args.int8,
+               "--threads": args.threads is not None, "--interop-threads": args.interop_threads is not None,
+               "--depth": args.depth != HS.CANDIDATE_DEPTH, "--leg-timeout": args.leg_timeout != HS.LEG_TIMEOUT_S,
+               "--sequential": args.sequential}
+    return [name for name, given in options.items() if given]
+
+def hybrid_search(args, parser):
+    # The running search server when one is given, else a local HybridSearch.
+    client = SearchServer.connect(args.server)
+    if client is not None:
+        options = local_options(args)
+        if options: parser.error(f"{', '.join(options)} cannot be used with a search server, which keeps the options it was started with")
+        return client
+    hs = HS.HybridSearch(SS.load_movies(), args.ann, args.precision, args.int8)
+    hs.candidate_depth = args.depth
+    hs.leg_timeout_s = args.leg_timeout
+    hs.concurrent = not args.sequential
+    return hs
+
 def get_limit(limit, rerank_method):
     if rerank_method == "individual":
         return limit * 5
@@ -40,45 +68,59 @@ def get_limit(limit, rerank_method):
 def main() -> None:
     parser = argparse.ArgumentParser(description="Hybrid Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")    
+    inference_parser = argparse.ArgumentParser(add_help=False)
+    inference_parser.add_argument("--int8", action="store_true", help="Encode queries and rerank with int8 dynamically quantized linear layers (CPU)")
+    inference_parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    inference_parser.add_argument("--interop-threads", type=int, help="torch inter-op threads")
     normalize_parser = subparsers.add_parser("normalize", help="min max normalize list")
     normalize_parser.add_argument("values", type=float, nargs='+', help="list values")
-    weighted_search_parser = subparsers.add_parser("weighted-search", help="weighted search of <query> with [--alpha [0,1]] weighting and [--limit N] results.")
+    weighted_search_parser = subparsers.add_parser("weighted-search", parents=[inference_parser], help="weighted search of <query> with [--alpha [0,1]] weighting and [--limit N] results.")
     weighted_search_parser.add_argument("query", type=str, help="Query to get weighted search results for.")
     weighted_search_parser.add_argument("--alpha", type=float, nargs='?', default=0.5, help="weight of exact matching vs embedding matching")
     weighted_search_parser.add_argument("--limit", type=int,   nargs='?', default=5, help="Number of results")
-    rrf_search_parser = subparsers.add_parser("rrf-search", help="weighted search of <query> with [--alpha [0,1]] weighting and [--limit N] results.")
+    weighted_search_parser.add_argument("--ann", action="store_true", help="Approximate semantic search with the IVF index")
+    weighted_search_parser.add_argument("--precision", type=str, choices=SS.PRECISIONS, default="float32", help="In-memory precision of chunk embeddings")
+    weighted_search_parser.add_argument("--depth", type=int, default=HS.CANDIDATE_DEPTH, help=f"Candidates taken from each leg before fusing (default limit * {HS.WEIGHTED_DEPTH_FACTOR})")
+    weighted_search_parser.add_argument("--leg-timeout", type=float, default=HS.LEG_TIMEOUT_S, help="Seconds a leg may take before results fall back to the other leg")
+    weighted_search_parser.add_argument("--sequential", action="store_true", help="Run the semantic and keyword legs one after the other")
+    weighted_search_parser.add_argument("--server", type=str, help=f"Search server URL to query instead of loading the index (default ${SearchServer.SERVER_ENV})")
+    rrf_search_parser = subparsers.add_parser("rrf-search", parents=[inference_parser], help="weighted search of <query> with [--alpha [0,1]] weighting and [--limit N] results.")
     rrf_search_parser.add_argument("query", type=str, help="Query to get weighted search results for.")
     rrf_search_parser.add_argument("-k", type=int, nargs='?', default=1, help="rrf k parameter")
     rrf_search_parser.add_argument("--limit", type=int, nargs='?', default=5, help="Number of results")
     rrf_search_parser.add_argument("--enhance", type=str, choices=["spell", "rewrite", "expand"], help="Query enhancement method")
     rrf_search_parser.add_argument("--rerank-method", type=str, choices=["individual", "batch", "cross_encoder"], help="Query enhancement method")
+    rrf_search_parser.add_argument("--rerank-top-n", type=int, help="Leading results the cross-encoder reranks (default all)")
     rrf_search_parser.add_argument("--evaluate",  action="store_true", help="LLM rating of search result.")
+    rrf_search_parser.add_argument("--ann", action="store_true", help="Approximate semantic search with the IVF index")
+    rrf_search_parser.add_argument("--precision", type=str, choices=SS.PRECISIONS, default="float32", help="In-memory precision of chunk embeddings")
+    rrf_search_parser.add_argument("--depth", type=int, default=HS.CANDIDATE_DEPTH, help=f"Candidates taken from each leg before fusing (default limit * {HS.RRF_DEPTH_FACTOR})")
+    rrf_search_parser.add_argument("--leg-timeout", type=float, default=HS.LEG_TIMEOUT_S, help="Seconds a leg may take before results fall back to the other leg")
+    rrf_search_parser.add_argument("--sequential", action="store_true", help="Run the semantic and keyword legs one after the other")
+    rrf_search_parser.add_argument("--server", type=str, help=f"Search server URL to query instead of loading the index (default ${SearchServer.SERVER_ENV})")
 
 
     args = parser.parse_args()
+    MR.configure_inference(getattr(args, "threads", None), getattr(args, "interop_threads", None))
 
     match args.command:
         case "normalize":
             normalized = HS.normalize(args.values)
             for n in normalized: print(f"* {n:.4f}")   
         case "weighted-search":
-            documents = SS.load_movies()
-            hs = HS.HybridSearch(documents)
+            hs = hybrid_search(args, parser)
             result = hs.weighted_search(args.query, args.alpha, args.limit)
+            print_missing_legs(result)
             print_weighted_search(result)  
         case "rrf-search":
-            documents = SS.load_movies()
-            hs = HS.HybridSearch(documents)
+            hs = hybrid_search(args, parser)
             fixed_query = HS.llm_fix_query(args.query, args.enhance)
             limit = get_limit(args.limit, args.rerank_method)
             result = hs.rrf_search(fixed_query, args.k, limit)
+            print_missing_legs(result)
             
-            if args.rerank_method == "individual":
-                result = HS.llm_rerank(result, fixed_query, args.limit)
-            elif args.rerank_method == "batch":
-                result = HS.llm_batch_rerank(result, fixed_query, args.limit)
-            elif args.rerank_method == "cross_encoder":
-                result = SS.cross_encoder_rerank(result, fixed_query)
+            if args.rerank_method:
+                result = hs.rerank(result, fixed_query, args.rerank_method, args.limit, args.rerank_top_n)
 
             if args.evaluate:
                 HS.llm_evaluate_result(fixed_query, result)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import argparse
 import lib.keyword_search as KS
 
@@ -19,6 +20,20 @@ def main() -> None:
     search_parser = subparsers.add_parser("search", help="Search movies using BM25")
     search_parser.add_argument("query", type=str, help="Search query")
     build_parser = subparsers.add_parser("build", help="Build inverted ks for movies")
+    build_parser.add_argument("--workers", type=int, default=1, help="Build shards in N worker processes (0 = all cores)")
+    build_parser.add_argument("--positions", action="store_true", help="Store token positions for phrase and proximity queries")
+    convert_parser = subparsers.add_parser("convert", help="Convert legacy cache/*.pkl files to the compact index format")
+    add_parser = subparsers.add_parser("add", help="Add movie <doc_id> <title> <description> to the index")
+    add_parser.add_argument("doc_id", type=int, help="Document ID")
+    add_parser.add_argument("title", type=str, help="Movie title")
+    add_parser.add_argument("description", type=str, help="Movie description")
+    update_parser = subparsers.add_parser("update", help="Replace movie <doc_id> with <title> <description>")
+    update_parser.add_argument("doc_id", type=int, help="Document ID")
+    update_parser.add_argument("title", type=str, help="Movie title")
+    update_parser.add_argument("description", type=str, help="Movie description")
+    delete_parser = subparsers.add_parser("delete", help="Delete movie <doc_id> from the index")
+    delete_parser.add_argument("doc_id", type=int, help="Document ID")
+    merge_parser = subparsers.add_parser("merge", help="Merge all index segments into one")
     tf_parser = subparsers.add_parser("tf", help="<term> frequency in document <doc_id>")
     tf_parser.add_argument("doc_id", type=str, help="Document ID")
     tf_parser.add_argument("term", type=str, help="Search query")
@@ -36,6 +51,12 @@ def main() -> None:
     bm25_tf_parser.add_argument("b", type=float, nargs='?', default=KS.BM25_B, help="Tunable BM25 b parameter")
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
     bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("--limit", type=int, default=5, help="Number of results")
+    bm25search_parser.add_argument("--pruned", action="store_true", help="Skip documents that cannot reach the top results (Block-Max WAND); scores fewer documents but is slower than exhaustive scoring here")
+    bm25search_parser.add_argument("--proximity", action="store_true", help="Boost documents where query terms appear close together")
+    phrase_parser = subparsers.add_parser("phrase", help="Search movies containing the exact <phrase>")
+    phrase_parser.add_argument("phrase", type=str, help="Phrase")
+    phrase_parser.add_argument("--limit", type=int, default=5, help="Number of results")
 
     args = parser.parse_args()  
 
@@ -72,11 +93,35 @@ def main() -> None:
             print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}")
         case "bm25search":
             ks.load()
-            bm25search = ks.bm25_search(args.query)
+            bm25search = ks.bm25_search(args.query, args.limit, args.pruned, args.proximity)
             print_bm25search_result(bm25search)
+            print(f"Scored {ks.scored_documents} of {len(ks.docmap)} documents")
+        case "phrase":
+            ks.load()
+            print_bm25search_result(ks.phrase_search(args.phrase, args.limit))
         case "build":
-            ks.build()
+            ks.build(args.workers or os.cpu_count(), args.positions)
+            ks.save()
+        case "add" | "update":
+            ks.load()
+            movie = {"id": args.doc_id, "title": args.title, "description": args.description}
+            if args.command == "add": ks.add_document(movie)
+            else: ks.update_document(movie)
+            ks.save()
+            print(f"Indexed {args.doc_id}, {len(ks.index.segments)} segments")
+        case "delete":
+            ks.load()
+            ks.delete_document(args.doc_id)
+            ks.save()
+            print(f"Deleted {args.doc_id}, {len(ks.index.segments)} segments")
+        case "merge":
+            ks.load()
+            ks.merge_segments(force=True, background=False)
             ks.save()
+            print(f"Merged into {len(ks.index.segments)} segment(s) with {ks.index.doc_count} documents")
+        case "convert":
+            index = ks.convert_pickle_cache()
+            print(f"Converted {index.doc_count} documents and {index.term_count} terms")
 
         case _:
             parser.print_help()
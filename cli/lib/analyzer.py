@@ -0,0 +1,46 @@
+import string
+from functools import lru_cache
+from nltk.stem import PorterStemmer
+
+STEM_CACHE_SIZE = 100_000
+
+
+class Analyzer:
+    # Lowercases, strips punctuation, drops stopwords and stems. One instance
+    # is shared by indexing and querying so the stem cache stays warm.
+
+    def __init__(self, stopwords_file="data/stopwords.txt", stem_cache_size=STEM_CACHE_SIZE):
+        self.stopwords_file = stopwords_file
+        self.stopwords = self.load_stopwords()
+        self.translation = str.maketrans("", "", string.punctuation)
+        self.stem = lru_cache(maxsize=stem_cache_size)(PorterStemmer().stem)
+
+    def load_stopwords(self):
+        with open(self.stopwords_file) as f:
+            return frozenset(f.read().split())
+
+    def normalize(self, text):
+        return text.lower().translate(self.translation)
+
+    def words(self, text):
+        return self.normalize(text).split()
+
+    def tokenize(self, text):
+        stopwords, stem = self.stopwords, self.stem
+        tokens = [stem(w) for w in self.words(text) if w not in stopwords]
+        tokens.sort()
+        return tokens
+
+    def tokenize_with_positions(self, text):
+        # Tokens in text order with their word positions; stopwords are
+        # dropped but keep their slot, so phrase gaps survive.
+        stopwords, stem = self.stopwords, self.stem
+        tokens, positions = [], []
+        for i, w in enumerate(self.words(text)):
+            if w in stopwords: continue
+            tokens.append(stem(w))
+            positions.append(i)
+        return tokens, positions
+
+    def tokenize_many(self, texts):
+        return [self.tokenize(t) for t in texts]
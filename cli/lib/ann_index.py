@@ -0,0 +1,94 @@
+import os
+import numpy as np
+from .embedding_store import normalize_rows, top_k
+
+DEFAULT_NPROBE = 8              # lists scanned per query
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64     # training rows per centroid
+ASSIGN_BATCH_SIZE = 8192        # rows scored against the centroids at once
+
+
+class IvfIndex:
+    # Inverted-file ANN index over unit embedding rows. k-means (cosine)
+    # centroids split the rows into lists; a query scans only the rows of
+    # the nprobe lists whose centroids are closest to it. More lists or a
+    # lower nprobe trade recall for latency.
+
+    def __init__(self, centroids, list_offsets, list_ids, source=None):
+        self.centroids = centroids          # n_lists x dim, unit rows
+        self.list_offsets = list_offsets    # list -> start in list_ids, n_lists + 1 entries
+        self.list_ids = list_ids            # row ids grouped by list
+        self.source = source                # (mtime_ns, size) of the embeddings file it was built from
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, iterations=KMEANS_ITERATIONS, seed=0, source=None):
+        if n_lists is None: n_lists = int(4 * np.sqrt(len(embeddings)))
+        n_lists = max(1, min(n_lists, len(embeddings)))
+        centroids = kmeans(embeddings, n_lists, iterations, np.random.default_rng(seed))
+        assignment = nearest_centroid(embeddings, centroids)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_offsets[1:])
+        list_ids = np.argsort(assignment, kind="stable").astype(np.int32)
+        return cls(centroids, list_offsets, list_ids, source)
+
+    @classmethod
+    def open(cls, path):
+        with np.load(path) as f:
+            source = tuple(int(v) for v in f["source"]) if len(f["source"]) else None
+            return cls(f["centroids"], f["list_offsets"], f["list_ids"], source)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path)
+
+    def save(self, path):
+        source = np.array(self.source if self.source is not None else [], dtype=np.int64)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets,
+                     list_ids=self.list_ids, source=source)
+        os.replace(path + ".tmp", path)
+
+    def candidates(self, query, nprobe=DEFAULT_NPROBE):
+        # Row ids in the nprobe lists closest to query.
+        lists = top_k(self.centroids @ query, min(nprobe, self.n_lists))
+        return np.concatenate([self.list_ids[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists])
+
+    def search(self, embeddings, query, k, nprobe=DEFAULT_NPROBE):
+        # (row ids, scores) of the approximate k nearest rows, best first.
+        ids = self.candidates(query, nprobe)
+        scores = embeddings[ids] @ query
+        best = top_k(scores, k)
+        return ids[best], scores[best]
+
+
+def kmeans(embeddings, n_lists, iterations, rng):
+    # Spherical k-means on a sample of the rows; centroids stay unit length.
+    sample_size = min(len(embeddings), n_lists * KMEANS_SAMPLE_PER_LIST)
+    sample = embeddings[np.sort(rng.choice(len(embeddings), sample_size, replace=False))]
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroid(sample, centroids)
+        counts = np.bincount(assignment, minlength=n_lists)
+        order = np.argsort(assignment, kind="stable")
+        filled = np.flatnonzero(counts)
+        sums = np.add.reduceat(sample[order], (np.cumsum(counts) - counts)[filled], axis=0)
+        centroids[filled] = normalize_rows(sums)
+        # Empty lists restart from random sample rows.
+        empty = np.flatnonzero(counts == 0)
+        if len(empty): centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+    return centroids
+
+def nearest_centroid(embeddings, centroids):
+    assignment = np.empty(len(embeddings), dtype=np.int64)
+    for i in range(0, len(embeddings), ASSIGN_BATCH_SIZE):
+        assignment[i:i + ASSIGN_BATCH_SIZE] = np.argmax(embeddings[i:i + ASSIGN_BATCH_SIZE] @ centroids.T, axis=1)
+    return assignment
+
+def recall(exact, approximate):
+    # Share of the exact results the approximate search also returned.
+    if not len(exact): return 1.0
+    return len(set(exact) & set(approximate)) / len(exact)
@@ -0,0 +1,96 @@
+import os
+import json
+import shutil
+import numpy as np
+
+FORMAT_VERSION = 1
+
+# On-disk layout of a chunk metadata directory. Columns are .npy files opened
+# with mmap, so opening it reads only meta.json whatever the chunk count.
+#   meta.json            format version, chunk count
+#   movie_idx.npy        int32[chunks]  position of the chunk's document in the corpus
+#   chunk_idx.npy        int32[chunks]  position of the chunk within its document
+#   total_chunks.npy     int32[chunks]  chunks of its document
+#   doc_keys.npy         uint64[documents]  fingerprint of each document's chunked text, optional
+COLUMNS = ["movie_idx", "chunk_idx", "total_chunks"]
+
+
+class ChunkMetadata:
+    # Per-chunk metadata as parallel integer columns; chunk i is row i of
+    # the chunk embeddings.
+
+    def __init__(self, columns, doc_keys=None):
+        self.movie_idx = columns["movie_idx"]
+        self.chunk_idx = columns["chunk_idx"]
+        self.total_chunks = columns["total_chunks"]
+        self.doc_keys = doc_keys    # per document of the corpus the chunks came from, None if unknown
+
+    @classmethod
+    def from_chunk_counts(cls, movie_idx, total_chunks, doc_keys=None):
+        # One row per chunk of every document, given each chunked document's
+        # position and chunk count.
+        movie_idx = np.asarray(movie_idx, dtype=np.int32)
+        counts = np.asarray(total_chunks, dtype=np.int32)
+        firsts = np.cumsum(counts) - counts
+        return cls({
+            "movie_idx"    : np.repeat(movie_idx, counts),
+            "chunk_idx"    : (np.arange(int(counts.sum())) - np.repeat(firsts, counts)).astype(np.int32),
+            "total_chunks" : np.repeat(counts, counts),
+        }, doc_keys)
+
+    @classmethod
+    def from_records(cls, records):
+        # From the dicts of the former chunk_metadata.json.
+        return cls({c: np.array([r[c] for r in records], dtype=np.int32) for c in COLUMNS})
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported chunk metadata format version {meta.get('format_version')} in {path}")
+        keys_file = os.path.join(path, "doc_keys.npy")
+        doc_keys = np.load(keys_file, mmap_mode="r") if os.path.exists(keys_file) else None
+        return cls({c: np.load(os.path.join(path, c + ".npy"), mmap_mode="r") for c in COLUMNS}, doc_keys)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+    def save(self, path):
+        # Written to a sibling directory and swapped in, so readers never see
+        # columns of different builds.
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for c in COLUMNS:
+            np.save(os.path.join(tmp, c + ".npy"), getattr(self, c))
+        if self.doc_keys is not None: np.save(os.path.join(tmp, "doc_keys.npy"), self.doc_keys)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"format_version": FORMAT_VERSION, "total_chunks": len(self)}, f)
+        if os.path.exists(path): shutil.rmtree(path)
+        os.replace(tmp, path)
+
+    def __len__(self):
+        return len(self.movie_idx)
+
+    def __getitem__(self, i):
+        return {c: int(getattr(self, c)[i]) for c in COLUMNS}
+
+    def group_offsets(self, n_documents):
+        # Chunks are stored grouped by document, in document order: the rows
+        # of the document at position p are offsets[p]:offsets[p + 1].
+        if np.any(np.diff(self.movie_idx) < 0): raise ValueError("Chunk metadata is not grouped by document")
+        offsets = np.zeros(n_documents + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.movie_idx, minlength=n_documents), out=offsets[1:])
+        return offsets
+
+
+def load_chunk_metadata(path, legacy_file=None):
+    # Opens the columns at path, converting a legacy JSON metadata file once;
+    # None when neither exists.
+    if ChunkMetadata.exists(path): return ChunkMetadata.open(path)
+    if legacy_file is None or not os.path.exists(legacy_file): return None
+    with open(legacy_file) as f:
+        ChunkMetadata.from_records(json.load(f)["chunks"]).save(path)
+    return ChunkMetadata.open(path)
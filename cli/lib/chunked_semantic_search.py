@@ -1,47 +1,56 @@
 import os
 import re
-import json
+import time
 import numpy as np
 import lib.semantic_search as ss
+import lib.model_registry as MR
+from .ann_index import IvfIndex, DEFAULT_NPROBE, recall
+from .embedding_store import load_or_quantize, save_embeddings, update_embeddings, assemble_embeddings, \
+                             fingerprints, load_keys, match_keys, PRECISIONS
+from .chunk_metadata import ChunkMetadata, load_chunk_metadata
+from .result_cache import cached_search, cached_search_many, file_version
 
+CHUNK_SENTENCES = 4     # sentences per description chunk
+CHUNK_OVERLAP = 1       # sentences shared by consecutive chunks
+AGGREGATIONS = ("max", "mean", "top_n_sum")     # how a movie's chunk scores combine into its score
+TOP_N = 2               # chunks summed per movie by top_n_sum
+AGGREGATE_CANDIDATES = 4    # movies per requested result whose chunks are all scored, on partial scans
 
 class ChunkedSemanticSearch(ss.SemanticSearch):
 
-    def __init__(self, model_name = "all-MiniLM-L6-v2") -> None:
+    def __init__(self, model_name = MR.EMBEDDING_MODEL) -> None:
         super().__init__(model_name)
         self.chunk_embeddings_cache_file = "cache/chunk_embeddings.npy"
-        self.chunk_metadata_file = "cache/chunk_metadata.json"
+        self.chunk_metadata_dir = "cache/chunk_metadata"
+        self.legacy_chunk_metadata_file = "cache/chunk_metadata.json"
         self.chunks = None
-        self.chunk_embeddings = None
-        self.chunk_metadata = None
+        self.chunk_embeddings = None    # EmbeddingStore of unit rows
+        self.chunk_embeddings_version = None
+        self.chunk_metadata = None      # ChunkMetadata, one row per chunk embedding
+        self.chunk_movie_idx = None     # chunk -> movie_idx of its metadata
+        self.chunk_offsets = None       # movie_idx -> its chunks, chunk_offsets[m]:chunk_offsets[m + 1]
+        self.aggregation = "max"        # one of AGGREGATIONS
+        self.top_n = TOP_N
+        self.ann_index_file = "cache/chunk_embeddings.ivf.npz"
+        self.ann_index = None           # IvfIndex over chunk_embeddings, None scans them all
+        self.nprobe = DEFAULT_NPROBE
 
+    def chunk_search_version(self):
+        ann = (self.ann_index.n_lists, self.nprobe) if self.ann_index is not None else None
+        return (self.model_id, self.chunk_embeddings_version, self.precision, self.rescore, ann,
+                self.aggregation, self.top_n)
+
+    @cached_search(chunk_search_version)
     def search_chunks(self, query: str, limit: int = 10):
-        if self.chunk_embeddings is None: 
-            raise ValueError("No chunk embeddings loaded. Call `load_or_create_chunk_embeddings` first.")
-        
-        qemb = super().generate_embedding(query)
-        chunk_scores = []
-        movie_scores = {}
-        
-        for i in range(len(self.chunk_embeddings)):
-            emb = self.chunk_embeddings[i]
-            sim = ss.cosine_similarity(emb, qemb)
-            meta = self.chunk_metadata[i]
-            cidx = meta["chunk_idx"]
-            midx = meta["movie_idx"]
-            
-            chunk_scores.append({
-                "chunk_idx": cidx, # chunk_idx: The index of the chunk within the document
-                "movie_idx": midx, # movie_idx: The index of the document in self.documents (you'll need to use self.chunk_metadata to map back to this)
-                "score": sim       # score: The cosine similarity score
-            })
-            
-            if midx not in movie_scores or movie_scores[midx] < sim:
-                movie_scores[midx] = sim
-        
-        movie_scores = sorted(movie_scores.items(), key=lambda e:e[1], reverse=True)
-        movie_scores = movie_scores[:limit]
+        return self.__chunk_result(self.__query_movie_scores(query, limit))
+
+    @cached_search_many(chunk_search_version, "search_chunks")
+    def search_chunks_many(self, queries, limit=10):
+        # search_chunks of each query, with one encoder call for the batch and
+        # one matrix product per block of queries.
+        return [self.__chunk_result(movie_scores) for movie_scores in self.__query_movie_scores_many(queries, limit)]
 
+    def __chunk_result(self, movie_scores):
         result = []
         for m in movie_scores:
             md = {
@@ -55,50 +64,315 @@ class ChunkedSemanticSearch(ss.SemanticSearch):
         
         return result
 
+    def movie_top_k(self, query, limit=10):
+        # (document positions, scores) arrays of the limit best movies, best
+        # first, ranked like search_chunks without building result dicts.
+        return movie_arrays(self.__query_movie_scores(query, limit))
+
+    def movie_top_k_many(self, queries, limit=10):
+        # movie_top_k of each query.
+        return [movie_arrays(movie_scores) for movie_scores in self.__query_movie_scores_many(queries, limit)]
+
+    def __query_movie_scores(self, query, limit):
+        if self.chunk_embeddings is None: 
+            raise ValueError("No chunk embeddings loaded. Call `load_or_create_chunk_embeddings` first.")
+        qemb = ss.normalize(super().generate_embedding(query))
+        nprobe = self.nprobe if self.ann_index is not None else None
+        return self.__movie_scores(self.chunk_embeddings, qemb, limit, nprobe, self.rescore)
+
+    def __query_movie_scores_many(self, queries, limit):
+        # IVF searches scan different chunks per query, so only exhaustive
+        # ones share matrix products.
+        if self.chunk_embeddings is None: 
+            raise ValueError("No chunk embeddings loaded. Call `load_or_create_chunk_embeddings` first.")
+        qembs = ss.normalize_rows(self.generate_embeddings(queries))
+        store = self.chunk_embeddings
+        if self.ann_index is not None: return [self.__movie_scores(store, q, limit, self.nprobe, self.rescore) for q in qembs]
+        return [self.__movie_scores(store, q, limit, rescore=self.rescore, all_scores=scores)
+                for q, scores in store.query_scores(qembs)]
+
+    def __movie_scores(self, store, qemb, limit, nprobe=None, rescore=True, all_scores=None):
+        # (movie_idx, score) of the limit best movies, a movie's score being
+        # its chunk scores reduced by self.aggregation. A scan of every chunk
+        # at final precision reduces each movie's contiguous chunks at once;
+        # max keeps the top-k of chunks, which touches fewer movies.
+        # all_scores are store's scores of every chunk, when already computed.
+        if nprobe is None and (not rescore or store.precision == "float32") and self.aggregation != "max":
+            if all_scores is None: all_scores = store.scores(qemb)
+            movie_scores = segment_scores(all_scores, self.chunk_offsets, self.aggregation, self.top_n)
+            best = ss.top_k(movie_scores, min(limit, int(np.count_nonzero(np.diff(self.chunk_offsets)))))
+            return [(int(m), float(movie_scores[m])) for m in best]
+        if self.aggregation == "max": return self.__best_chunk_scores(store, qemb, limit, nprobe, rescore, all_scores)
+        # Partial scans find candidate movies by their best chunk; all chunks
+        # of those are then scored and reduced.
+        movies = np.array([m for m, _ in self.__best_chunk_scores(store, qemb, limit * AGGREGATE_CANDIDATES, nprobe, rescore, all_scores)],
+                          dtype=np.int64)
+        counts = self.chunk_offsets[movies + 1] - self.chunk_offsets[movies]
+        offsets = np.zeros(len(movies) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        rows = np.repeat(self.chunk_offsets[movies] - offsets[:-1], counts) + np.arange(int(offsets[-1]))
+        scores = store.exact_scores(rows, qemb) if rescore else store.scores(qemb, rows)
+        movie_scores = segment_scores(scores, offsets, self.aggregation, self.top_n)
+        return [(int(movies[j]), float(movie_scores[j])) for j in ss.top_k(movie_scores, min(limit, len(movies)))]
+
+    def __best_chunk_scores(self, store, qemb, limit, nprobe=None, rescore=True, all_scores=None):
+        # (movie_idx, best chunk score) of the limit best movies. With an
+        # nprobe only the chunks of the IVF lists closest to the query are
+        # scored; nprobe doubles until they hold limit movies, so deep
+        # searches degrade to exact ones. Quantized scores of the leading
+        # chunks are optionally rescored at full precision.
+        while True:
+            ids = self.ann_index.candidates(qemb, nprobe) if nprobe else None
+            scores = all_scores if ids is None and all_scores is not None else store.scores(qemb, ids)
+            groups = self.chunk_movie_idx if ids is None else self.chunk_movie_idx[ids]
+            if rescore and store.precision != "float32":
+                top = top_chunks(scores, groups, limit * store.rescore_factor)
+                scores, groups = store.exact_scores(top if ids is None else ids[top], qemb), groups[top]
+            movie_scores = best_per_group(scores, groups, limit)
+            if ids is None or len(movie_scores) >= limit or nprobe >= self.ann_index.n_lists: return movie_scores
+            nprobe *= 2
+
+    def __full_precision(self):
+        if self.chunk_embeddings.precision == "float32": return self.chunk_embeddings
+        return load_or_quantize(self.chunk_embeddings_cache_file)
+
     def build_chunk_embeddings(self, documents):
+        # Chunks and encodes every document again; load_or_create_chunk_embeddings only encodes changes.
         self.documents = documents
-        self.document_map = { d["id"]: d for d in documents }
-        
-        self.chunks = []
-        self.chunk_metadata = []
-        for id in range(len(self.documents)):
-            d = self.documents[id]
-            if not d["description"]: continue
-            dscs = semantic_chunk(d["description"], 4, 1)
-            midx = d["id"]
-
-            for isc in range(len(dscs)):
-                sc = dscs[isc]
-                self.chunks.append(sc)
-                self.chunk_metadata.append({
-                    "movie_idx": id,         # The index of the document in self.documents
-                    "chunk_idx": isc,        # The index of the chunk within the document
-                    "total_chunks": len(dscs)
-                })
-        
-        self.chunk_embeddings = [self.model.encode(c, show_progress_bar = True) for c in self.chunks]
-        np.save(self.chunk_embeddings_cache_file, self.chunk_embeddings)
-        with open(self.chunk_metadata_file, 'w') as f:
-            json.dump({"chunks": self.chunk_metadata, "total_chunks": len(self.chunks)}, f, indent=2)
-        
+        self.document_map = ss.document_map(documents)
+        self.chunks, counts = chunk_documents(documents, range(len(documents)))
+        chunk_embeddings = ss.encode_texts(self.model, self.chunks, self.embed_batch_size, self.embed_workers)
+        save_embeddings(self.chunk_embeddings_cache_file, chunk_embeddings, fingerprints(self.chunks, self.model_name))
+        ChunkMetadata.from_chunk_counts(np.arange(len(documents)), counts,
+                                        self.__document_keys(documents)).save(self.chunk_metadata_dir)
+        return self.__open_chunk_embeddings()
+
+    def __document_keys(self, documents):
+        # Fingerprint of what chunking a document's description yields.
+        chunking = f"{self.model_name}:{CHUNK_SENTENCES}:{CHUNK_OVERLAP}"
+        return fingerprints([d["description"] or "" for d in documents], chunking)
+
+    def __encode_chunks(self, chunks):
+        return ss.encode_texts(self.model, chunks, self.embed_batch_size, self.embed_workers)
+
+    def __update_changed_documents(self, old, old_keys, doc_keys):
+        # Rewrites the chunk embeddings for the current documents: documents
+        # whose key is in old keep their rows, the others are chunked again
+        # and only chunks whose text has no row yet are encoded. Returns the
+        # number of chunks encoded and each document's chunk count.
+        match = match_keys(old.doc_keys, doc_keys)     # document -> its position among the old ones, or -1
+        old_offsets = old.group_offsets(len(old.doc_keys))
+        old_starts, old_counts = old_offsets[:-1], np.diff(old_offsets)
+        changed = np.flatnonzero(match < 0)
+        chunks, changed_counts = chunk_documents(self.documents, changed)
+        counts = np.zeros(len(doc_keys), dtype=np.int64)
+        counts[match >= 0] = old_counts[match[match >= 0]]
+        counts[changed] = changed_counts
+
+        doc_of_row = np.repeat(np.arange(len(doc_keys)), counts)
+        offsets = np.arange(len(doc_of_row)) - (np.cumsum(counts) - counts)[doc_of_row]
+        kept = match[doc_of_row] >= 0
+        rows = np.full(len(doc_of_row), -1, dtype=np.int64)
+        rows[kept] = old_starts[match[doc_of_row[kept]]] + offsets[kept]
+        keys = np.empty(len(doc_of_row), dtype=np.uint64)
+        keys[kept] = old_keys[rows[kept]]
+        keys[~kept] = fingerprints(chunks, self.model_name)
+        rows[~kept] = match_keys(old_keys, keys[~kept])
+        missing = np.flatnonzero(rows[~kept] < 0)
+        encoded = self.__encode_chunks([chunks[i] for i in missing]) if len(missing) or not len(keys) else None
+        assemble_embeddings(self.chunk_embeddings_cache_file, keys, rows, encoded)
+        return len(missing), counts
+
+    def __open_chunk_embeddings(self):
+        # Maps the chunk embeddings and metadata columns; None when they disagree.
+        self.chunk_metadata = load_chunk_metadata(self.chunk_metadata_dir, self.legacy_chunk_metadata_file)
+        if self.chunk_metadata is None: return None
+        self.chunk_embeddings = load_or_quantize(self.chunk_embeddings_cache_file, self.precision)
+        self.chunk_embeddings_version = (file_version(self.chunk_embeddings_cache_file),
+                                         file_version(os.path.join(self.chunk_metadata_dir, "meta.json")))
+        if len(self.chunk_embeddings) != len(self.chunk_metadata):
+            print(f"Embedding and Metadata count mismatch {len(self.chunk_embeddings)} {len(self.chunk_metadata)}")
+            return None
+        self.chunk_movie_idx = self.chunk_metadata.movie_idx
+        self.chunk_offsets = self.chunk_metadata.group_offsets(len(self.documents))
         return self.chunk_embeddings
     
     def load_or_create_chunk_embeddings(self, documents: list[dict]):
+        # Documents are keyed by a fingerprint of their description, chunks by
+        # one of their text and model: unchanged documents keep their rows,
+        # only new chunks of new or changed documents are encoded, and rows
+        # of deleted documents are dropped.
         self.documents = documents
-        self.document_map = { d["id"]: d for d in documents }
-        if os.path.exists(self.chunk_metadata_file):
-            with open(self.chunk_metadata_file) as f:
-                self.chunk_metadata = json.load(f)["chunks"]
+        self.document_map = ss.document_map(documents)
+        doc_keys = self.__document_keys(documents)
+        old = None
         if os.path.exists(self.chunk_embeddings_cache_file):
-            self.chunk_embeddings = np.load(self.chunk_embeddings_cache_file)
-            if len(self.chunk_embeddings) == len(self.chunk_metadata):
-                return self.chunk_embeddings
-            else: 
-                print(f"Embedding and Metadata count mismatch {len(self.chunk_embeddings)} {len(self.chunk_metadata)}")
+            old = load_chunk_metadata(self.chunk_metadata_dir, self.legacy_chunk_metadata_file)
+            if old is not None and old.doc_keys is not None and np.array_equal(old.doc_keys, doc_keys):
+                chunk_embeddings = self.__open_chunk_embeddings()
+                if chunk_embeddings is not None: return chunk_embeddings
+
+        old_keys = load_keys(self.chunk_embeddings_cache_file) if old is not None else None
+        if old is None or old.doc_keys is None or old_keys is None or len(old_keys) != len(old):
+            # Without document keys every document is chunked; rows still match by chunk text.
+            self.chunks, counts = chunk_documents(documents, range(len(documents)))
+            encode = lambda missing: self.__encode_chunks([self.chunks[i] for i in missing])
+            encoded = update_embeddings(self.chunk_embeddings_cache_file, fingerprints(self.chunks, self.model_name), encode)
+        else:
+            encoded, counts = self.__update_changed_documents(old, old_keys, doc_keys)
+        ChunkMetadata.from_chunk_counts(np.arange(len(documents)), counts, doc_keys).save(self.chunk_metadata_dir)
+        if encoded: print(f"Encoded {encoded} new or changed chunks")
+        chunk_embeddings = self.__open_chunk_embeddings()
+        return chunk_embeddings if chunk_embeddings is not None else self.build_chunk_embeddings(documents)
+
+    def build_ann_index(self, n_lists=None):
+        if self.chunk_embeddings is None: 
+            raise ValueError("No chunk embeddings loaded. Call `load_or_create_chunk_embeddings` first.")
+        source = file_version(self.chunk_embeddings_cache_file)[1:]
+        self.ann_index = IvfIndex.build(self.__full_precision().rows(), n_lists, source=source)
+        self.ann_index.save(self.ann_index_file)
+        return self.ann_index
+
+    def load_or_create_ann_index(self, n_lists=None):
+        # An index built from other chunk embeddings than the loaded ones is rebuilt.
+        if IvfIndex.exists(self.ann_index_file):
+            index = IvfIndex.open(self.ann_index_file)
+            if index.source == file_version(self.chunk_embeddings_cache_file)[1:] and \
+               len(index.list_ids) == len(self.chunk_embeddings) and (n_lists is None or n_lists == index.n_lists):
+                self.ann_index = index
+                return index
+        return self.build_ann_index(n_lists)
+
+    def __recall(self, qembs, exact, limit, store, nprobe=None, rescore=True):
+        # Mean recall@limit of movies against exact, and mean latency in ms.
+        recalls, start = [], time.perf_counter()
+        for q, e in zip(qembs, exact):
+            recalls.append(recall(e, [m for m, _ in self.__movie_scores(store, q, limit, nprobe, rescore)]))
+        latency = (time.perf_counter() - start) / max(len(qembs), 1)
+        return (float(np.mean(recalls)) if recalls else 1.0), latency * 1e3
+
+    def __exact_movies(self, queries, limit):
+        qembs = ss.normalize_rows(ss.encode_texts(self.model, queries, self.embed_batch_size))
+        full = self.__full_precision()
+        return qembs, [[m for m, _ in self.__movie_scores(full, q, limit)] for q in qembs]
+
+    def ann_recall(self, queries, limit, nprobes):
+        # recall@limit of movies and mean latency per nprobe, against exact search.
+        qembs, exact = self.__exact_movies(queries, limit)
+        report = []
+        for nprobe in nprobes:
+            r, latency = self.__recall(qembs, exact, limit, self.chunk_embeddings, nprobe, self.rescore)
+            report.append({"nprobe": nprobe, "recall": r, "latency_ms": latency})
+        return report
+
+    def precision_recall(self, queries, limit, precisions=PRECISIONS):
+        # recall@limit of movies, mean latency and memory per precision, with
+        # and without rescoring, against exact float32 search.
+        qembs, exact = self.__exact_movies(queries, limit)
+        report = []
+        for precision in precisions:
+            store = load_or_quantize(self.chunk_embeddings_cache_file, precision)
+            for rescore in ([False, True] if precision != "float32" else [False]):
+                r, latency = self.__recall(qembs, exact, limit, store, rescore=rescore)
+                report.append({"precision": precision, "rescore": rescore, "recall": r,
+                               "latency_ms": latency, "megabytes": store.nbytes / 2**20})
+        return report
+
+    def quantization_drift(self, queries, limit, sample_chunks=200):
+        # int8 against float32 encoding: cosine between the two embeddings of
+        # each query and of up to sample_chunks document chunks, recall@limit
+        # of movies searched with the int8 query embeddings against the
+        # float32 ones over the stored chunk embeddings, and mean encode
+        # latency per query of each encoder.
+        positions = np.random.default_rng(0).choice(len(self.documents), min(sample_chunks, len(self.documents)), replace=False)
+        chunks = chunk_documents(self.documents, np.sort(positions))[0][:sample_chunks]
+        qembs, cembs, latency = {}, {}, {}
+        for quantized in (False, True):
+            model = MR.sentence_transformer(self.model_name, quantized)
+            with MR.inference():
+                start = time.perf_counter()
+                qembs[quantized] = ss.normalize_rows(np.stack([model.encode([q])[0] for q in queries]))
+                latency[quantized] = (time.perf_counter() - start) / len(queries) * 1e3
+                cembs[quantized] = ss.normalize_rows(model.encode(chunks, batch_size=self.embed_batch_size))
+        full = self.__full_precision()
+        exact = [[m for m, _ in self.__movie_scores(full, q, limit)] for q in qembs[False]]
+        r, _ = self.__recall(qembs[True], exact, limit, full)
+        query_cosines = np.sum(qembs[False] * qembs[True], axis=1)
+        chunk_cosines = np.sum(cembs[False] * cembs[True], axis=1) if len(chunks) else np.ones(1)
+        return {
+            "queries"           : len(queries),
+            "chunks"            : len(chunks),
+            "query_cosine_mean" : float(query_cosines.mean()),
+            "query_cosine_min"  : float(query_cosines.min()),
+            "chunk_cosine_mean" : float(chunk_cosines.mean()),
+            "chunk_cosine_min"  : float(chunk_cosines.min()),
+            "recall"            : r,
+            "float32_ms"        : latency[False],
+            "int8_ms"           : latency[True],
+        }
+
+def movie_arrays(movie_scores):
+    # (movie_idx, score) pairs as (positions, scores) arrays.
+    return (np.array([m for m, _ in movie_scores], dtype=np.int64),
+            np.array([s for _, s in movie_scores], dtype=np.float64))
+
+def chunk_documents(documents, positions):
+    # Chunk texts of the documents at positions, concatenated, and each one's chunk count.
+    chunks, counts = [], np.zeros(len(positions), dtype=np.int64)
+    for i, p in enumerate(positions):
+        description = documents[p]["description"]
+        dscs = semantic_chunk(description, CHUNK_SENTENCES, CHUNK_OVERLAP) if description else []
+        chunks.extend(dscs)
+        counts[i] = len(dscs)
+    return chunks, counts
 
-        return self.build_chunk_embeddings(documents)
+def segment_scores(scores, offsets, aggregation="max", top_n=TOP_N):
+    # Per-group reduction of scores laid out group by group, group g being
+    # scores[offsets[g]:offsets[g + 1]]; groups without scores get -inf.
+    counts = np.diff(offsets)
+    filled = np.flatnonzero(counts)
+    starts = offsets[:-1][filled]
+    result = np.full(len(counts), -np.inf, dtype=np.float32)
+    if not len(filled): return result
+    if aggregation == "max":
+        result[filled] = np.maximum.reduceat(scores, starts)
+    elif aggregation == "mean":
+        result[filled] = np.add.reduceat(scores, starts) / counts[filled]
+    elif aggregation == "top_n_sum":
+        # top_n passes, each adding every group's highest remaining score and
+        # then removing it; cheaper than sorting within groups for small top_n.
+        remaining = np.array(scores, dtype=np.float32)
+        group_of = np.repeat(np.arange(len(filled)), counts[filled])
+        sums = np.zeros(len(filled), dtype=np.float32)
+        for _ in range(min(top_n, int(counts.max()))):
+            best = np.maximum.reduceat(remaining, starts)
+            sums += np.where(np.isfinite(best), best, 0)
+            hits = np.flatnonzero(remaining == best[group_of])
+            first = np.diff(group_of[hits], prepend=-1) != 0     # hits are in order, so groups are contiguous
+            remaining[hits[first]] = -np.inf
+        result[filled] = sums
+    else: raise ValueError(f"Unknown aggregation '{aggregation}'")
+    return result
 
+def top_chunks(scores, groups, n_groups):
+    # Chunk indices best first, down to the best chunk of the n_groups-th
+    # distinct group. Widens a top-k until enough groups are seen instead
+    # of reducing every group.
+    k = n_groups * 2
+    while True:
+        top = ss.top_k(scores, k)
+        _, first = np.unique(groups[top], return_index=True)
+        if len(first) >= n_groups or k >= len(scores): break
+        k *= 4
+    if len(first) > n_groups: top = top[:np.sort(first)[n_groups - 1] + 1]
+    return top
 
+def best_per_group(scores, groups, limit):
+    # (group, best score) of the limit groups whose best score is highest, best first.
+    if limit <= 0: return []
+    top = top_chunks(scores, groups, limit)
+    _, first = np.unique(groups[top], return_index=True)
+    return [(int(groups[top[j]]), float(scores[top[j]])) for j in np.sort(first)]
 
 def chunk(text, chunk_size, overlap):
     tokens = text.split()
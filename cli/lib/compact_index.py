@@ -0,0 +1,327 @@
+import os
+import json
+import mmap
+import bisect
+import heapq
+import itertools
+import pickle
+import shutil
+import numpy as np
+from collections.abc import Mapping
+
+FORMAT_VERSION = 1
+
+# On-disk layout of an index directory. Arrays are .npy files opened with
+# mmap, so opening an index reads only meta.json and queries page in just
+# the postings of the terms they touch.
+#   meta.json              format version, document/term counts, total and average length
+#   terms.bin              sorted UTF-8 terms, concatenated
+#   term_offsets.npy       int64[terms + 1]  byte offsets into terms.bin
+#   postings_offsets.npy   int64[terms + 1]  offsets into doc_ordinals / term_freqs
+#   doc_ordinals.npy       int32[postings]   ascending within each term
+#   term_freqs.npy         int32[postings]
+#   doc_ids.npy            int64[docs]       document id per ordinal
+#   doc_id_order.npy       int32[docs]       ordinals sorted by document id
+#   doc_lengths.npy        int32[docs]       tokens per document
+#   documents.jsonl        one JSON document per ordinal
+#   document_offsets.npy   int64[docs + 1]   byte offsets into documents.jsonl
+# Indexes built with positions add, per posting, its term_freq word positions
+# delta-encoded (first absolute, then gaps) as uint16, or uint32 if needed:
+#   positions.npy          uint16[sum of term_freqs]
+#   position_offsets.npy   int64[postings + 1]  offsets into positions
+ARRAYS = ["term_offsets", "postings_offsets", "doc_ordinals", "term_freqs",
+          "doc_ids", "doc_id_order", "doc_lengths", "document_offsets"]
+POSITION_ARRAYS = ["positions", "position_offsets"]
+BLOBS = ["terms.bin", "documents.jsonl"]
+
+
+class CompactIndex:
+
+    def __init__(self, meta, arrays, terms, documents):
+        self.meta = meta
+        self.doc_count = meta["doc_count"]
+        self.term_count = meta["term_count"]
+        self.total_length = meta.get("total_length")
+        if self.total_length is None:
+            self.total_length = int(np.sum(arrays["doc_lengths"], dtype=np.int64))
+        self.avg_doc_length = meta["avg_doc_length"]
+        self.path = None            # directory once saved or opened
+        self.term_offsets = arrays["term_offsets"]
+        self.postings_offsets = arrays["postings_offsets"]
+        self.doc_ordinals = arrays["doc_ordinals"]
+        self.term_freqs = arrays["term_freqs"]
+        self.doc_ids = arrays["doc_ids"]
+        self.doc_id_order = arrays["doc_id_order"]
+        self.doc_lengths = arrays["doc_lengths"]
+        self.document_offsets = arrays["document_offsets"]
+        self.positions = arrays.get("positions")                # None without positions
+        self.position_offsets = arrays.get("position_offsets")
+        self.terms = terms          # bytes or mmap
+        self.documents = documents  # bytes or mmap
+
+    @classmethod
+    def empty(cls):
+        return cls.from_documents([], [], [])
+
+    @classmethod
+    def from_documents(cls, doc_ids, documents, term_frequencies, doc_lengths=None, term_positions=None):
+        # doc_ids, documents and term_frequencies (Counter per document) are
+        # parallel lists in ordinal order. term_positions, when given, holds
+        # per document a dict term -> ascending word positions.
+        if doc_lengths is None:
+            doc_lengths = [sum(tf.values()) for tf in term_frequencies]
+        postings = {}   # term -> ([ordinals], [tfs], [position deltas])
+        for ordinal, tf in enumerate(term_frequencies):
+            for term, count in tf.items():
+                entry = postings.get(term)
+                if entry is None:
+                    entry = postings[term] = ([], [], [])
+                entry[0].append(ordinal)
+                entry[1].append(count)
+                if term_positions is not None:
+                    p = term_positions[ordinal][term]
+                    entry[2].append(p[0])
+                    entry[2].extend(b - a for a, b in zip(p, p[1:]))
+
+        terms = sorted(postings)
+        counts = [len(postings[t][0]) for t in terms]
+        doc_ordinals = np.fromiter((o for t in terms for o in postings[t][0]), dtype=np.int32, count=sum(counts))
+        term_freqs = np.fromiter((c for t in terms for c in postings[t][1]), dtype=np.int32, count=sum(counts))
+        positions = None
+        if term_positions is not None:
+            positions = np.fromiter((d for t in terms for d in postings[t][2]), dtype=np.int64, count=int(term_freqs.sum()))
+        serialized = [json.dumps(d).encode("utf-8") + b"\n" for d in documents]
+        return cls.assemble(
+            [t.encode("utf-8") for t in terms], counts, doc_ordinals, term_freqs,
+            np.array(doc_ids, dtype=np.int64), np.array(doc_lengths, dtype=np.int32),
+            [len(d) for d in serialized], b"".join(serialized), positions)
+
+    @classmethod
+    def assemble(cls, encoded_terms, postings_counts, doc_ordinals, term_freqs, doc_ids, doc_lengths, document_sizes, documents, positions=None):
+        # Shared tail of every constructor: offsets, id order and metadata.
+        term_offsets = np.zeros(len(encoded_terms) + 1, dtype=np.int64)
+        np.cumsum([len(t) for t in encoded_terms], out=term_offsets[1:])
+        postings_offsets = np.zeros(len(encoded_terms) + 1, dtype=np.int64)
+        np.cumsum(postings_counts, out=postings_offsets[1:])
+        document_offsets = np.zeros(len(doc_ids) + 1, dtype=np.int64)
+        np.cumsum(document_sizes, out=document_offsets[1:])
+        total_length = int(np.sum(doc_lengths, dtype=np.int64))
+        arrays = {
+            "term_offsets"      : term_offsets,
+            "postings_offsets"  : postings_offsets,
+            "doc_ordinals"      : np.asarray(doc_ordinals, dtype=np.int32),
+            "term_freqs"        : np.asarray(term_freqs, dtype=np.int32),
+            "doc_ids"           : doc_ids,
+            "doc_id_order"      : np.argsort(doc_ids, kind="stable").astype(np.int32),
+            "doc_lengths"       : doc_lengths,
+            "document_offsets"  : document_offsets,
+        }
+        if positions is not None:
+            positions = np.asarray(positions)
+            fits_uint16 = len(positions) == 0 or int(positions.max()) <= np.iinfo(np.uint16).max
+            arrays["positions"] = positions.astype(np.uint16 if fits_uint16 else np.uint32)
+            arrays["position_offsets"] = np.zeros(len(term_freqs) + 1, dtype=np.int64)
+            np.cumsum(term_freqs, out=arrays["position_offsets"][1:])
+        meta = {
+            "version"        : FORMAT_VERSION,
+            "doc_count"      : len(doc_ids),
+            "term_count"     : len(encoded_terms),
+            "total_length"   : total_length,
+            "avg_doc_length" : total_length / len(doc_ids) if len(doc_ids) else 0.0,
+            "positions"      : positions is not None,
+        }
+        return cls(meta, arrays, b"".join(encoded_terms), documents)
+
+    @classmethod
+    def merge(cls, parts):
+        # Concatenates indexes over consecutive document ranges. Part i's
+        # ordinals follow part i-1's, so the result is identical to building
+        # one index over all documents in order.
+        if not parts: return cls.empty()
+        doc_bases = np.cumsum([0] + [p.doc_count for p in parts])
+        merged_terms = heapq.merge(*[zip(p.iter_terms(), itertools.repeat(i)) for i, p in enumerate(parts)])
+
+        terms, counts, slices = [], [], []
+        cursors = [0] * len(parts)     # next term id per part
+        for term, i in merged_terms:
+            p, j = parts[i], cursors[i]
+            cursors[i] += 1
+            start, end = int(p.postings_offsets[j]), int(p.postings_offsets[j + 1])
+            if not terms or terms[-1] != term:
+                terms.append(term)
+                counts.append(0)
+            counts[-1] += end - start
+            slices.append((i, start, end))
+
+        empty = np.empty(0, dtype=np.int32)
+        doc_ordinals = np.concatenate([empty] + [parts[i].doc_ordinals[a:b] + np.int32(doc_bases[i]) for i, a, b in slices])
+        term_freqs = np.concatenate([empty] + [parts[i].term_freqs[a:b] for i, a, b in slices])
+        positions = None
+        if all(p.positions is not None for p in parts):
+            positions = np.concatenate([np.empty(0, dtype=np.uint32)] + [
+                parts[i].positions[parts[i].position_offsets[a]:parts[i].position_offsets[b]] for i, a, b in slices])
+        return cls.assemble(
+            [t.encode("utf-8") for t in terms], counts, doc_ordinals, term_freqs,
+            np.concatenate([p.doc_ids for p in parts]).astype(np.int64),
+            np.concatenate([p.doc_lengths for p in parts]).astype(np.int32),
+            np.concatenate([np.diff(p.document_offsets) for p in parts]),
+            b"".join(bytes(p.documents) for p in parts), positions)
+
+    def without(self, deleted):
+        # Copy of this index with the given ordinals removed and the
+        # remaining documents renumbered in order.
+        keep = np.ones(self.doc_count, dtype=bool)
+        keep[np.asarray(deleted, dtype=np.int64)] = False
+        renumbered = np.cumsum(keep, dtype=np.int64) - 1
+        live_postings = keep[self.doc_ordinals]
+        kept_before = np.concatenate([[0], np.cumsum(live_postings, dtype=np.int64)])
+        counts = np.diff(kept_before[self.postings_offsets])
+        live_terms = np.flatnonzero(counts)
+        documents = b"".join(bytes(self.documents[self.document_offsets[o]:self.document_offsets[o + 1]])
+                             for o in np.flatnonzero(keep))
+        positions = None
+        if self.positions is not None:
+            positions = self.positions[np.repeat(live_postings, self.term_freqs)]
+        return self.assemble(
+            [bytes(self.terms[self.term_offsets[i]:self.term_offsets[i + 1]]) for i in live_terms],
+            counts[live_terms], renumbered[self.doc_ordinals[live_postings]], self.term_freqs[live_postings],
+            np.asarray(self.doc_ids[keep], dtype=np.int64), np.asarray(self.doc_lengths[keep], dtype=np.int32),
+            np.diff(self.document_offsets)[keep], documents, positions)
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format version {meta.get('version')} in {path}")
+        names = ARRAYS + (POSITION_ARRAYS if meta.get("positions") else [])
+        arrays = {a: np.load(os.path.join(path, f"{a}.npy"), mmap_mode="r") for a in names}
+        terms, documents = [open_blob(os.path.join(path, b)) for b in BLOBS]
+        index = cls(meta, arrays, terms, documents)
+        index.path = path
+        return index
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "meta.json"))
+
+    def save(self, path):
+        # Written to a sibling directory and swapped in: files of an index
+        # already at path are unlinked, never rewritten, so processes that
+        # have them memory-mapped keep reading the old index.
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for a in ARRAYS + (POSITION_ARRAYS if self.positions is not None else []):
+            np.save(os.path.join(tmp, f"{a}.npy"), np.asarray(getattr(self, a)))
+        for b, blob in zip(BLOBS, [self.terms, self.documents]):
+            with open(os.path.join(tmp, b), "wb") as f:
+                f.write(blob)
+        # meta.json last: an index without it is incomplete and never opened.
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2)
+        if os.path.exists(path): shutil.rmtree(path)
+        os.replace(tmp, path)
+        self.path = path
+
+
+    def iter_terms(self):
+        return (self.term(i) for i in range(self.term_count))
+
+    def term(self, term_id):
+        return self.terms[self.term_offsets[term_id]:self.term_offsets[term_id + 1]].decode("utf-8")
+
+    def term_id(self, term):
+        key = term.encode("utf-8")
+        offsets = self.term_offsets
+        i = bisect.bisect_left(range(self.term_count), key, key=lambda i: self.terms[offsets[i]:offsets[i + 1]])
+        if i < self.term_count and self.terms[offsets[i]:offsets[i + 1]] == key:
+            return i
+        return -1
+
+    def postings(self, term):
+        # term -> (document ordinals ascending, term frequencies), mmap views
+        i = self.term_id(term)
+        if i < 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        start, end = self.postings_offsets[i], self.postings_offsets[i + 1]
+        return self.doc_ordinals[start:end], self.term_freqs[start:end]
+
+    def doc_freq(self, term):
+        i = self.term_id(term)
+        return 0 if i < 0 else int(self.postings_offsets[i + 1] - self.postings_offsets[i])
+
+    def term_frequency(self, term, ordinal):
+        ordinals, tfs = self.postings(term)
+        j = int(np.searchsorted(ordinals, ordinal))
+        return int(tfs[j]) if j < len(ordinals) and ordinals[j] == ordinal else 0
+
+    def term_positions(self, term, ordinal):
+        # Word positions of term in document ordinal, empty when absent.
+        i = self.term_id(term)
+        if i < 0 or self.positions is None: return np.empty(0, dtype=np.int64)
+        start, end = int(self.postings_offsets[i]), int(self.postings_offsets[i + 1])
+        j = start + int(np.searchsorted(self.doc_ordinals[start:end], ordinal))
+        if j >= end or self.doc_ordinals[j] != ordinal: return np.empty(0, dtype=np.int64)
+        deltas = self.positions[self.position_offsets[j]:self.position_offsets[j + 1]]
+        return np.cumsum(deltas, dtype=np.int64)
+
+    def ordinal(self, doc_id):
+        # document id -> ordinal, -1 when missing
+        order, ids = self.doc_id_order, self.doc_ids
+        j = bisect.bisect_left(order, doc_id, key=lambda o: ids[o])
+        if j < self.doc_count and ids[order[j]] == doc_id:
+            return int(order[j])
+        return -1
+
+    def document(self, ordinal):
+        start, end = self.document_offsets[ordinal], self.document_offsets[ordinal + 1]
+        return json.loads(self.documents[start:end])
+
+    def iter_doc_ids(self):
+        return (int(d) for d in self.doc_ids)
+
+
+class DocumentMap(Mapping):
+    # Read-only document id -> document view over a CompactIndex or
+    # SegmentedIndex. Documents are decoded on access instead of being held
+    # as Python dicts.
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, doc_id):
+        ordinal = self.index.ordinal(doc_id)
+        if ordinal < 0: raise KeyError(doc_id)
+        return self.index.document(ordinal)
+
+    def __iter__(self):
+        return self.index.iter_doc_ids()
+
+    def __len__(self):
+        return self.index.doc_count
+
+
+def open_blob(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0: return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def convert_pickle_cache(index_dir, docmap_file, term_frequencies_file, doc_lengths_file):
+    # Converts the legacy cache/*.pkl files written by KeywordSearch.save into
+    # the compact format. Documents keep their docmap order as ordinals.
+    with open(docmap_file, "rb") as f:
+        docmap = pickle.load(f)
+    with open(term_frequencies_file, "rb") as f:
+        term_frequencies = pickle.load(f)
+    with open(doc_lengths_file, "rb") as f:
+        doc_lengths = pickle.load(f)
+    doc_ids = list(docmap)
+    index = CompactIndex.from_documents(
+        doc_ids,
+        [docmap[d] for d in doc_ids],
+        [term_frequencies[d] for d in doc_ids],
+        [doc_lengths[d] for d in doc_ids])
+    index.save(index_dir)
+    return index
@@ -0,0 +1,140 @@
+import os
+import json
+from collections.abc import Mapping, Sequence
+
+MOVIES_JSON_FILE = "data/movies.json"
+READ_CHUNK_SIZE = 1 << 20
+NUMBER_CHARS = "0123456789+-.eE"
+
+shared_stores = {}  # absolute path -> (file stamp, DocumentStore) shared by the whole process
+
+
+class DocumentStore(Sequence):
+    # The single in-process copy of the corpus. Documents are addressed by
+    # position (list order of the source file) and by document id.
+
+    def __init__(self, documents=()):
+        self.documents = []
+        self.positions = {}     # document id -> position
+        self.by_id = DocumentsById(self)
+        for d in documents: self.append(d)
+
+    @classmethod
+    def from_file(cls, path, key="movies"):
+        # .jsonl holds one document per line; .json holds a top-level array
+        # or an object whose `key` is the array. Both are parsed streaming.
+        with open(path) as f:
+            if path.endswith(".jsonl"):
+                return cls(json.loads(line) for line in f if line.strip())
+            return cls(iter_json_array(f, key))
+
+    def append(self, document):
+        self.positions[document["id"]] = len(self.documents)
+        self.documents.append(document)
+
+    def __getitem__(self, position):
+        return self.documents[position]
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def position(self, doc_id):
+        return self.positions[doc_id]
+
+    def get(self, doc_id, default=None):
+        position = self.positions.get(doc_id)
+        return default if position is None else self.documents[position]
+
+
+class DocumentsById(Mapping):
+    # document id -> document view over a DocumentStore, without a second dict of documents.
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, doc_id):
+        return self.store.documents[self.store.positions[doc_id]]
+
+    def __iter__(self):
+        return iter(self.store.positions)
+
+    def __len__(self):
+        return len(self.store.positions)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.store.positions
+
+
+def load_documents(path=MOVIES_JSON_FILE):
+    # Parses each corpus file once per process; every search component that
+    # asks for the same file gets the same store until the file changes.
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = shared_stores.get(path)
+    if cached is None or cached[0] != stamp:
+        cached = shared_stores[path] = (stamp, DocumentStore.from_file(path))
+    return cached[1]
+
+def document_map(documents):
+    # document id -> document for a DocumentStore or a plain list of documents.
+    if isinstance(documents, DocumentStore): return documents.by_id
+    return {d["id"]: d for d in documents}
+
+def iter_json_array(f, key=None):
+    # Yields the items of a JSON array one at a time while reading f in
+    # chunks, so the raw text is never held in memory as a whole. The array
+    # is either the top-level value or the value of the top-level object's
+    # `key` member; members before it are decoded and skipped.
+    decoder = json.JSONDecoder()
+    buf, pos = f.read(READ_CHUNK_SIZE), 0
+
+    def peek(skipped=" \t\r\n"):
+        # The next character not in skipped, reading more of f as needed.
+        nonlocal buf, pos
+        while True:
+            while pos < len(buf) and buf[pos] in skipped: pos += 1
+            if pos < len(buf): return buf[pos]
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk: raise ValueError("Unexpected end of JSON input")
+            buf, pos = buf[pos:] + chunk, 0
+
+    def decode():
+        # The next JSON value. A number running to the end of buf, or up to
+        # a character that could continue it, may be cut short, so it is
+        # decoded again with more input.
+        nonlocal buf, pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) and buf[end] not in NUMBER_CHARS: break
+            except json.JSONDecodeError:
+                pass
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                value, end = decoder.raw_decode(buf, pos)
+                break
+            buf, pos = buf[pos:] + chunk, 0
+        pos = end
+        if pos > READ_CHUNK_SIZE: buf, pos = buf[pos:], 0
+        return value
+
+    if peek() != "[":
+        if peek() != "{" or key is None: raise ValueError(f"No JSON array '{key}' found")
+        pos += 1
+        while True:
+            if peek(" \t\r\n,") == "}": raise ValueError(f"No JSON array '{key}' found")
+            name = decode()
+            if peek() != ":": raise ValueError(f"Expected ':' after JSON member '{name}'")
+            pos += 1
+            if name == key: break
+            decode()
+        if peek() != "[": raise ValueError(f"JSON member '{key}' is not an array")
+    pos += 1
+
+    while peek(" \t\r\n,") != "]":
+        yield decode()
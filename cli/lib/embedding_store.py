@@ -0,0 +1,299 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+FORMAT_VERSION = 1
+PRECISIONS = ("float32", "float16", "int8", "binary")
+SCORE_BLOCK_ROWS = 4096         # rows dequantized at once while scoring
+QUERY_BLOCK_ROWS = 256          # queries scored against every row by one matrix product
+RESCORE_FACTORS = {"float32": 1, "float16": 2, "int8": 4, "binary": 32}    # coarse candidates rescored per requested result
+
+# On-disk layout next to an embeddings file, e.g. cache/chunk_embeddings.npy.
+# Every array is opened with mmap, so opening a store reads only its meta
+# file and processes on one host share the rows through the page cache.
+#   chunk_embeddings.npy                 float32[rows, dim]  unit rows
+#   chunk_embeddings.float32.json        meta marking the .npy as unit rows
+#   chunk_embeddings.keys.npy            uint64[rows]  fingerprint of the text each row encodes
+#   chunk_embeddings.<precision>.npy     codes of the quantized rows
+#   chunk_embeddings.<precision>.json    format version, precision, dim, scale/offset,
+#                                        and (mtime_ns, size) of the .npy they came from
+class EmbeddingStore:
+    # Unit embedding rows held at a chosen precision:
+    #   float32  the rows as they are
+    #   float16  half precision, 2x smaller
+    #   int8     one byte per value, scaled per dimension between its min and max, 4x smaller
+    #   binary   one bit per value, set when it is above its dimension's mean,
+    #            32x smaller; scored by Hamming distance h to the query's bits
+    #            as cos(pi * h / dim), which estimates the angle between them
+    # scores() approximates the cosine similarity of rows to a unit query;
+    # exact_scores() scores a few coarse candidates again with the float32
+    # store the rows came from.
+
+    def __init__(self, precision, codes, dim, scale=None, offset=None, source=None):
+        self.precision = precision
+        self.codes = codes
+        self.dim = dim
+        self.scale = scale          # int8: per-dimension step
+        self.offset = offset        # int8: per-dimension minimum, binary: per-dimension mean
+        self.source = source        # (mtime_ns, size) of the float32 file the rows came from
+        self.full = None            # float32 store of the same rows, for rescoring
+
+    @classmethod
+    def quantize(cls, matrix, precision="float32", source=None):
+        if precision not in PRECISIONS: raise ValueError(f"Unknown embedding precision '{precision}'")
+        dim = matrix.shape[1]
+        if precision == "float32": return cls(precision, matrix, dim, source=source)
+        if precision == "float16": return cls(precision, matrix.astype(np.float16), dim, source=source)
+        if precision == "binary":
+            mean = matrix.mean(axis=0, dtype=np.float64).astype(np.float32)
+            return cls(precision, np.packbits(matrix > mean, axis=1), dim, offset=mean, source=source)
+        offset = matrix.min(axis=0)
+        scale = (matrix.max(axis=0) - offset) / 255
+        scale[scale == 0] = 1
+        codes = np.empty(matrix.shape, dtype=np.uint8)
+        for i in range(0, len(matrix), SCORE_BLOCK_ROWS):
+            block = (matrix[i:i + SCORE_BLOCK_ROWS] - offset) / scale
+            codes[i:i + SCORE_BLOCK_ROWS] = np.rint(block)
+        return cls(precision, codes, dim, scale.astype(np.float32), offset.astype(np.float32), source)
+
+    @classmethod
+    def open(cls, embeddings_file, precision="float32"):
+        codes_file, meta_file = store_files(embeddings_file, precision)
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported embeddings format version {meta.get('format_version')} in {meta_file}")
+        scale = np.array(meta["scale"], dtype=np.float32) if "scale" in meta else None
+        offset = np.array(meta["offset"], dtype=np.float32) if "offset" in meta else None
+        codes = np.load(codes_file, mmap_mode="r")
+        return cls(meta["precision"], codes, meta["dim"], scale, offset, tuple(meta["source"]))
+
+    def save(self, embeddings_file):
+        # Quantized codes and their meta; float32 rows are written by save_embeddings.
+        codes_file, meta_file = store_files(embeddings_file, self.precision)
+        with open(codes_file + ".tmp", "wb") as f:
+            np.save(f, self.codes)
+        os.replace(codes_file + ".tmp", codes_file)
+        write_meta(meta_file, self)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return (len(self.codes), self.dim)
+
+    @property
+    def rescore_factor(self):
+        return RESCORE_FACTORS[self.precision]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def rows(self, ids=None):
+        # Dequantized float32 rows (all rows when ids is None).
+        codes = self.codes if ids is None else self.codes[ids]
+        if self.precision == "float32": return codes
+        if self.precision == "float16": return codes.astype(np.float32)
+        if self.precision == "int8": return codes * self.scale + self.offset
+        signs = np.unpackbits(codes, axis=1, count=self.dim).astype(np.float32) * 2 - 1
+        return normalize_rows(signs)
+
+    def scores(self, query, ids=None):
+        # Approximate cosine similarity of the rows ids (all rows when None) to
+        # a unit query; query may also be a dim x n matrix of unit columns,
+        # giving rows x n scores.
+        codes = self.codes if ids is None else self.codes[ids]
+        if self.precision == "float32": return codes @ query
+        if self.precision == "binary":
+            if query.ndim == 2: return np.stack([self.scores(q, ids) for q in query.T], axis=1)
+            query_bits = np.packbits(query > self.offset)
+            distances = np.zeros(len(codes), dtype=np.int64)
+            for i in range(0, len(codes), SCORE_BLOCK_ROWS):
+                block = np.bitwise_count(codes[i:i + SCORE_BLOCK_ROWS] ^ query_bits)
+                distances[i:i + SCORE_BLOCK_ROWS] = block.sum(axis=1, dtype=np.int64)
+            return np.cos(np.pi * distances / self.dim).astype(np.float32)
+        if self.precision == "int8":
+            scale = self.scale if query.ndim == 1 else self.scale[:, None]
+            query, bias = query * scale, self.offset @ query
+        else: bias = None
+        scores = np.empty((len(codes),) + query.shape[1:], dtype=np.float32)
+        block = np.empty((min(len(codes), SCORE_BLOCK_ROWS), self.dim), dtype=np.float32)
+        for i in range(0, len(codes), SCORE_BLOCK_ROWS):
+            rows = block[:len(codes[i:i + SCORE_BLOCK_ROWS])]
+            rows[...] = codes[i:i + SCORE_BLOCK_ROWS]
+            scores[i:i + SCORE_BLOCK_ROWS] = rows @ query
+        return scores + bias if bias is not None else scores
+
+    def scores_many(self, queries):
+        # scores() of every row for each row of a queries x dim matrix of unit
+        # queries, as queries x rows, from one matrix product.
+        if self.precision == "float32": return queries @ self.codes.T
+        return np.ascontiguousarray(self.scores(np.ascontiguousarray(queries.T)).T)
+
+    def query_scores(self, queries):
+        # (query, scores of every row) for each unit query row, scoring
+        # QUERY_BLOCK_ROWS queries at a time.
+        for i in range(0, len(queries), QUERY_BLOCK_ROWS):
+            block = queries[i:i + QUERY_BLOCK_ROWS]
+            yield from zip(block, self.scores_many(block))
+
+    def exact_scores(self, ids, query):
+        # Full-precision scores of rows ids; rows are read in file order.
+        if self.full is None: return self.scores(query, ids)
+        order = np.argsort(ids)
+        scores = np.empty(len(ids), dtype=np.float32)
+        scores[order] = self.full.scores(query, ids[order])
+        return scores
+
+    def search(self, query, k, rescore=True, scores=None):
+        # (row ids, scores) of the k best rows, best first. With rescore, the
+        # rescore_factor * k best approximate rows are rescored at full
+        # precision. scores are those of every row, when already computed.
+        if scores is None: scores = self.scores(query)
+        if not rescore or self.full is None:
+            ids = top_k(scores, k)
+            return ids, scores[ids]
+        candidates = top_k(scores, k * self.rescore_factor)
+        exact = self.exact_scores(candidates, query)
+        best = top_k(exact, k)
+        return candidates[best], exact[best]
+
+    def search_many(self, queries, k, rescore=True):
+        # search() of each unit query row.
+        return [self.search(query, k, rescore, scores) for query, scores in self.query_scores(queries)]
+
+
+def store_files(embeddings_file, precision):
+    # (codes file, meta file) of a store next to embeddings_file.
+    base = os.path.splitext(embeddings_file)[0]
+    codes_file = embeddings_file if precision == "float32" else f"{base}.{precision}.npy"
+    return codes_file, f"{base}.{precision}.json"
+
+def write_meta(meta_file, store):
+    meta = {
+        "format_version" : FORMAT_VERSION,
+        "precision"      : store.precision,
+        "rows"           : len(store),
+        "dim"            : store.dim,
+        "source"         : list(store.source),
+    }
+    if store.scale is not None: meta["scale"] = store.scale.tolist()
+    if store.offset is not None: meta["offset"] = store.offset.tolist()
+    with open(meta_file + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(meta_file + ".tmp", meta_file)
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def save_embeddings(embeddings_file, embeddings, keys=None):
+    # Writes embeddings as unit float32 rows, which is what every store reads,
+    # and the fingerprints of their texts when given.
+    matrix = normalize_rows(embeddings)
+    if keys is not None: save_keys(embeddings_file, keys)
+    with open(embeddings_file + ".tmp", "wb") as f:
+        np.save(f, matrix)
+    os.replace(embeddings_file + ".tmp", embeddings_file)
+    write_meta(store_files(embeddings_file, "float32")[1],
+               EmbeddingStore("float32", matrix, matrix.shape[1], source=file_stamp(embeddings_file)))
+
+def open_embeddings(embeddings_file):
+    # The float32 store of an embeddings file, memory-mapped. A file written
+    # without the meta (raw model output) is normalized in place once.
+    meta_file = store_files(embeddings_file, "float32")[1]
+    if not os.path.exists(meta_file) or EmbeddingStore.open(embeddings_file).source != file_stamp(embeddings_file):
+        save_embeddings(embeddings_file, np.load(embeddings_file))
+    return EmbeddingStore.open(embeddings_file)
+
+def load_or_quantize(embeddings_file, precision="float32"):
+    # The rows of an embeddings file at precision. Quantized rows are cached
+    # next to it and rebuilt when the file changes.
+    full = open_embeddings(embeddings_file)
+    if precision == "float32": return full
+    store = None
+    if os.path.exists(store_files(embeddings_file, precision)[1]):
+        store = EmbeddingStore.open(embeddings_file, precision)
+        if store.source != full.source: store = None
+    if store is None:
+        store = EmbeddingStore.quantize(full.rows(), precision, full.source)
+        store.save(embeddings_file)
+        store = EmbeddingStore.open(embeddings_file, precision)
+    store.full = full
+    return store
+
+def fingerprints(texts, model_name):
+    # uint64 key per text, from the text and the model that encodes it, so
+    # rows are reused only for the same text under the same model.
+    prefix = model_name.encode() + b"\0"
+    return np.fromiter((int.from_bytes(hashlib.blake2b(prefix + t.encode(), digest_size=8).digest(), "little")
+                        for t in texts), dtype=np.uint64, count=len(texts))
+
+def keys_file(embeddings_file):
+    return os.path.splitext(embeddings_file)[0] + ".keys.npy"
+
+def load_keys(embeddings_file):
+    # Fingerprints of the rows of embeddings_file; None for files written without them.
+    path = keys_file(embeddings_file)
+    return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+def save_keys(embeddings_file, keys):
+    path = keys_file(embeddings_file)
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, np.asarray(keys, dtype=np.uint64))
+    os.replace(path + ".tmp", path)
+
+def match_keys(old_keys, keys):
+    # For each key, a row of old_keys holding it, or -1.
+    if not len(old_keys) or not len(keys): return np.full(len(keys), -1, dtype=np.int64)
+    order = np.argsort(old_keys, kind="stable")
+    sorted_keys = np.asarray(old_keys)[order]
+    at = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(sorted_keys[at] == keys, order[at], -1)
+
+def assemble_embeddings(embeddings_file, keys, rows, encoded=None):
+    # Rewrites embeddings_file with one row per key: row rows[i] of the
+    # current file where rows[i] >= 0, else the next row of encoded.
+    reused = rows >= 0
+    old = open_embeddings(embeddings_file) if reused.any() else None
+    matrix = np.empty((len(keys), old.dim if old is not None else encoded.shape[1]), dtype=np.float32)
+    if old is not None: matrix[reused] = old.codes[rows[reused]]
+    if encoded is not None: matrix[~reused] = encoded
+    save_embeddings(embeddings_file, matrix, keys)
+
+def update_embeddings(embeddings_file, keys, encode):
+    # Brings embeddings_file to one row per key, in order. Rows whose key is
+    # already in the file are reused, deleted ones dropped, and only the
+    # missing positions are passed to encode, which returns their rows.
+    # Returns the number of rows encoded. Nothing is known about the rows
+    # of a file written without keys, so it is encoded again in full.
+    old_keys = load_keys(embeddings_file) if os.path.exists(embeddings_file) else None
+    if old_keys is not None and len(old_keys) != len(open_embeddings(embeddings_file)): old_keys = None
+    if old_keys is not None and np.array_equal(old_keys, keys): return 0
+    rows = match_keys(old_keys, keys) if old_keys is not None else np.full(len(keys), -1, dtype=np.int64)
+    missing = np.flatnonzero(rows < 0)
+    encoded = encode(missing) if len(missing) or not len(keys) else None
+    assemble_embeddings(embeddings_file, keys, rows, encoded)
+    return len(missing)
+
+def normalize(vector):
+    norm = np.linalg.norm(vector)
+    return np.asarray(vector / norm if norm else vector, dtype=np.float32)
+
+def normalize_rows(embeddings):
+    # Unit rows in a new contiguous float32 matrix, so a matrix-vector
+    # product gives cosine similarities; zero rows stay zero and score 0.
+    # embeddings itself, possibly a read-only memmap, is left as it is.
+    matrix = np.array(embeddings, dtype=np.float32, order="C")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+def top_k(scores, k):
+    # Indices of the k highest scores, best first, without sorting them all.
+    if k <= 0: return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
@@ -1,15 +1,24 @@
 import os
 from dotenv import load_dotenv
-from google import genai
 
 
 load_dotenv()
 api_key = os.environ.get("GEMINI_API_KEY")
-client = genai.Client(api_key=api_key)
+client = None   # genai.Client, created by the first request
+
+
+def get_client():
+    # google.genai takes most of a second to import; searches that never
+    # call the LLM, e.g. through the search server, skip it.
+    global client
+    if client is None:
+        from google import genai
+        client = genai.Client(api_key=api_key)
+    return client
 
 
 def request(text):    
-    response = client.models.generate_content(model='gemini-2.5-flash', contents=text)
+    response = get_client().models.generate_content(model='gemini-2.5-flash', contents=text)
     result = { 
         "response_text"   : response.text,
         "prompt_tokens"   : response.usage_metadata.prompt_token_count,
@@ -19,12 +28,13 @@ def request(text):
 
 
 def request_with_image(prompt, image, mime, query):    
+    from google import genai
     parts = [
         prompt,
         genai.types.Part.from_bytes(data=image, mime_type=mime),
         query
     ]
 
-    response = client.models.generate_content(model='gemini-2.5-flash', contents=parts)
+    response = get_client().models.generate_content(model='gemini-2.5-flash', contents=parts)
     
     return response
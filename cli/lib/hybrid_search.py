@@ -1,98 +1,215 @@
 import os
 import time
 import json
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import lib.gemini as gemini
+import lib.model_registry as MR
+import lib.semantic_search as SS
 from .keyword_search import KeywordSearch
 from .chunked_semantic_search import ChunkedSemanticSearch
 from .repeat_decorator import repeat_decorator
+from .document_store import document_map
+from .result_cache import ResultCache, cached_search, cached_search_many
+from .embedding_store import top_k
+from .reranker import shared_reranker
+
+CANDIDATE_DEPTH = None  # results taken from each leg before fusion, None takes limit * the search's factor
+WEIGHTED_DEPTH_FACTOR = 500
+RRF_DEPTH_FACTOR = 100
+LEG_WORKERS = 8         # threads shared by every HybridSearch to run its legs
+LEG_TIMEOUT_S = None    # seconds a leg may take before fusion goes on without it, None waits
+
+leg_pool = None         # ThreadPoolExecutor created on first concurrent search
+leg_pool_lock = threading.Lock()
 
 
 class HybridSearch:
-    def __init__(self, documents):
+    def __init__(self, documents, ann=False, precision="float32", quantized=False):
         self.documents = documents
-        self.documents_map = {d['id']:d for d in documents}
+        self.documents_map = document_map(documents)
         self.css = ChunkedSemanticSearch()
+        self.css.precision = precision
+        self.css.quantized = quantized
         self.css.load_or_create_chunk_embeddings(documents)
+        if ann: self.css.load_or_create_ann_index()
         self.ks = KeywordSearch()
         self.ks.load_or_create()
+        self.result_cache = ResultCache()   # fused results, None disables
+        self.candidate_depth = CANDIDATE_DEPTH
+        self.doc_ids = np.array([d["id"] for d in documents], dtype=np.int64)    # position -> document id
+        self.concurrent = True              # run the legs on the shared pool
+        self.leg_timeout_s = LEG_TIMEOUT_S
+        self.leg_timeouts = {"semantic": 0, "keyword": 0}   # searches each leg was left out of
+
+    def warm_up(self, cross_encoder=False):
+        # Loads the models a search needs before the first query does.
+        self.css.warm_up()
+        if cross_encoder: MR.cross_encoder(quantized=self.css.quantized)
+
+    def index_version(self):
+        return (self.css.chunk_search_version(), self.ks.index_version(), self.candidate_depth)
 
     def _bm25_search(self, query, limit):
         self.idx.load()
         return self.idx.bm25_search(query, limit)
 
-    def weighted_search(self, query, alpha, limit=5):
-        ss_result = self.css.search_chunks(query, limit * 500)
-        ks_result = self.ks.bm25_search(query, limit * 500)
-        ss_scores = normalize([s['score'] for s in ss_result])
-        ks_scores = normalize([s['score'] for s in ks_result])
-        
-        scores = {}
-        for i in range(len(ss_result)): 
-            s = ss_result[i]
-            scores[s["id"]] = { 
-                "title": s["title"], 
-                "description": s["document"],
-                "document": self.documents_map[s['id']],
-                "semantic_score": ss_scores[i],
-                "keyword_score": 0
+    def __candidates(self, query, limit, depth_factor):
+        # [(semantic, keyword)] (document ids, scores) of each leg, best
+        # first, candidate_depth (else limit * depth_factor) deep, the depth
+        # asked for and the legs that timed out, which come back empty.
+        depth = self.__depth(limit, depth_factor)
+        legs, missing = self.__run_legs({
+            "semantic" : lambda: [self.__semantic_ids(*self.css.movie_top_k(query, depth))],
+            "keyword"  : lambda: [self.ks.bm25_top_k(query, depth)],
+        })
+        return per_query(legs, 1), depth, missing
+
+    def __candidates_many(self, queries, limit, depth_factor):
+        # __candidates of each query, each leg handling the whole batch at once.
+        depth = self.__depth(limit, depth_factor)
+        legs, missing = self.__run_legs({
+            "semantic" : lambda: [self.__semantic_ids(*leg) for leg in self.css.movie_top_k_many(queries, depth)],
+            "keyword"  : lambda: self.ks.bm25_top_k_many(queries, depth),
+        })
+        return per_query(legs, len(queries)), depth, missing
+
+    def __depth(self, limit, depth_factor):
+        if self.candidate_depth is None: return limit * depth_factor
+        return max(self.candidate_depth, limit)
+
+    def __semantic_ids(self, positions, scores):
+        return self.doc_ids[positions], scores
+
+    def __run_legs(self, legs):
+        # Query encoding and the numpy scans release the GIL, so the legs
+        # overlap on the shared pool. A leg still running leg_timeout_s after
+        # submission is left out (its thread finishes in the background);
+        # errors propagate.
+        if not self.concurrent: return {name: leg() for name, leg in legs.items()}, []
+        deadline = time.monotonic() + self.leg_timeout_s if self.leg_timeout_s is not None else None
+        futures = {name: leg_executor().submit(leg) for name, leg in legs.items()}
+        results, missing = {}, []
+        for name, future in futures.items():
+            timeout = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            try:
+                results[name] = future.result(timeout)
+            except FutureTimeoutError:
+                missing.append(name)
+                self.leg_timeouts[name] += 1
+        if not results: raise TimeoutError(f"Every hybrid search leg timed out after {self.leg_timeout_s}s")
+        return results, missing
+
+    def __results(self, ids, fused, semantic, keyword, limit, score_name):
+        # Result dicts, keyed by document id, of the limit best fused scores only.
+        result = {}
+        for i in top_k(fused, limit).tolist():     # ties keep first appearance
+            doc_id = int(ids[i])
+            document = self.documents_map.get(doc_id)
+            if document is None: document = self.ks.docmap[doc_id]     # indexed but not in self.documents
+            result[doc_id] = {
+                "title"          : document["title"],
+                "description"    : document["description"][:100],
+                "document"       : document,
+                "semantic_score" : float(semantic[i]),
+                "keyword_score"  : float(keyword[i]),
+                score_name       : float(fused[i]),
             }
-        for i in range(len(ks_result)):
-            s = ks_result[i]
-            if s["id"] not in scores: 
-                scores[s["id"]] = { 
-                    "title": s["title"],
-                    "description": s["document"], 
-                    "document": self.documents_map[s['id']],
-                    "semantic_score": 0
-                }
-            scores[s["id"]]["keyword_score"] = ks_scores[i]   
-
-        for id in list(scores):
-            sss = scores[id].get("semantic_score", 0)
-            kss = scores[id].get("keyword_score", 0)
-            scores[id]["hybrid_score"] = hybrid_score(kss, sss, alpha)
-
-        result = sorted(scores.items(), reverse=True, key=lambda e: e[1]["hybrid_score"])
-        result = list(result)[:limit]
-        return dict(result)
+        return result
 
+    @cached_search(index_version)
+    def weighted_search(self, query, alpha, limit=5):
+        candidates, depth, missing = self.__candidates(query, limit, WEIGHTED_DEPTH_FACTOR)
+        return partial_result(self.__weighted(*candidates[0], depth, alpha, limit), missing)
+
+    @cached_search_many(index_version, "weighted_search")
+    def weighted_search_many(self, queries, alpha, limit=5):
+        # weighted_search of each query; each leg encodes, scans and scores
+        # the whole batch at once.
+        candidates, depth, missing = self.__candidates_many(queries, limit, WEIGHTED_DEPTH_FACTOR)
+        return [partial_result(self.__weighted(semantic, keyword, depth, alpha, limit), missing)
+                for semantic, keyword in candidates]
+
+    def __weighted(self, semantic, keyword, depth, alpha, limit):
+        # alpha * min-max normalized BM25 + (1 - alpha) * normalized semantic
+        # score; a document missing from a leg scores 0 there.
+        # Fewer BM25 hits than asked for means every other document scores 0,
+        # which is then the minimum.
+        keyword_low = 0.0 if len(keyword[0]) < depth else None
+        ids, (semantic_scores, keyword_scores) = fuse_candidates(
+            [(semantic[0], normalize_scores(semantic[1])), (keyword[0], normalize_scores(keyword[1], keyword_low))])
+        fused = alpha * keyword_scores + (1 - alpha) * semantic_scores
+        return self.__results(ids, fused, semantic_scores, keyword_scores, limit, "hybrid_score")
+
+    @cached_search(index_version)
     def rrf_search(self, query, k=60, limit=5):
-        ss_result = self.css.search_chunks(query, limit * 100)
-        ks_result = self.ks.bm25_search(query, limit * 100)
-        ss_scores = [rrf_score(i,k) for i in range(len(ss_result))]
-        ks_scores = [rrf_score(i,k) for i in range(len(ks_result))]
-
-        scores = {}
-        for i in range(len(ss_result)): 
-            s = ss_result[i]
-            scores[s["id"]] = { 
-                "title": s["title"], 
-                "description": s["document"],
-                "document": self.documents_map[s['id']],
-                "semantic_score": ss_scores[i],
-                "keyword_score": 0
-            }
-
-        for i in range(len(ks_result)):
-            s = ks_result[i]
-            if s["id"] not in scores: 
-                scores[s["id"]] = { 
-                    "title": s["title"],
-                    "description": s["document"], 
-                    "document": self.documents_map[s['id']],
-                    "semantic_score": 0
-                }
-            scores[s["id"]]["keyword_score"] = ks_scores[i]   
-
-        for id in list(scores):
-            sss = scores[id].get("semantic_score", 0)
-            kss = scores[id].get("keyword_score", 0)
-            scores[id]["rrf_score"] = kss + sss
-
-        result = sorted(scores.items(), reverse=True, key=lambda e: e[1]["rrf_score"])
-        result = list(result)[:limit]
-        return dict(result)
-
+        candidates, _, missing = self.__candidates(query, limit, RRF_DEPTH_FACTOR)
+        return partial_result(self.__rrf(*candidates[0], k, limit), missing)
+
+    @cached_search_many(index_version, "rrf_search")
+    def rrf_search_many(self, queries, k=60, limit=5):
+        # rrf_search of each query; each leg encodes, scans and scores the
+        # whole batch at once.
+        candidates, _, missing = self.__candidates_many(queries, limit, RRF_DEPTH_FACTOR)
+        return [partial_result(self.__rrf(semantic, keyword, k, limit), missing) for semantic, keyword in candidates]
+
+    def __rrf(self, semantic, keyword, k, limit):
+        # Sum over legs of 1 / (k + rank), rank counted from 0.
+        ids, (semantic_scores, keyword_scores) = fuse_candidates(
+            [(semantic[0], rrf_scores(len(semantic[0]), k)), (keyword[0], rrf_scores(len(keyword[0]), k))])
+        return self.__results(ids, semantic_scores + keyword_scores, semantic_scores, keyword_scores, limit, "rrf_score")
+
+    def rerank(self, result, query, method, limit=5, top_n=None):
+        # Reorders a search result by LLM ratings (individual, batch) or the
+        # cross-encoder, which reranks only the top_n leading entries.
+        if method == "individual": return llm_rerank(result, query, limit)
+        if method == "batch": return llm_batch_rerank(result, query, limit)
+        if method == "cross_encoder": return SS.cross_encoder_rerank(result, query, self.css.quantized, top_n)
+        raise ValueError(f"Unknown rerank method '{method}'")
+
+    def answer(self, mode, query, limit=5):
+        # (rrf_search result, LLM response) for a RAG_MODES mode.
+        generate = RAG_MODES.get(mode)
+        if generate is None: raise ValueError(f"Unknown RAG mode '{mode}'")
+        result = self.rrf_search(query, limit=limit)
+        return result, generate(query, result)
+
+    def stats(self):
+        query_cache = self.css.query_cache
+        return {
+            "result_cache" : self.result_cache.stats() if self.result_cache is not None else None,
+            "query_cache"  : query_cache.stats() if query_cache is not None else None,
+            "leg_timeouts" : dict(self.leg_timeouts),
+            "reranker"     : shared_reranker(self.css.quantized).stats(),
+            "models"       : [list(m) for m in MR.loaded_models()],
+        }
+
+
+class PartialResult(dict):
+    # Fused result of the legs that answered in time; the search cache
+    # does not keep it.
+    partial = True
+
+    def __init__(self, result, missing_legs):
+        super().__init__(result)
+        self.missing_legs = missing_legs
+
+
+def per_query(legs, n_queries):
+    # [(semantic, keyword)] per query from per-leg lists; a missing leg is empty.
+    empty = [(np.empty(0, dtype=np.int64), np.empty(0))] * n_queries
+    return list(zip(legs.get("semantic", empty), legs.get("keyword", empty)))
+
+def partial_result(result, missing_legs):
+    return PartialResult(result, missing_legs) if missing_legs else result
+
+def leg_executor():
+    # One pool for the whole process, so searches do not pay for thread start-up.
+    global leg_pool
+    with leg_pool_lock:
+        if leg_pool is None: leg_pool = ThreadPoolExecutor(LEG_WORKERS, thread_name_prefix="hybrid-leg")
+    return leg_pool
 
 LLM_REQUEST_REPEATS = 3
 LLM_REQUEST_PAUSE = 2
@@ -343,12 +460,48 @@ def llm_batch_rerank(result, query, limit):
     return result
 
 
+RAG_MODES = {
+    "rag"       : llm_rag,
+    "summarize" : llm_summarize,
+    "citations" : llm_citations,
+    "question"  : llm_question,
+}
+
 def rrf_score(rank, k=60):
     return 1 / (k + rank)
 
 def hybrid_score(bm25_score, semantic_score, alpha=0.5):
     return alpha * bm25_score + (1 - alpha) * semantic_score
 
+def rrf_scores(n, k=60):
+    return 1 / (k + np.arange(n, dtype=np.float64))
+
+def normalize_scores(scores, low=None):
+    # Vectorized normalize(); low, when given, also counts as a score.
+    scores = np.asarray(scores, dtype=np.float64)
+    if not len(scores): return scores
+    low = scores.min() if low is None else min(low, scores.min())
+    high = scores.max()
+    if high == low: return np.ones(len(scores))
+    return (scores - low) / (high - low)
+
+def fuse_candidates(legs):
+    # legs: (document ids, scores) per retriever. Returns the union of their
+    # ids, in order of first appearance across legs, and per leg its scores
+    # aligned to that union, 0 where a leg did not return the document.
+    all_ids = np.concatenate([ids for ids, _ in legs]) if legs else np.empty(0, dtype=np.int64)
+    unique, first, inverse = np.unique(all_ids, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    aligned, start = [], 0
+    for ids, scores in legs:
+        leg = np.zeros(len(unique), dtype=np.float64)
+        leg[rank[inverse[start:start + len(ids)]]] = scores
+        aligned.append(leg)
+        start += len(ids)
+    return unique[order], aligned
+
 def normalize(value_list):
     _min = min(value_list)
     _max = max(value_list)
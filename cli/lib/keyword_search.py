@@ -1,20 +1,57 @@
 
-import os
-import json
-import string
+import re
 import math
-import pickle 
-from collections import defaultdict, Counter
-from nltk.stem import PorterStemmer
+import heapq
+import itertools
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from collections import Counter, OrderedDict
+from .analyzer import Analyzer
+from .document_store import load_documents
+from .compact_index import CompactIndex, DocumentMap, convert_pickle_cache
+from .segmented_index import SegmentedIndex
+from .result_cache import ResultCache, cached_search, cached_search_many, fold_query
+from .embedding_store import top_k
 
 BM25_K1 = 1.5
 BM25_B = 0.75
+WAND_BLOCK_SIZE = 64    # postings per block-max bound
+WAND_SLACK = 1e-9       # relative slack so float rounding never prunes a true top-k document
+TERM_CACHE_SIZE = 4096  # terms whose decoded postings, impacts and block maxima are kept in memory
+BUILD_SHARDS_PER_WORKER = 4
+PHRASE_PATTERN = re.compile(r'"([^"]+)"')   # quoted phrases in queries
+PROXIMITY_WINDOW = 5    # max word distance counted as a term pair occurrence
+PROXIMITY_DEPTH = 10    # proximity reranks the top limit * PROXIMITY_DEPTH BM25 hits
+
+
+class TermCache:
+    # Bounded LRU of values derived from one term's postings.
+
+    def __init__(self, max_entries=TERM_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, term):
+        with self.__lock:
+            value = self.entries.get(term)
+            if value is not None: self.entries.move_to_end(term)
+            return value
+
+    def put(self, term, value):
+        with self.__lock:
+            self.entries[term] = value
+            self.entries.move_to_end(term)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
 
 
 class KeywordSearch:
 
     def __init__(self):
-        self.__index_cache_file  = "cache/index.pkl"
+        self.__index_dir = "cache/keyword_index"
+        # Legacy pickle cache, converted to the compact format on first load.
         self.__docmap_cache_file = "cache/docmap.pkl"
         self.__term_frequencies_cache_file = "cache/term_frequencies.pkl"
         self.__doc_lengths_cache_file = "cache/doc_lengths.pkl"
@@ -22,70 +59,260 @@ class KeywordSearch:
         self.__movies_json_file  = "data/movies.json"
         self.__stopwords_file    = "data/stopwords.txt"
 
-        self.__stopwords = self.__load_stopwords()
-        self.__movies = self.__load_movies()
+        self.analyzer = Analyzer(self.__stopwords_file)
         
-        self.index = defaultdict(set)   # tokens -> document IDs
-        self.docmap = {}  # document IDs -> documents
-        self.term_frequencies = {}  # document IDs -> Counter
-        self.doc_lengths = {}
-
-    def __load_stopwords(self): 
-        with open(self.__stopwords_file) as f: 
-            return f.read().split()
+        self.index = SegmentedIndex()   # tokens -> postings, documents
+        self.docmap = DocumentMap(self.index)  # document IDs -> documents
+        self.scored_documents = 0   # documents fully scored by the last bm25_search
+        self.background_merge = False   # run segment merges on a background thread
+        self.result_cache = ResultCache()   # bm25_search results, None disables
+        self.__prepare_scoring()
 
     def __load_movies(self):
-        with open(self.__movies_json_file) as f: 
-            return json.load(f)["movies"] # [ { "id":number, "title":string, "description":string },..]
+        return load_documents(self.__movies_json_file) # [ { "id":number, "title":string, "description":string },..]
 
     def __tokenize(self, text):
-        stemmer = PorterStemmer()
-        translation = str.maketrans("", "", string.punctuation)
-        translated = text.lower().translate(translation)
-        words = translated.split()
-        words = [w for w in words if w] 
-        result = [stemmer.stem(w) for w in words if w not in self.__stopwords]
-        result.sort()
-        return result
-
-    def __add_document(self, doc_id, text):
-        tokens = self.__tokenize(text)
-        tokens.sort()
-
-        if doc_id not in self.term_frequencies:
-            self.term_frequencies[doc_id] = Counter()
-        for t in set(tokens):
-            self.index[t].add(doc_id)
-        
-        self.term_frequencies[doc_id].update(tokens)
-        self.doc_lengths[doc_id] = len(tokens)
-        
-    def __get_avg_doc_length(self):
-        if len(self.doc_lengths) == 0: 
-            return 0.0
-        else:
-            return sum(self.doc_lengths.values()) / len(self.doc_lengths)
+        return self.analyzer.tokenize(text)
+
+    def __prepare_scoring(self):
+        # Per-query caches over the (possibly memory-mapped) index. Documents
+        # are addressed by ordinal (docmap order) so postings are sorted arrays.
+        self.__index_version = self.index.version
+        self.__postings_cache = TermCache()
+        self.__impacts_cache = TermCache()
+        self.__wand_cache = TermCache()
+        self.__bm25_idf_cache = TermCache()
+
+    def __sync_index(self):
+        # Picks up a finished background merge and drops stale caches.
+        self.index.install_merge()
+        if self.__index_version != self.index.version:
+            self.__prepare_scoring()
+
+    def __postings(self, term):
+        # term -> (document ordinals ascending, term frequencies)
+        postings = self.__postings_cache.get(term)
+        if postings is None:
+            ordinals, tfs = self.index.postings(term)
+            postings = (ordinals.astype(np.int64), tfs.astype(np.float64))
+            self.__postings_cache.put(term, postings)
+        return postings
+
+    def __term_bm25_idf(self, term):
+        idf = self.__bm25_idf_cache.get(term)
+        if idf is None:
+            doc_count = self.index.doc_count
+            term_doc_count = self.index.doc_freq(term)
+            idf = math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+            self.__bm25_idf_cache.put(term, idf)
+        return idf
+
+    def __term_impacts(self, term):
+        # term -> (document ordinals ascending, BM25 contribution per posting)
+        impacts = self.__impacts_cache.get(term)
+        if impacts is None:
+            ordinals, tfs = self.__postings(term)
+            bm25_tf = (tfs * (BM25_K1 + 1)) / (tfs + BM25_K1 * self.__length_norm(ordinals))
+            impacts = (ordinals, bm25_tf * self.__term_bm25_idf(term))
+            self.__impacts_cache.put(term, impacts)
+        return impacts
+
+    def __length_norm(self, ordinals):
+        lengths = self.index.lengths(ordinals).astype(np.float64)
+        avg_doc_length = self.index.avg_doc_length
+        if not avg_doc_length: return lengths
+        return 1 - BM25_B + BM25_B * (lengths / avg_doc_length)
+
+    def __wand_postings(self, term):
+        # term -> (ordinals, impacts, last ordinal per block, max impact per block, max impact)
+        # The ordinals and impacts are the arrays of __term_impacts, not copies.
+        postings = self.__wand_cache.get(term)
+        if postings is None:
+            ordinals, impacts = self.__term_impacts(term)
+            starts = np.arange(0, len(ordinals), WAND_BLOCK_SIZE)
+            block_last = ordinals[np.minimum(starts + WAND_BLOCK_SIZE, len(ordinals)) - 1]
+            block_max = np.maximum.reduceat(impacts, starts) if len(starts) else np.empty(0)
+            postings = (ordinals, impacts, block_last, block_max, float(block_max.max(initial=0.0)))
+            self.__wand_cache.put(term, postings)
+        return postings
+
+    def __bm25_scores(self, tokens):
+        # Term-at-a-time accumulation over the query terms' postings only.
+        # Tokens are added in query order so sums match per-document scoring.
+        scores = np.zeros(self.index.ordinal_count, dtype=np.float64)
+        touched = []
+        for t in tokens:
+            ordinals, impacts = self.__term_impacts(t)
+            if len(ordinals) == 0: continue
+            scores[ordinals] += impacts
+            touched.append(ordinals)
+        candidates = np.unique(np.concatenate(touched)) if touched else np.empty(0, dtype=np.int64)
+        return scores, candidates
+
+    def __top_k(self, scores, candidates, limit, pad=True):
+        ranked = zip(scores[candidates].tolist(), candidates.tolist())
+        top = [o for _, o in heapq.nlargest(limit, ranked, key=lambda e: (e[0], -e[1]))]
+        return self.__pad_top_k(top, limit) if pad else top
+
+    def __pad_top_k(self, top, limit):
+        # Documents without any query term score 0 and follow in docmap order.
+        # Fewer than limit hits means every matching document is already in top.
+        if len(top) < limit:
+            matched = set(top)
+            for o in self.index.live_ordinals():
+                if len(top) >= limit: break
+                if o not in matched: top.append(o)
+        return top
+
+    def __wand_top_k(self, tokens, limit):
+        # Document-at-a-time Block-Max WAND. A cursor per distinct query term
+        # walks its postings; documents whose summed max-score (then block-max)
+        # upper bound cannot beat the current k-th score are skipped unscored.
+        # Surviving documents are scored in query token order, so their scores
+        # are bit-identical to __bm25_scores.
+        weights = Counter(tokens)
+        cursors = {}    # term -> [position, ordinals, impacts, block_last, block_max, upper bound, ordinal at position]
+        for t, w in weights.items():
+            ordinals, impacts, block_last, block_max, max_impact = self.__wand_postings(t)
+            if len(ordinals): cursors[t] = [0, ordinals, impacts, block_last, block_max, w * max_impact, int(ordinals[0])]
+
+        def seek(c, position):
+            c[0] = position
+            c[6] = int(c[1][position]) if position < len(c[1]) else None
+
+        heap = []   # (score, -ordinal), smallest first
+        scored = 0
+        def may_enter(bound):
+            return len(heap) < limit or bound * (1 + WAND_SLACK) > heap[0][0]
+
+        while True:
+            live = sorted((c[6], t) for t, c in cursors.items() if c[6] is not None)
+            if not live: break
+
+            bound = 0.0
+            pivot = None
+            for i, (o, t) in enumerate(live):
+                bound += cursors[t][5]
+                if may_enter(bound):
+                    pivot = i
+                    break
+            if pivot is None: break
+            pivot_doc = live[pivot][0]
+
+            if live[0][0] != pivot_doc:
+                # No document before pivot_doc can reach the threshold.
+                for o, t in live[:pivot]:
+                    c = cursors[t]
+                    seek(c, c[0] + int(c[1][c[0]:].searchsorted(pivot_doc)))
+                continue
+
+            group = [t for o, t in live if o == pivot_doc]
+            block_bound = 0.0
+            for t in group:
+                c = cursors[t]
+                block_bound += weights[t] * float(c[4][c[0] // WAND_BLOCK_SIZE])
+            if not may_enter(block_bound):
+                # Skip past the shortest current block of the group, but not
+                # beyond the next document of any other term.
+                target = min(int(cursors[t][3][cursors[t][0] // WAND_BLOCK_SIZE]) for t in group) + 1
+                if len(group) < len(live): target = min(target, live[len(group)][0])
+                target = max(target, pivot_doc + 1)
+                for t in group:
+                    c = cursors[t]
+                    seek(c, c[0] + int(c[1][c[0]:].searchsorted(target)))
+                continue
+
+            score = 0.0
+            for t in tokens:
+                c = cursors.get(t)
+                if c and c[6] == pivot_doc: score += float(c[2][c[0]])
+            scored += 1
+            entry = (score, -pivot_doc)
+            if len(heap) < limit: heapq.heappush(heap, entry)
+            elif entry > heap[0]: heapq.heapreplace(heap, entry)
+            for t in group: seek(cursors[t], cursors[t][0] + 1)
+
+        self.scored_documents = scored
+        ranked = sorted(heap, reverse=True)
+        top = self.__pad_top_k([-o for _, o in ranked], limit)
+        return top, {-o: s for s, o in ranked}
+
+    def __require_positions(self):
+        if not self.index.has_positions:
+            raise ValueError("Index has no token positions. Rebuild it with positions enabled.")
 
+    def __phrase_ordinals(self, phrase):
+        # Ordinals of documents containing phrase: postings of its terms are
+        # intersected (rarest first), then the candidates' position lists.
+        # Returns None for phrases made only of stopwords.
+        tokens, offsets = self.analyzer.tokenize_with_positions(phrase)
+        if not tokens: return None
+        candidates = None
+        for t in sorted(set(tokens), key=lambda t: len(self.__postings(t)[0])):
+            ordinals = self.__postings(t)[0]
+            candidates = ordinals if candidates is None else np.intersect1d(candidates, ordinals, assume_unique=True)
+            if not len(candidates): break
+
+        matches = []
+        for o in candidates.tolist():
+            starts = None
+            for t, offset in zip(tokens, offsets):
+                p = self.index.term_positions(t, o) - (offset - offsets[0])
+                starts = p if starts is None else np.intersect1d(starts, p, assume_unique=True)
+                if not len(starts): break
+            if len(starts): matches.append(o)
+        return np.array(matches, dtype=np.int64)
+
+    def __proximity_boost(self, terms, ordinal):
+        # BM25TP-style term-pair score: each pair of distinct query terms
+        # occurring within PROXIMITY_WINDOW words adds 1/distance^2, saturated
+        # like BM25 tf and weighted by the rarer term's IDF.
+        positions = [(t, self.index.term_positions(t, ordinal)) for t in terms]
+        positions = [(t, p) for t, p in positions if len(p)]
+        if len(positions) < 2: return 0.0
+        k = BM25_K1 * float(self.__length_norm(np.array([ordinal]))[0])
+        boost = 0.0
+        for (ta, pa), (tb, pb) in itertools.combinations(positions, 2):
+            distances = np.abs(pa[:, None] - pb[None, :])
+            distances = distances[(distances > 0) & (distances <= PROXIMITY_WINDOW)]
+            if not len(distances): continue
+            weight = float(np.sum(1.0 / distances.astype(np.float64) ** 2))
+            idf = min(self.__term_bm25_idf(ta), self.__term_bm25_idf(tb))
+            boost += idf * (weight * (BM25_K1 + 1)) / (weight + k)
+        return boost
+
+    def __bm25_result(self, ordinal, score):
+        document = self.index.document(ordinal)
+        return {
+            "id"        : self.index.doc_id(ordinal),
+            "title"     : document['title'],
+            "document"  : document['description'][:100],
+            "score"     : float(score),
+        }
+
+    def __ordinal(self, doc_id):
+        ordinal = self.index.ordinal(int(doc_id))
+        if ordinal < 0: raise ValueError("doc_id not found")
+        return ordinal
 
     def get_documents(self, term):
-        return sorted(list(self.index.get(term, set())))
+        ordinals, _ = self.index.postings(term)
+        return sorted(self.index.ids(ordinals).tolist())
 
 
     def get_tf(self, doc_id, term):
         query = self.__tokenize(term)
         if len(query) != 1: raise ValueError("get_tf expects single token query")
         query = query[0]
-        if int(doc_id) not in self.term_frequencies: raise ValueError("doc_id not found")
-        return self.term_frequencies[int(doc_id)][query]
+        return self.index.term_frequency(query, self.__ordinal(doc_id))
 
     def get_idf(self, term):
         query = self.__tokenize(term)
         if len(query) != 1: raise Exception("get_idf expects single token query")
         query = query[0]
 
-        doc_count = len(self.docmap)
-        term_docs = self.get_documents(query)
-        term_doc_count = len(term_docs)
+        doc_count = self.index.doc_count
+        term_doc_count = self.index.doc_freq(query)
         idf = math.log((doc_count + 1) / (term_doc_count + 1))
         return idf
 
@@ -97,73 +324,233 @@ class KeywordSearch:
     def get_bm25_idf(self, term):
         query = self.__tokenize(term)
         if len(query) != 1: raise Exception("get_bm25_idf expects single token query")
-        query = query[0]
-
-        doc_count = len(self.docmap)
-        term_docs = self.get_documents(query)
-        term_doc_count = len(term_docs)
-        bm25_idf = math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
-        return bm25_idf
+        self.__sync_index()
+        return self.__term_bm25_idf(query[0])
 
     def get_bm25_tf(self, doc_id, term, k1=BM25_K1, b=BM25_B):
         tf = self.get_tf(doc_id, term)
-        length_norm = 1 - b + b * (self.doc_lengths[doc_id] / self.__get_avg_doc_length())
+        doc_length = self.index.doc_length(self.__ordinal(doc_id))
+        length_norm = 1 - b + b * (doc_length / self.index.avg_doc_length)
         bm25_tf = (tf * (k1 + 1)) / (tf + k1 * length_norm)
         return bm25_tf
 
     def bm25(self, doc_id, term):
         return self.get_bm25_tf(doc_id, term) * self.get_bm25_idf(term)
 
-    def bm25_search(self, query, limit=5):
-        tokens = self.__tokenize(query)
-        scores = []
+    def index_version(self):
+        # Changes whenever the loaded index does (build, load, updates, merges).
+        return self.index.version
 
-        for doc_id in self.docmap:
-            score = 0.0
-            for t in tokens:
-                score += self.bm25(doc_id, t)
-            
-            scores.append({
-                "id"        : doc_id,
-                "title"     : self.docmap[doc_id]['title'],
-                "document"  : self.docmap[doc_id]['description'][:100],
-                "score"     : score,
-            })
-            
-        scores.sort(reverse=True, key=lambda s: s["score"])
-        return scores[:limit]
-
-
-    def build(self):
-        for m in self.__movies:
-            document = f"{m['title']} {m['description']}"
-            self.docmap[m["id"]] = m
-            self.__add_document(m["id"], document)
+    @cached_search(index_version, fold_query)
+    def bm25_search(self, query, limit=5, pruned=False, proximity=False):
+        # pruned=True uses Block-Max WAND; results are identical to exhaustive
+        # scoring, but only self.scored_documents documents get scored. It
+        # reduces scored documents, not latency: the cursors advance one
+        # posting at a time in Python, which is slower than the vectorized
+        # exhaustive scoring at this corpus size.
+        # "Quoted phrases" restrict results to documents containing them and
+        # proximity=True reranks by term closeness; both always score
+        # exhaustively. Proximity needs token positions; without them phrase
+        # words are scored as plain terms (see __phrases).
+        self.__sync_index()
+        return self.__bm25_search(self.__tokenize(query), query, limit, pruned, proximity)
+
+    @cached_search_many(index_version, "bm25_search", fold_query)
+    def bm25_search_many(self, queries, limit=5, pruned=False, proximity=False):
+        # bm25_search of each query; see __prepare_batch.
+        batch = self.__prepare_batch(queries, pruned)
+        return [self.__bm25_search(tokens, query, limit, pruned, proximity) for tokens, query in zip(batch, queries)]
+
+    def __prepare_batch(self, queries, pruned):
+        # Tokens of each query. The postings of every distinct term of the
+        # batch are decoded once, in term order, before any query is scored.
+        self.__sync_index()
+        batch = self.analyzer.tokenize_many(queries)
+        for t in sorted(set(itertools.chain.from_iterable(batch))):
+            if pruned: self.__wand_postings(t)
+            else: self.__term_impacts(t)
+        return batch
+
+    def __bm25_search(self, tokens, query, limit, pruned, proximity):
+        self.scored_documents = 0
+        if not self.docmap or limit <= 0: return []
+        phrases = self.__phrases(query)
+        if pruned and not phrases and not proximity:
+            top, scores = self.__wand_top_k(tokens, limit)
+            return [self.__bm25_result(o, scores.get(o, 0.0)) for o in top]
+
+        scores, candidates = self.__bm25_scores(tokens)
+        candidates, filtered = self.__phrase_filter(phrases, candidates)
+        pad = not filtered
+        self.scored_documents = len(candidates)
+        if proximity:
+            self.__require_positions()
+            reranked = np.array(self.__top_k(scores, candidates, limit * PROXIMITY_DEPTH, pad=False), dtype=np.int64)
+            terms = sorted(set(tokens))
+            for o in reranked.tolist():
+                scores[o] += self.__proximity_boost(terms, o)
+            candidates = reranked
+        top = self.__top_k(scores, candidates, limit, pad)
+        return [self.__bm25_result(o, scores[o]) for o in top]
+
+    def bm25_top_k(self, query, limit=5, pruned=False):
+        # (document ids, scores) arrays of the limit best documents matching
+        # the query, best first, ranked like bm25_search but neither padded
+        # with non-matching documents nor decoded into result dicts; for
+        # callers that fuse or rerank rankings. No proximity reranking.
+        # Fusion asks for thousands of candidates, where WAND prunes little
+        # and the vectorized exhaustive scoring is much faster.
+        self.__sync_index()
+        return self.__bm25_top_k(self.__tokenize(query), query, limit, pruned)
+
+    def bm25_top_k_many(self, queries, limit=5, pruned=False):
+        # bm25_top_k of each query.
+        batch = self.__prepare_batch(queries, pruned)
+        return [self.__bm25_top_k(tokens, query, limit, pruned) for tokens, query in zip(batch, queries)]
+
+    def __bm25_top_k(self, tokens, query, limit, pruned):
+        self.scored_documents = 0
+        if not self.docmap or limit <= 0: return np.empty(0, dtype=np.int64), np.empty(0)
+        phrases = self.__phrases(query)
+        if pruned and not phrases:
+            top, scores = self.__wand_top_k(tokens, limit)
+            ordinals = np.array([o for o in top if o in scores], dtype=np.int64)
+            return self.index.ids(ordinals), np.array([scores[o] for o in ordinals.tolist()])
+        scores, candidates = self.__bm25_scores(tokens)
+        candidates, _ = self.__phrase_filter(phrases, candidates)
+        self.scored_documents = len(candidates)
+        ordinals = candidates[top_k(scores[candidates], limit)]
+        return self.index.ids(ordinals), scores[ordinals]
+
+    def __phrases(self, query):
+        # Quoted phrases of query. An index without token positions cannot
+        # match them, so their words only count as ordinary query terms.
+        return PHRASE_PATTERN.findall(query) if self.index.has_positions else []
+
+    def __phrase_filter(self, phrases, candidates):
+        # Candidates containing every phrase, and whether any phrase applied.
+        filtered = False
+        for phrase in phrases:
+            matches = self.__phrase_ordinals(phrase)
+            if matches is None: continue
+            candidates = np.intersect1d(candidates, matches, assume_unique=True)
+            filtered = True
+        return candidates, filtered
+
+    def phrase_search(self, phrase, limit=5):
+        # Documents containing phrase, ranked by BM25 of the phrase terms.
+        # Unlike quoted phrases in bm25_search, needs token positions.
+        self.__sync_index()
+        self.__require_positions()
+        return self.bm25_search(f'"{phrase}"', limit)
+
+
+    def build(self, workers=1, positions=False):
+        # workers > 1 indexes contiguous shards of the corpus in a process pool
+        # and merges them; the merged index is identical to a serial build.
+        # positions=True also stores word positions for phrase and proximity queries.
+        movies = self.__load_movies()
+        if workers > 1 and len(movies) > 1:
+            shard_size = -(-len(movies) // (workers * BUILD_SHARDS_PER_WORKER))
+            shards = [movies[i:i + shard_size] for i in range(0, len(movies), shard_size)]
+            n = len(shards)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parts = list(pool.map(build_shard, [self.__stopwords_file] * n, shards, [None] * n, [positions] * n))
+            index = CompactIndex.merge(parts)
+        else:
+            index = build_shard(self.__stopwords_file, movies, self.analyzer, positions)
+        self.index = SegmentedIndex.from_index(index)
+        self.docmap = DocumentMap(self.index)
+        self.__prepare_scoring()
     
     def save(self):
-        os.makedirs("cache", exist_ok=True)
-        with open(self.__index_cache_file, "wb") as f:
-            pickle.dump(self.index, f)
-        with open(self.__docmap_cache_file, "wb") as f:
-            pickle.dump(self.docmap, f)
-        with open(self.__term_frequencies_cache_file, "wb") as f:
-            pickle.dump(self.term_frequencies, f)
-        with open(self.__doc_lengths_cache_file, "wb") as f:
-            pickle.dump(self.doc_lengths, f)
+        self.index.save(self.__index_dir)
         
     def load(self):
-        with open(self.__index_cache_file, "rb") as f:
-            self.index = pickle.load(f)
-        with open(self.__docmap_cache_file, "rb") as f:
-            self.docmap = pickle.load(f)
-        with open(self.__term_frequencies_cache_file, "rb") as f:
-            self.term_frequencies = pickle.load(f)
-        with open(self.__doc_lengths_cache_file, "rb") as f:
-            self.doc_lengths = pickle.load(f)
-        return self.index and self.docmap and self.term_frequencies and self.doc_lengths
+        # Opens the memory-mapped index; nothing but its metadata is read here.
+        if not SegmentedIndex.exists(self.__index_dir):
+            self.convert_pickle_cache()
+        self.index = SegmentedIndex.open(self.__index_dir)
+        self.docmap = DocumentMap(self.index)
+        self.__prepare_scoring()
+        return self.index.doc_count > 0
+
+    def convert_pickle_cache(self):
+        # Raises FileNotFoundError when there is no legacy cache to convert.
+        return convert_pickle_cache(
+            self.__index_dir,
+            self.__docmap_cache_file,
+            self.__term_frequencies_cache_file,
+            self.__doc_lengths_cache_file)
+
+    def add_document(self, document):
+        # Indexes one movie dict into a new small segment.
+        if self.index.ordinal(document["id"]) >= 0:
+            raise ValueError(f"doc_id {document['id']} already exists, use update_document")
+        self.__add_segment(document)
+
+    def update_document(self, document):
+        if not self.index.delete(document["id"]):
+            raise ValueError("doc_id not found")
+        self.__add_segment(document)
+
+    def __add_segment(self, document):
+        # New segments keep positions if the rest of the index has them.
+        tokens, term_positions = analyze(self.analyzer, [document], self.index.has_positions)
+        self.index.add_documents([document["id"]], [document], [Counter(t) for t in tokens], term_positions)
+        self.__after_update()
+
+    def delete_document(self, doc_id):
+        if not self.index.delete(int(doc_id)):
+            raise ValueError("doc_id not found")
+        self.__after_update()
+
+    def merge_segments(self, force=False, background=None):
+        # force=True merges every segment into one, dropping all tombstones.
+        background = self.background_merge if background is None else background
+        candidates = None
+        if force and (len(self.index.segments) > 1 or self.index.doc_count < self.index.ordinal_count):
+            candidates = list(range(len(self.index.segments)))
+        merged = self.index.merge(candidates, background=background)
+        self.__sync_index()
+        return merged
+
+    def __after_update(self):
+        if self.index.merge_candidates():
+            self.index.merge(background=self.background_merge)
+        self.__sync_index()
 
     def load_or_create(self):
-        if not self.load():
+        try: loaded = self.load()
+        except FileNotFoundError: loaded = False
+        if not loaded:
             self.build()
             self.save()
-            self.load()
\ No newline at end of file
+            self.load()
+
+
+def build_shard(stopwords_file, movies, analyzer=None, positions=False):
+    # Indexes one contiguous slice of the corpus; runs in pool workers.
+    analyzer = analyzer or Analyzer(stopwords_file)
+    tokens, term_positions = analyze(analyzer, movies, positions)
+    return CompactIndex.from_documents(
+        [m["id"] for m in movies],
+        movies,
+        [Counter(t) for t in tokens],
+        term_positions=term_positions)
+
+def analyze(analyzer, movies, positions=False):
+    # -> (tokens per movie, term -> word positions per movie or None)
+    if not positions:
+        return analyzer.tokenize_many(index_text(m) for m in movies), None
+    tokens, term_positions = [], []
+    for m in movies:
+        words, word_positions = analyzer.tokenize_with_positions(index_text(m))
+        grouped = {}
+        for w, p in zip(words, word_positions): grouped.setdefault(w, []).append(p)
+        tokens.append(words)
+        term_positions.append(grouped)
+    return tokens, term_positions
+
+def index_text(movie):
+    return f"{movie['title']} {movie['description']}"
@@ -0,0 +1,77 @@
+import threading
+from contextlib import nullcontext
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-TinyBERT-L2-v2"
+CLIP_MODEL = "clip-ViT-B-32"
+
+shared_models = {}  # (kind, name, quantized) -> model shared by the whole process
+loading_locks = {}  # (kind, name, quantized) -> lock held while the model loads
+registry_lock = threading.Lock()
+inference_settings = {"inference_mode": True}   # run encoders under torch.inference_mode
+
+
+def load_model(kind, name, quantized=False):
+    # sentence_transformers (and torch) are imported on the first load, so
+    # commands that never touch a model do not pay for them.
+    if kind == "sentence_transformer":
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(name, device="cpu" if quantized else None)
+    elif kind == "cross_encoder":
+        from sentence_transformers import CrossEncoder
+        model = CrossEncoder(name, device="cpu" if quantized else None)
+    else: raise ValueError(f"Unknown model kind '{kind}'")
+    return quantize_linear_layers(model) if quantized else model
+
+def quantize_linear_layers(model):
+    # PyTorch dynamic int8 quantization: Linear weights are stored as int8
+    # and activations quantized on the fly, on CPU only. Embeddings drift
+    # slightly; see ChunkedSemanticSearch.quantization_drift.
+    import torch
+    target = model if isinstance(model, torch.nn.Module) else model.model     # older CrossEncoders wrap their module
+    torch.ao.quantization.quantize_dynamic(target, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+def get_model(kind, name, quantized=False):
+    # Loads a model on first use; later calls, from any thread, get the same
+    # instance. Different models load concurrently.
+    key = (kind, name, quantized)
+    model = shared_models.get(key)
+    if model is not None: return model
+    with registry_lock:
+        lock = loading_locks.setdefault(key, threading.Lock())
+    with lock:
+        model = shared_models.get(key)
+        if model is None: model = shared_models[key] = load_model(kind, name, quantized)
+    return model
+
+def sentence_transformer(name=EMBEDDING_MODEL, quantized=False):
+    return get_model("sentence_transformer", name, quantized)
+
+def cross_encoder(name=CROSS_ENCODER_MODEL, quantized=False):
+    return get_model("cross_encoder", name, quantized)
+
+def warm_up(models):
+    # Loads (kind, name[, quantized]) entries ahead of the first request that needs them.
+    for model in models: get_model(*model)
+
+def configure_inference(threads=None, interop_threads=None, inference_mode=None):
+    # Process-wide torch settings for CPU inference; None keeps the current one.
+    if inference_mode is not None: inference_settings["inference_mode"] = inference_mode
+    if not threads and not interop_threads: return
+    import torch
+    if threads: torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            print(f"Inter-op threads can only be set before torch starts parallel work; keeping {torch.get_num_interop_threads()}")
+
+def inference():
+    # Context every encoder call runs in.
+    if not inference_settings["inference_mode"]: return nullcontext()
+    import torch
+    return torch.inference_mode()
+
+def loaded_models():
+    return sorted(shared_models)
@@ -3,44 +3,52 @@ import torch
 import torch.nn.functional as torchF
 import numpy as np
 from PIL import Image
-from sentence_transformers import SentenceTransformer
 import lib.semantic_search as SS
+import lib.model_registry as MR
+from .embedding_store import load_or_quantize, update_embeddings, fingerprints
 
 
 class MultimodalSearch:
 
-    def __init__(self, documents, model_name="clip-ViT-B-32"):
+    def __init__(self, documents, model_name=MR.CLIP_MODEL, precision="float32", quantized=False):
         self.embeddings_cache_file = "cache/multimodal_text_embeddings.npy"
-        self.model = SentenceTransformer(model_name)
+        self.precision = precision      # in-memory precision of text_embeddings, see EmbeddingStore
+        self.rescore = True
+        self.model_name = model_name
+        self.quantized = quantized      # int8 dynamically quantized linear layers (CPU)
         self.documents = documents
         self.texts = [f"{d['title']}: {d['description']}" for d in documents]
         self.texts = self.texts
         self.load_or_build_embeddings()
 
+    @property
+    def model(self):
+        # Loaded on first use: unchanged text embeddings never need it.
+        return MR.sentence_transformer(self.model_name, self.quantized)
+
     def load_or_build_embeddings(self):
-        if os.path.exists(self.embeddings_cache_file):
-            self.text_embeddings = np.load(self.embeddings_cache_file)
-            if len(self.text_embeddings) == len(self.texts): 
-                return self.text_embeddings
-            else: 
-                print(f"Embedding and Texts count mismatch {len(self.text_embeddings)} {len(self.texts)}")
-                print("Rebuilding...")
-                
-        self.text_embeddings = self.model.encode_query(self.texts, show_progress_bar=True)
-        np.save(self.embeddings_cache_file, self.text_embeddings)
-        print("Rebuilt.")
+        # Only texts without a row for their fingerprint are encoded.
+        keys = fingerprints(self.texts, self.model_name)
+        encoded = update_embeddings(self.embeddings_cache_file, keys, self.__encode_texts)
+        if encoded: print(f"Encoded {encoded} new or changed texts")
+        self.text_embeddings = load_or_quantize(self.embeddings_cache_file, self.precision)
+        return self.text_embeddings
+
 
+    def __encode_texts(self, positions):
+        model = self.model
+        with MR.inference():
+            return model.encode_query([self.texts[i] for i in positions], show_progress_bar=True)
 
     def embed_image(self, path):
         image = Image.open(path)
-        embedding = self.model.encode([image])
+        model = self.model
+        with MR.inference():
+            embedding = model.encode([image])
         return embedding[0] 
     
     def search_with_image(self, path):
-        ie = self.embed_image(path)
-        cos_sim = []
-        for i in range(len(self.texts)):
-            cos_sim.append((SS.cosine_similarity(ie, self.text_embeddings[i]), self.documents[i])) 
-        cos_sim.sort(key=lambda e: e[0], reverse=True) 
-        return cos_sim[:5]
+        ie = SS.normalize(self.embed_image(path))
+        ids, scores = self.text_embeddings.search(ie, 5, self.rescore)
+        return [(float(score), self.documents[i]) for i, score in zip(ids, scores)]
         
\ No newline at end of file
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+
+QUERY_CACHE_SIZE = 4096                         # embeddings kept in memory
+QUERY_CACHE_FILE = "cache/query_embeddings.db"  # persistent tier, None keeps embeddings in memory only
+QUERY_CACHE_ROWS = 100_000                      # persistent rows kept; the oldest go first
+
+shared_caches = {}  # absolute path (or None) -> QueryEmbeddingCache shared by the whole process
+
+
+class QueryEmbeddingCache:
+    # Query embeddings keyed by model and whitespace-normalized text: an
+    # in-process LRU in front of an optional SQLite file that outlives the
+    # process. Embeddings come back read-only and as the model returned them.
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, path=QUERY_CACHE_FILE, max_rows=QUERY_CACHE_ROWS):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_rows = max_rows
+        self.entries = OrderedDict()    # (model, text) -> embedding
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__db = None
+        if path is not None: self.__open(path)
+
+    def __open(self, path):
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                          "(model TEXT, text TEXT, dtype TEXT, vector BLOB, PRIMARY KEY (model, text))")
+        (rows,) = self.__db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if rows > self.max_rows:
+            self.__db.execute("DELETE FROM embeddings WHERE rowid IN "
+                              "(SELECT rowid FROM embeddings ORDER BY rowid LIMIT ?)", (rows - self.max_rows,))
+
+    def get(self, model, text):
+        key = (model, normalize_text(text))
+        with self.__lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+            if self.__db is not None:
+                row = self.__db.execute("SELECT dtype, vector FROM embeddings WHERE model = ? AND text = ?", key).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[1], dtype=row[0])
+                    self.__remember(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put(self, model, text, embedding):
+        key = (model, normalize_text(text))
+        embedding = np.array(embedding)
+        embedding.setflags(write=False)
+        with self.__lock:
+            self.__remember(key, embedding)
+            if self.__db is not None:
+                self.__db.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                                  key + (embedding.dtype.str, embedding.tobytes()))
+        return embedding
+
+    def __remember(self, key, embedding):
+        if self.max_entries <= 0: return
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.entries.clear()
+            if self.__db is not None: self.__db.execute("DELETE FROM embeddings")
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits"        : self.hits,
+            "disk_hits"   : self.disk_hits,
+            "misses"      : self.misses,
+            "hit_rate"    : (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "size"        : len(self.entries),
+            "max_entries" : self.max_entries,
+            "path"        : self.path,
+        }
+
+
+def shared_query_cache(path=QUERY_CACHE_FILE):
+    # One cache per file per process, so every search component and every
+    # model shares the same LRU and database connection.
+    key = os.path.abspath(path) if path is not None else None
+    cache = shared_caches.get(key)
+    if cache is None: cache = shared_caches[key] = QueryEmbeddingCache(path=path)
+    return cache
+
+def normalize_text(text):
+    # Tokenizers ignore runs of whitespace; case is kept since cased models embed it.
+    return " ".join(text.split())
@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+import lib.model_registry as MR
+from .query_cache import normalize_text
+
+RERANK_BATCH_SIZE = 32          # query/document pairs per cross-encoder forward pass
+RERANK_CACHE_SIZE = 16384       # pair scores kept in memory
+RERANK_TOP_N = None             # leading candidates reranked, None reranks all of them
+
+shared_rerankers = {}   # (model name, quantized) -> CrossEncoderReranker shared by the whole process
+rerankers_lock = threading.Lock()
+
+
+class CrossEncoderReranker:
+    # Reorders search results by cross-encoder score. Scores are cached per
+    # (query, document id) with the pair text they came from, so a document
+    # whose text changed is scored again; only uncached pairs reach the
+    # model, in batches of batch_size.
+
+    def __init__(self, model_name=MR.CROSS_ENCODER_MODEL, quantized=False, batch_size=RERANK_BATCH_SIZE,
+                 top_n=RERANK_TOP_N, max_entries=RERANK_CACHE_SIZE):
+        self.model_name = model_name
+        self.quantized = quantized
+        self.batch_size = batch_size
+        self.top_n = top_n
+        self.max_entries = max_entries
+        self.entries = OrderedDict()    # (query, document id) -> (pair text, score)
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def model(self):
+        return MR.cross_encoder(self.model_name, self.quantized)
+
+    def rerank(self, result, query, top_n=None):
+        # result with its top_n leading entries (self.top_n when None, all
+        # when that is None too) ordered by "cross_encoder_score", ties
+        # keeping their order; the other entries follow unscored.
+        top_n = self.top_n if top_n is None else top_n
+        entries = list(result.items())
+        head, tail = (entries, []) if top_n is None else (entries[:top_n], entries[top_n:])
+        scores = self.scores(query, [doc_id for doc_id, _ in head], [pair_text(entry) for _, entry in head])
+        for (_, entry), score in zip(head, scores): entry["cross_encoder_score"] = score
+        head.sort(reverse=True, key=lambda e: e[1]["cross_encoder_score"])
+        return dict(head + tail)
+
+    def scores(self, query, doc_ids, texts):
+        # Cross-encoder score of query against each text, texts[i] being that of document doc_ids[i].
+        keys = [(normalize_text(query), doc_id) for doc_id in doc_ids]
+        scores = [None] * len(keys)
+        with self.__lock:
+            for i, (key, text) in enumerate(zip(keys, texts)):
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] == text:
+                    self.entries.move_to_end(key)
+                    scores[i] = entry[1]
+            missing = [i for i, score in enumerate(scores) if score is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if not missing: return scores
+        model = self.model
+        with MR.inference():
+            predicted = model.predict([[query, texts[i]] for i in missing], batch_size=self.batch_size)
+        with self.__lock:
+            for i, score in zip(missing, predicted):
+                scores[i] = float(score)
+                self.__remember(keys[i], (texts[i], scores[i]))
+        return scores
+
+    def __remember(self, key, entry):
+        if self.max_entries <= 0: return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits"        : self.hits,
+            "misses"      : self.misses,
+            "hit_rate"    : self.hits / lookups if lookups else 0.0,
+            "size"        : len(self.entries),
+            "max_entries" : self.max_entries,
+            "batch_size"  : self.batch_size,
+        }
+
+
+def shared_reranker(quantized=False, model_name=MR.CROSS_ENCODER_MODEL):
+    # One reranker, and so one score cache, per model per process.
+    key = (model_name, quantized)
+    with rerankers_lock:
+        reranker = shared_rerankers.get(key)
+        if reranker is None: reranker = shared_rerankers[key] = CrossEncoderReranker(model_name, quantized)
+    return reranker
+
+def pair_text(entry):
+    # Document side of a result entry's cross-encoder pair.
+    return f"{entry.get('title', '')} - {entry.get('document', '')}"
@@ -0,0 +1,150 @@
+import os
+import time
+import inspect
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL_S = None   # seconds, None = entries never expire
+
+
+class ResultCache:
+    # Bounded LRU of search results with optional TTL. Every lookup carries
+    # the version of the data the result was computed from; a new version
+    # drops all entries.
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl_s=RESULT_CACHE_TTL_S):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.entries = OrderedDict()    # key -> (expires at, result)
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.__lock = threading.Lock()
+
+    def get(self, version, key):
+        with self.__lock:
+            if version != self.version:
+                if self.entries: self.invalidations += 1
+                self.entries.clear()
+                self.version = version
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None: del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, version, key, result):
+        with self.__lock:
+            if version != self.version or self.max_entries <= 0: return
+            expires = time.monotonic() + self.ttl_s if self.ttl_s else None
+            self.entries[key] = (expires, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.__lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits"          : self.hits,
+            "misses"        : self.misses,
+            "hit_rate"      : self.hits / lookups if lookups else 0.0,
+            "size"          : len(self.entries),
+            "max_entries"   : self.max_entries,
+            "evictions"     : self.evictions,
+            "invalidations" : self.invalidations,
+        }
+
+
+def cached_search(version, normalize=None):
+    # Caches a search method in self.result_cache. The key is the normalized
+    # query plus all other arguments (defaults filled in); version(self)
+    # identifies the index/embeddings state the result depends on.
+    # normalize(query) defaults to normalize_query; searches that ignore
+    # case may pass fold_query.
+    normalize = normalize or normalize_query
+    def cached_search_decorator(function):
+        signature = inspect.signature(function)
+
+        @wraps(function)
+        def decorated(self, *args, **kwargs):
+            cache = getattr(self, "result_cache", None)
+            if cache is None: return function(self, *args, **kwargs)
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            params = list(bound.arguments.items())[1:]
+            query = normalize(params[0][1])
+            key = (function.__name__, query, tuple(params[1:]))
+            v = version(self)
+            result = cache.get(v, key)
+            if result is None:
+                result = function(self, *args, **kwargs)
+                if getattr(result, "partial", False): return result     # degraded, e.g. a leg timed out
+                cache.put(v, key, result)
+            return copy_result(result)
+        return decorated
+    return cached_search_decorator
+
+
+def cached_search_many(version, name, normalize=None):
+    # cached_search for a method taking a list of queries and returning a
+    # result per query. Entries are shared with the single-query method
+    # name, whose other arguments and normalize must match; only queries
+    # missing from the cache are passed on.
+    normalize = normalize or normalize_query
+    def cached_search_many_decorator(function):
+        signature = inspect.signature(function)
+
+        @wraps(function)
+        def decorated(self, queries, *args, **kwargs):
+            cache = getattr(self, "result_cache", None)
+            if cache is None: return function(self, queries, *args, **kwargs)
+            bound = signature.bind(self, queries, *args, **kwargs)
+            bound.apply_defaults()
+            params = tuple(list(bound.arguments.items())[2:])
+            keys = [(name, normalize(query), params) for query in queries]
+            v = version(self)
+            results = [cache.get(v, key) for key in keys]
+            missing = [i for i, result in enumerate(results) if result is None]
+            if missing:
+                computed = function(self, [queries[i] for i in missing], *args, **kwargs)
+                for i, result in zip(missing, computed):
+                    if not getattr(result, "partial", False): cache.put(v, keys[i], result)
+                    results[i] = result
+            return [copy_result(result) for result in results]
+        return decorated
+    return cached_search_many_decorator
+
+
+def normalize_query(query):
+    # Only whitespace: embedding models may be case sensitive.
+    return " ".join(query.split())
+
+def fold_query(query):
+    return normalize_query(query).lower()
+
+def copy_result(result):
+    # Callers annotate result entries (rerank scores, evaluations), so each
+    # caller gets its own entry dicts; documents themselves are shared.
+    if getattr(result, "partial", False): return result    # never cached, so never shared
+    if isinstance(result, dict): return {k: dict(v) for k, v in result.items()}
+    return [dict(r) for r in result]
+
+def file_version(path):
+    # Identifies the on-disk state of a cache file.
+    try:
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return (path, None, None)
@@ -0,0 +1,219 @@
+import os
+import json
+import traceback
+import numpy as np
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .hybrid_search import PartialResult, RAG_MODES
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_ENV = "SEARCH_SERVER"    # URL of a running server the CLIs send their searches to, e.g. http://127.0.0.1:8765
+CLIENT_TIMEOUT_S = 600          # individual LLM reranking of many results is slow
+RERANK_METHODS = ("individual", "batch", "cross_encoder")
+
+
+class SearchServer(ThreadingHTTPServer):
+    # Serves one HybridSearch, with its models, index and embeddings loaded
+    # once, as a JSON API over local HTTP. Each connection gets its own
+    # thread; the searches share the caches.
+    #   POST /weighted_search  {query, alpha, limit}
+    #   POST /rrf_search       {query, k, limit}
+    #   POST /weighted_search_many, /rrf_search_many  as above with queries
+    #   POST /rerank           {result, query, method, limit, top_n}
+    #   POST /answer           {mode, query, limit}
+    #   GET  /stats, /health
+    daemon_threads = True
+
+    def __init__(self, hs, host=SERVER_HOST, port=SERVER_PORT):
+        super().__init__((host, port), SearchRequestHandler)
+        self.hs = hs
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, clients can reuse the connection
+
+    def do_GET(self):
+        self.__respond(GET_ROUTES.get(self.path), None)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            params = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.__send(400, {"error": "Request body is not JSON"})
+        if not isinstance(params, dict): return self.__send(400, {"error": "Request body is not a JSON object"})
+        self.__respond(POST_ROUTES.get(self.path), params)
+
+    def __respond(self, route, params):
+        if route is None: return self.__send(404, {"error": f"Unknown endpoint {self.command} {self.path}"})
+        try:
+            body = route(self.server.hs) if params is None else route(self.server.hs, params)
+        except RequestError as e:
+            return self.__send(400, {"error": str(e)})
+        except TimeoutError as e:
+            return self.__send(504, {"error": str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            return self.__send(500, {"error": f"{type(e).__name__}: {e}"})
+        self.__send(200, body)
+
+    def __send(self, status, body):
+        data = json.dumps(body, default=json_default).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass    # one line per query is noise; errors go through traceback
+
+
+class SearchClient:
+    # Thin client with the HybridSearch methods the CLIs call, answered by a
+    # SearchServer, so a command pays only for its query instead of
+    # loading models and indexes. Index and inference options are the
+    # server's.
+
+    def __init__(self, url, timeout_s=CLIENT_TIMEOUT_S):
+        self.url = url.rstrip("/")
+        self.timeout_s = timeout_s
+
+    def weighted_search(self, query, alpha, limit=5):
+        return decode_result(self.__request("/weighted_search", {"query": query, "alpha": alpha, "limit": limit}))
+
+    def rrf_search(self, query, k=60, limit=5):
+        return decode_result(self.__request("/rrf_search", {"query": query, "k": k, "limit": limit}))
+
+    def weighted_search_many(self, queries, alpha, limit=5):
+        body = self.__request("/weighted_search_many", {"queries": queries, "alpha": alpha, "limit": limit})
+        return [decode_result(result) for result in body["results"]]
+
+    def rrf_search_many(self, queries, k=60, limit=5):
+        body = self.__request("/rrf_search_many", {"queries": queries, "k": k, "limit": limit})
+        return [decode_result(result) for result in body["results"]]
+
+    def rerank(self, result, query, method, limit=5, top_n=None):
+        params = dict(encode_result(result), query=query, method=method, limit=limit, top_n=top_n)
+        return decode_result(self.__request("/rerank", params))
+
+    def answer(self, mode, query, limit=5):
+        body = self.__request("/answer", {"mode": mode, "query": query, "limit": limit})
+        return decode_result(body), body["response"]
+
+    def stats(self):
+        return self.__request("/stats")
+
+    def health(self):
+        return self.__request("/health")
+
+    def __request(self, path, params=None):
+        data = json.dumps(params, default=json_default).encode() if params is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            message = json.load(e).get("error", e.reason)
+            if e.code == 400: raise ValueError(message) from None
+            if e.code == 504: raise TimeoutError(message) from None
+            raise RuntimeError(f"Search server error {e.code}: {message}") from None
+
+
+class RequestError(ValueError):
+    # A missing or ill-typed request field, answered with 400; any other
+    # exception is a server error.
+    pass
+
+REQUIRED = object()
+
+def field(params, name, types, default=REQUIRED):
+    if name not in params:
+        if default is REQUIRED: raise RequestError(f"Missing field '{name}'")
+        return default
+    value = params[name]
+    # bool is an int, but never a valid limit or weight
+    if isinstance(value, bool) or not isinstance(value, types):
+        raise RequestError(f"Field '{name}' has type {type(value).__name__}")
+    return value
+
+def queries_field(params):
+    queries = field(params, "queries", list)
+    if not all(isinstance(query, str) for query in queries): raise RequestError("Field 'queries' must be a list of strings")
+    return queries
+
+def choice_field(params, name, choices):
+    value = field(params, name, str)
+    if value not in choices: raise RequestError(f"Field '{name}' must be one of {', '.join(choices)}")
+    return value
+
+def result_field(params):
+    result = field(params, "result", list)
+    for pair in result:
+        if not (isinstance(pair, list) and len(pair) == 2 and isinstance(pair[1], dict)) or isinstance(pair[0], bool) or not isinstance(pair[0], int):
+            raise RequestError("Field 'result' must be a list of [id, entry] pairs")
+    field(params, "missing_legs", list, [])
+    return decode_result(params)
+
+def health(hs):
+    return {"status": "ok"}
+
+def stats(hs):
+    return hs.stats()
+
+def weighted_search(hs, params):
+    return encode_result(hs.weighted_search(field(params, "query", str), field(params, "alpha", (int, float), 0.5), field(params, "limit", int, 5)))
+
+def rrf_search(hs, params):
+    return encode_result(hs.rrf_search(field(params, "query", str), field(params, "k", int, 60), field(params, "limit", int, 5)))
+
+def weighted_search_many(hs, params):
+    results = hs.weighted_search_many(queries_field(params), field(params, "alpha", (int, float), 0.5), field(params, "limit", int, 5))
+    return {"results": [encode_result(result) for result in results]}
+
+def rrf_search_many(hs, params):
+    results = hs.rrf_search_many(queries_field(params), field(params, "k", int, 60), field(params, "limit", int, 5))
+    return {"results": [encode_result(result) for result in results]}
+
+def rerank(hs, params):
+    result = hs.rerank(result_field(params), field(params, "query", str), choice_field(params, "method", RERANK_METHODS),
+                       field(params, "limit", int, 5), field(params, "top_n", (int, type(None)), None))
+    return encode_result(result)
+
+def answer(hs, params):
+    result, response = hs.answer(choice_field(params, "mode", tuple(RAG_MODES)), field(params, "query", str), field(params, "limit", int, 5))
+    return dict(encode_result(result), response=response)
+
+GET_ROUTES = {"/health": health, "/stats": stats}
+POST_ROUTES = {"/weighted_search": weighted_search, "/rrf_search": rrf_search,
+               "/weighted_search_many": weighted_search_many, "/rrf_search_many": rrf_search_many,
+               "/rerank": rerank, "/answer": answer}
+
+def encode_result(result):
+    # JSON object keys would turn document ids into strings, so results
+    # travel as [id, entry] pairs, best first.
+    return {"result": [[doc_id, entry] for doc_id, entry in result.items()],
+            "missing_legs": getattr(result, "missing_legs", [])}
+
+def decode_result(body):
+    result = {int(doc_id): entry for doc_id, entry in body["result"]}
+    missing_legs = body.get("missing_legs")
+    return PartialResult(result, missing_legs) if missing_legs else result
+
+def json_default(value):
+    # numpy scores, e.g. cross-encoder outputs.
+    if isinstance(value, np.generic): return value.item()
+    if isinstance(value, np.ndarray): return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def connect(url=None):
+    # SearchClient for url, else for $SEARCH_SERVER; None when neither is set.
+    url = url or os.environ.get(SERVER_ENV)
+    return SearchClient(url) if url else None
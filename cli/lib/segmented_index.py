@@ -0,0 +1,288 @@
+import os
+import json
+import shutil
+import threading
+import itertools
+import numpy as np
+from .compact_index import CompactIndex
+
+MANIFEST_VERSION = 1
+MAX_SEGMENTS = 8            # more segments than this merges all but the largest
+MAX_DELETED_RATIO = 0.2     # segments with more tombstones than this get compacted
+
+generations = itertools.count(1)    # index versions, never reused by any SegmentedIndex of the process
+generations_lock = threading.Lock()
+
+
+class Segment:
+
+    def __init__(self, name, index, deleted=()):
+        self.name = name
+        self.index = index
+        self.deleted = np.array(sorted(deleted), dtype=np.int64)    # tombstoned local ordinals
+
+    @property
+    def live_count(self):
+        return self.index.doc_count - len(self.deleted)
+
+    @property
+    def live_length(self):
+        return self.index.total_length - int(np.sum(self.index.doc_lengths[self.deleted], dtype=np.int64))
+
+    def is_deleted(self, ordinal):
+        j = int(np.searchsorted(self.deleted, ordinal))
+        return j < len(self.deleted) and self.deleted[j] == ordinal
+
+    def delete(self, ordinal):
+        self.deleted = np.insert(self.deleted, np.searchsorted(self.deleted, ordinal), ordinal)
+
+    def live_postings(self, term):
+        ordinals, tfs = self.index.postings(term)
+        if len(self.deleted) and len(ordinals):
+            live = ~np.isin(ordinals, self.deleted)
+            ordinals, tfs = ordinals[live], tfs[live]
+        return ordinals, tfs
+
+
+class SegmentedIndex:
+    # A list of immutable CompactIndex segments plus per-segment tombstones.
+    # Ordinals are global: segment i's documents follow segment i-1's. Corpus
+    # statistics (doc_count, avg_doc_length, doc_freq) count live documents
+    # only, so scores equal those of a full rebuild over the live documents.
+    #
+    # On disk a directory holds manifest.json and one sub-directory per
+    # segment. A plain CompactIndex directory opens as a single segment.
+
+    def __init__(self, segments=(), next_segment=0):
+        self.segments = list(segments)
+        self.next_segment = next_segment
+        self.__lock = threading.Lock()
+        self.__merge_thread = None
+        self.__pending_merge = None
+        self.__refresh()
+
+    def __refresh(self):
+        self.bases = np.cumsum([0] + [s.index.doc_count for s in self.segments])
+        self.ordinal_count = int(self.bases[-1])
+        self.doc_count = sum(s.live_count for s in self.segments)
+        self.total_length = sum(s.live_length for s in self.segments)
+        self.avg_doc_length = self.total_length / self.doc_count if self.doc_count else 0.0
+        with generations_lock:
+            self.version = next(generations)
+
+    def __new_segment(self, index):
+        return Segment(self.__new_name(), index)
+
+    def __new_name(self):
+        name = f"seg-{self.next_segment:06d}"
+        self.next_segment += 1
+        return name
+
+    @classmethod
+    def from_index(cls, index):
+        return cls([Segment("seg-000000", index)], 1)
+
+    @classmethod
+    def open(cls, path):
+        manifest_file = os.path.join(path, "manifest.json")
+        if not os.path.exists(manifest_file):
+            return cls([Segment(".", CompactIndex.open(path))], 0)
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version {manifest.get('version')} in {path}")
+        segments = [Segment(s["name"], CompactIndex.open(os.path.join(path, s["name"])), s["deleted"])
+                    for s in manifest["segments"]]
+        return cls(segments, manifest["next_segment"])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "manifest.json")) or CompactIndex.exists(path)
+
+    def save(self, path):
+        # Only segments that are not on disk yet get written, each under a
+        # name no directory at path has, so a rebuild never overwrites the
+        # segments of the current manifest. Tombstones live in the manifest,
+        # which is replaced atomically; segments it no longer lists are
+        # deleted after the switch.
+        self.install_merge()
+        os.makedirs(path, exist_ok=True)
+        for s in self.segments:
+            if s.index.path is not None and os.path.abspath(s.index.path) == os.path.abspath(os.path.join(path, s.name)):
+                continue
+            while os.path.exists(os.path.join(path, s.name)):
+                s.name = self.__new_name()
+            s.index.save(os.path.join(path, s.name))
+        manifest = {
+            "version"      : MANIFEST_VERSION,
+            "next_segment" : self.next_segment,
+            "segments"     : [{"name": s.name, "deleted": s.deleted.tolist()} for s in self.segments],
+        }
+        manifest_file = os.path.join(path, "manifest.json")
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+        live = {s.name for s in self.segments}
+        for name in os.listdir(path):
+            if name.startswith("seg-") and name not in live:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+    def __locate(self, ordinal):
+        i = int(np.searchsorted(self.bases, ordinal, side="right")) - 1
+        return self.segments[i], ordinal - int(self.bases[i])
+
+    def __gather(self, ordinals, array_name):
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        if len(self.segments) == 1:
+            return getattr(self.segments[0].index, array_name)[ordinals]
+        which = np.searchsorted(self.bases, ordinals, side="right") - 1
+        result = None
+        for i in np.unique(which):
+            mask = which == i
+            values = getattr(self.segments[i].index, array_name)[ordinals[mask] - self.bases[i]]
+            if result is None: result = np.empty(len(ordinals), dtype=values.dtype)
+            result[mask] = values
+        return result if result is not None else np.empty(0, dtype=np.int64)
+
+    def postings(self, term):
+        # term -> (global ordinals ascending, term frequencies), live documents only
+        ordinals, tfs = [], []
+        for s, base in zip(self.segments, self.bases):
+            o, tf = s.live_postings(term)
+            if not len(o): continue
+            ordinals.append(o + np.int64(base) if base else o)
+            tfs.append(tf)
+        if not ordinals:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+        if len(ordinals) == 1:
+            return ordinals[0], tfs[0]
+        return np.concatenate(ordinals), np.concatenate(tfs)
+
+    def doc_freq(self, term):
+        return sum(len(s.live_postings(term)[0]) if len(s.deleted) else s.index.doc_freq(term)
+                   for s in self.segments)
+
+    def term_frequency(self, term, ordinal):
+        segment, local = self.__locate(ordinal)
+        if segment.is_deleted(local): return 0
+        return segment.index.term_frequency(term, local)
+
+    def ordinal(self, doc_id):
+        # document id -> global ordinal of its live copy, -1 when missing
+        for i in range(len(self.segments) - 1, -1, -1):
+            s = self.segments[i]
+            local = s.index.ordinal(doc_id)
+            if local >= 0 and not s.is_deleted(local):
+                return int(self.bases[i]) + local
+        return -1
+
+    @property
+    def has_positions(self):
+        return bool(self.segments) and all(s.index.positions is not None for s in self.segments)
+
+    def term_positions(self, term, ordinal):
+        segment, local = self.__locate(ordinal)
+        if segment.is_deleted(local): return np.empty(0, dtype=np.int64)
+        return segment.index.term_positions(term, local)
+
+    def document(self, ordinal):
+        segment, local = self.__locate(ordinal)
+        return segment.index.document(local)
+
+    def doc_id(self, ordinal):
+        segment, local = self.__locate(ordinal)
+        return int(segment.index.doc_ids[local])
+
+    def doc_length(self, ordinal):
+        segment, local = self.__locate(ordinal)
+        return int(segment.index.doc_lengths[local])
+
+    def ids(self, ordinals):
+        return self.__gather(ordinals, "doc_ids")
+
+    def lengths(self, ordinals):
+        return self.__gather(ordinals, "doc_lengths")
+
+    def live_ordinals(self):
+        for s, base in zip(self.segments, self.bases):
+            deleted = set(s.deleted.tolist())
+            for local in range(s.index.doc_count):
+                if local not in deleted: yield int(base) + local
+
+    def iter_doc_ids(self):
+        return (self.doc_id(o) for o in self.live_ordinals())
+
+
+    def add_documents(self, doc_ids, documents, term_frequencies, term_positions=None):
+        # New documents become one small segment; callers delete older copies.
+        self.install_merge()
+        index = CompactIndex.from_documents(doc_ids, documents, term_frequencies, term_positions=term_positions)
+        self.segments.append(self.__new_segment(index))
+        self.__refresh()
+
+    def delete(self, doc_id):
+        self.install_merge()
+        ordinal = self.ordinal(doc_id)
+        if ordinal < 0: return False
+        segment, local = self.__locate(ordinal)
+        segment.delete(local)
+        self.__refresh()
+        return True
+
+    def merge_candidates(self):
+        # Merge policy: compact segments with many tombstones, and once there
+        # are more than MAX_SEGMENTS segments fold all but the largest together.
+        candidates = {i for i, s in enumerate(self.segments)
+                      if s.index.doc_count and len(s.deleted) / s.index.doc_count > MAX_DELETED_RATIO}
+        if len(self.segments) > MAX_SEGMENTS:
+            largest = max(range(len(self.segments)), key=lambda i: self.segments[i].index.doc_count)
+            candidates.update(i for i in range(len(self.segments)) if i != largest)
+        return sorted(candidates)
+
+    def merge(self, candidates=None, background=False):
+        # Builds the merged segment (optionally on a background thread); it is
+        # swapped in by install_merge on the next read or write of the caller.
+        self.install_merge()
+        if self.__merge_thread is not None: return False
+        candidates = self.merge_candidates() if candidates is None else candidates
+        if not candidates: return False
+        snapshot = [(self.segments[i], self.segments[i].deleted) for i in candidates]
+        if background:
+            self.__merge_thread = threading.Thread(target=self.__merge_segments, args=(snapshot,), daemon=True)
+            self.__merge_thread.start()
+        else:
+            self.__merge_segments(snapshot)
+            self.install_merge()
+        return True
+
+    def __merge_segments(self, snapshot):
+        parts = [s.index.without(deleted) if len(deleted) else s.index for s, deleted in snapshot]
+        merged = CompactIndex.merge(parts)
+        with self.__lock:
+            self.__pending_merge = (snapshot, merged)
+
+    def install_merge(self):
+        # Swaps a finished merge in; returns True when the segments changed.
+        with self.__lock:
+            pending, self.__pending_merge = self.__pending_merge, None
+        if pending is None: return False
+        if self.__merge_thread is not None:
+            self.__merge_thread.join()
+            self.__merge_thread = None
+
+        snapshot, merged = pending
+        merged_segment = self.__new_segment(merged)
+        # Tombstones added while the merge ran are carried over by document id.
+        for s, deleted in snapshot:
+            for local in np.setdiff1d(s.deleted, deleted).tolist():
+                ordinal = merged.ordinal(int(s.index.doc_ids[local]))
+                if ordinal >= 0: merged_segment.delete(ordinal)
+        merged_names = {s.name for s, _ in snapshot}
+        position = min(i for i, s in enumerate(self.segments) if s.name in merged_names)
+        segments = [s for s in self.segments if s.name not in merged_names]
+        segments.insert(position, merged_segment)
+        self.segments = segments
+        self.__refresh()
+        return True
@@ -1,64 +1,128 @@
-import os
-import json
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sentence_transformers import CrossEncoder
+from .document_store import load_documents, document_map
+from .result_cache import ResultCache, cached_search, cached_search_many, file_version
+from .query_cache import shared_query_cache
+from .reranker import shared_reranker
+from .embedding_store import load_or_quantize, save_embeddings, update_embeddings, fingerprints, normalize, normalize_rows, top_k, PRECISIONS
+import lib.model_registry as MR
 
+EMBED_BATCH_SIZE = 64
 
 class SemanticSearch:
     
-    def __init__(self, model_name = "all-MiniLM-L6-v2"):
-        # Load the model (downloads automatically the first time)
+    def __init__(self, model_name = MR.EMBEDDING_MODEL):
         self.embeddings_cache_file = "cache/movie_embeddings.npy"
-        self.model = SentenceTransformer(model_name)
-        self.embeddings = None
+        self.model_name = model_name
+        self.embeddings = None          # EmbeddingStore of unit rows
+        self.embeddings_version = None  # on-disk state the loaded embeddings came from
         self.documents = None
         self.document_map = {}
-        
+        self.result_cache = ResultCache()   # search results, None disables
+        self.query_cache = shared_query_cache() # query embeddings by model and text, None disables
+        self.embed_batch_size = EMBED_BATCH_SIZE
+        self.embed_workers = 1              # > 1 encodes builds in a pool of CPU processes
+        self.precision = "float32"          # in-memory precision of loaded embeddings, see EmbeddingStore
+        self.rescore = True                 # rescore quantized candidates at full precision
+        self.quantized = False              # encode with int8 dynamically quantized linear layers (CPU)
+
+    @property
+    def model(self):
+        # Loaded (downloaded the first time) on first use, and shared by every
+        # search over the same model in the process.
+        return MR.sentence_transformer(self.model_name, self.quantized)
+
+    @property
+    def model_id(self):
+        # Identifies what embeds queries, for caches of query embeddings and
+        # results. Corpus rows stay keyed by model_name: they are valid for
+        # either encoder, up to the drift quantization_drift reports.
+        return f"{self.model_name}:int8" if self.quantized else self.model_name
+
+    def warm_up(self):
+        return self.model
+
+    def search_version(self):
+        return (self.model_id, self.embeddings_version, self.precision, self.rescore)
+
+    @cached_search(search_version)
     def search(self, query, limit=5):
         if self.embeddings is None: 
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
-        query_embedding = self.generate_embedding(query)
-        similarity = []
-        for i in range(len(self.documents)):
-            doc = self.documents[i]
-            emb = self.embeddings[i]
-            sim = cosine_similarity(emb, query_embedding)
-            similarity.append((sim, doc))
-        similarity.sort(key=lambda e:e[0], reverse=True)
-        limited = similarity[:limit]
+        query_embedding = normalize(self.generate_embedding(query))
+        return self.__result(*self.embeddings.search(query_embedding, limit, self.rescore))
+
+    @cached_search_many(search_version, "search")
+    def search_many(self, queries, limit=5):
+        # search of each query, with one encoder call for the batch and one
+        # matrix product per block of queries.
+        if self.embeddings is None: 
+            raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
+        query_embeddings = normalize_rows(self.generate_embeddings(queries))
+        return [self.__result(ids, scores) for ids, scores in self.embeddings.search_many(query_embeddings, limit, self.rescore)]
+
+    def __result(self, ids, scores):
         result = []
-        for e in limited:
-            result.append({ 'score':e[0], 'title':e[1]['title'], 'description':e[1]['description'] })
+        for i, score in zip(ids, scores):
+            doc = self.documents[i]
+            result.append({ 'score':float(score), 'title':doc['title'], 'description':doc['description'] })
         return result
 
     def generate_embedding(self, text):
         if len(text) == 0 or text.isspace(): 
             raise ValueError("generate_embedding expects non empty and non whitespace text") 
 
-        embeddings = self.model.encode([text])
+        if self.query_cache is not None:
+            embedding = self.query_cache.get(self.model_id, text)
+            if embedding is not None: return embedding
+        model = self.model
+        with MR.inference():
+            embeddings = model.encode([text])
         embedding = embeddings[0]
+        if self.query_cache is not None: embedding = self.query_cache.put(self.model_id, text, embedding)
         return embedding
 
+    def generate_embeddings(self, texts):
+        # generate_embedding of each text as the rows of one matrix; texts
+        # missing from the query cache are encoded by a single model call.
+        if any(len(text) == 0 or text.isspace() for text in texts):
+            raise ValueError("generate_embeddings expects non empty and non whitespace texts")
+        cache = self.query_cache
+        embeddings = {text: cache.get(self.model_id, text) if cache is not None else None for text in texts}
+        missing = [text for text, embedding in embeddings.items() if embedding is None]
+        if missing:
+            model = self.model
+            with MR.inference():
+                encoded = model.encode(missing, batch_size=self.embed_batch_size)
+            for text, embedding in zip(missing, encoded):
+                embeddings[text] = cache.put(self.model_id, text, embedding) if cache is not None else embedding
+        if not texts: return np.empty((0, 0), dtype=np.float32)
+        return np.stack([embeddings[text] for text in texts])
+
     def build_embeddings(self, documents):
+        # Encodes every document again; load_or_create_embeddings only encodes changes.
         self.documents = documents
-        self.document_map = { d["id"]: d for d in documents }
-        documents = [f"{d['title']}: {d['description']}" for d in documents]
-        self.embeddings = [self.model.encode(d, show_progress_bar = True) for d in documents]
-        np.save(self.embeddings_cache_file, self.embeddings)
-        return self.embeddings
+        self.document_map = document_map(documents)
+        texts = embedding_texts(documents)
+        embeddings = encode_texts(self.model, texts, self.embed_batch_size, self.embed_workers)
+        save_embeddings(self.embeddings_cache_file, embeddings, fingerprints(texts, self.model_name))
+        return self.__open_embeddings()
 
     def load_or_create_embeddings(self, documents):
+        # Rows are keyed by a fingerprint of their text and model: only new
+        # or changed documents are encoded, rows of deleted ones are dropped.
         self.documents = documents
-        self.document_map = { d["id"]: d for d in documents }
-        if os.path.exists(self.embeddings_cache_file):
-            self.embeddings = np.load(self.embeddings_cache_file)
-            if len(self.embeddings) == len(self.documents):
-                return self.embeddings
-            else: 
-                print(f"Document and Embedding count mismatch {len(self.documents)} {len(self.embeddings)}")
-        return self.build_embeddings(documents)
+        self.document_map = document_map(documents)
+        texts = embedding_texts(documents)
+        encode = lambda missing: encode_texts(self.model, [texts[i] for i in missing],
+                                              self.embed_batch_size, self.embed_workers)
+        encoded = update_embeddings(self.embeddings_cache_file, fingerprints(texts, self.model_name), encode)
+        if encoded: print(f"Encoded {encoded} new or changed documents")
+        return self.__open_embeddings()
 
+    def __open_embeddings(self):
+        self.embeddings = load_or_quantize(self.embeddings_cache_file, self.precision)
+        self.embeddings_version = file_version(self.embeddings_cache_file)
+        return self.embeddings
 
 def cosine_similarity(vec1, vec2):
     dot_product = np.dot(vec1, vec2)
@@ -70,23 +134,46 @@ def cosine_similarity(vec1, vec2):
 
     return dot_product / (norm1 * norm2)
 
+def embedding_texts(documents):
+    return [f"{d['title']}: {d['description']}" for d in documents]
+
+def encode_texts(model, texts, batch_size=EMBED_BATCH_SIZE, workers=1):
+    # Encodes longest texts first so each batch pads to similar lengths, with
+    # a single progress bar; workers > 1 spreads the batches over a pool of
+    # CPU processes. Rows come back in the order of texts.
+    if not texts:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+    ordered = [texts[i] for i in order]
+    if workers > 1:
+        pool = model.start_multi_process_pool(["cpu"] * workers)
+        try:
+            embeddings = model.encode(ordered, pool=pool, batch_size=batch_size, show_progress_bar=True)
+        finally:
+            model.stop_multi_process_pool(pool)
+    else:
+        with MR.inference():
+            embeddings = model.encode(ordered, batch_size=batch_size, show_progress_bar=True)
+    result = np.empty_like(embeddings)
+    result[order] = embeddings
+    return result
+
 def verify_model():
     ss = SemanticSearch()
     print(f"Model loaded: {ss.model}")
     print(f"Max sequence length: {ss.model.max_seq_length}")
         
-def verify_embeddings():
+def verify_embeddings(batch_size=EMBED_BATCH_SIZE, workers=1):
     ss = SemanticSearch()
+    ss.embed_batch_size, ss.embed_workers = batch_size, workers
     documents = load_movies()
     embeddings = ss.load_or_create_embeddings(documents)
     print(f"Number of docs:   {len(documents)}")
     print(f"Embeddings shape: {embeddings.shape[0]} vectors in {embeddings.shape[1]} dimensions")
 
 def load_movies():
-    movies_json_file  = "data/movies.json"
-    with open(movies_json_file) as f: 
-        documents = json.load(f)["movies"] # [ { "id":number, "title":string, "description":string },..]
-    return documents
+    # The process-wide DocumentStore: [ { "id":number, "title":string, "description":string },..]
+    return load_documents("data/movies.json")
 
 def embed_query_text(query):
     ss = SemanticSearch()
@@ -95,11 +182,6 @@ def embed_query_text(query):
     print(f"First 5 dimensions: {embedding[:5]}")
     print(f"Shape: {embedding.shape}")
 
-def cross_encoder_rerank(result, query):
-    cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
-    pairs = [[query, f"{d.get('title', '')} - {d.get('document', '')}"] for d in result.values()]
-    scores = cross_encoder.predict(pairs)
-    for d in zip(result.values(), scores): d[0]["cross_encoder_score"] = d[1]
-    result = sorted(result.items(), reverse=True, key=lambda e: e[1]["cross_encoder_score"])
-    result = dict(result)
-    return result
\ No newline at end of file
+def cross_encoder_rerank(result, query, quantized=False, top_n=None):
+    # See CrossEncoderReranker.rerank.
+    return shared_reranker(quantized).rerank(result, query, top_n)
\ No newline at end of file
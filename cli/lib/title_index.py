@@ -0,0 +1,165 @@
+import heapq
+import numpy as np
+from bisect import bisect_left
+
+COMPLETION_LIMIT = 10
+CACHED_PREFIX_LENGTH = 3    # prefixes up to this many characters have precomputed completions
+CACHED_COMPLETIONS = 32     # completions kept per cached prefix
+SCAN_CHUNK_SIZE = 64        # first chunk of candidate ranks checked at once; later chunks double
+PREFIX_EXPANSION = 4        # expand a prefix up front when count**2 < PREFIX_EXPANSION * limit * titles
+TRIGRAM_LENGTH = 3
+NO_POSTINGS = np.zeros(0, dtype=np.int32)
+
+
+class TitleIndex:
+    # Prefix index over normalized title words for type-ahead. Titles have a
+    # static rank (fewer words first, then catalog order); every word's posting
+    # list holds the ranks of the titles containing it, ascending, so the best
+    # completions are the smallest matching ranks. Words are a sorted array,
+    # a prefix is a contiguous range of it, and short prefixes, whose ranges
+    # are widest, are answered from a precomputed table.
+
+    def __init__(self, titles, analyzer):
+        self.analyzer = analyzer
+        words = [sorted(set(analyzer.words(t))) for t in titles]
+        order = sorted(range(len(titles)), key=lambda i: len(words[i]))
+        self.titles = [titles[i] for i in order]                # rank -> title
+        self.word_counts = np.array([len(words[i]) for i in order], dtype=np.int32)
+
+        self.terms = sorted({w for ws in words for w in ws})
+        term_ids = {t: i for i, t in enumerate(self.terms)}
+        # rank -> its term ids, as offsets into one flat array
+        self.title_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(self.word_counts, out=self.title_offsets[1:])
+        self.title_terms = np.fromiter((term_ids[w] for i in order for w in words[i]),
+                                       dtype=np.int32, count=int(self.title_offsets[-1]))
+
+        # term id -> ranks of the titles containing it, as offsets into one flat array
+        ranks = np.repeat(np.arange(len(order), dtype=np.int32), self.word_counts)
+        self.term_offsets = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.title_terms, minlength=len(self.terms)), out=self.term_offsets[1:])
+        self.rank_postings = ranks[np.argsort(self.title_terms, kind="stable")]
+
+        self.cached = {}
+        for prefix in {t[:n] for t in self.terms for n in range(1, CACHED_PREFIX_LENGTH + 1)}:
+            self.cached[prefix] = self.__merge_ranks(prefix, CACHED_COMPLETIONS)
+
+    def postings(self, term_id):
+        return self.rank_postings[self.term_offsets[term_id]:self.term_offsets[term_id + 1]]
+
+    def __term_range(self, prefix):
+        lo = bisect_left(self.terms, prefix)
+        hi = bisect_left(self.terms, prefix + "\uffff", lo)
+        return lo, hi
+
+    def __merge_ranks(self, prefix, limit):
+        # Smallest distinct title ranks among all words starting with prefix.
+        lo, hi = self.__term_range(prefix)
+        ranks = []
+        for rank in heapq.merge(*(self.postings(t)[:limit].tolist() for t in range(lo, hi))):
+            if ranks and ranks[-1] == rank: continue
+            ranks.append(rank)
+            if len(ranks) == limit: break
+        return ranks
+
+    def __prefix_union(self, prefix, start):
+        # Ranks >= start of every title with a word starting with prefix.
+        lo, hi = self.__term_range(prefix)
+        ranks = np.unique(self.rank_postings[self.term_offsets[lo]:self.term_offsets[hi]])
+        return ranks[np.searchsorted(ranks, start):]
+
+    def __has_term_in(self, ranks, lo, hi):
+        # For each rank, whether one of its title's term ids is in [lo, hi).
+        counts = self.word_counts[ranks]
+        firsts = np.cumsum(counts) - counts
+        flat = np.repeat(self.title_offsets[ranks] - firsts, counts) + np.arange(int(counts.sum()))
+        terms = self.title_terms[flat]
+        return np.logical_or.reduceat((terms >= lo) & (terms < hi), firsts)
+
+    def prefix_count(self, prefix):
+        # Upper bound on the titles a prefix matches (sum of its posting sizes).
+        lo, hi = self.__term_range(prefix)
+        return int(self.term_offsets[hi] - self.term_offsets[lo])
+
+    def complete_ranks(self, query, limit=COMPLETION_LIMIT):
+        # Every word of query must be a title word, except the last one, which
+        # only has to be a prefix unless query ends in whitespace.
+        words = self.analyzer.words(query)
+        if not words or limit <= 0: return []
+        prefix = None if query[-1:].isspace() else words.pop()
+        if not words:
+            cached = self.cached.get(prefix)
+            if cached is not None and limit <= CACHED_COMPLETIONS: return cached[:limit]
+            return self.__merge_ranks(prefix, limit)
+
+        words = set(words)
+        exact = []
+        for w in words:
+            j = bisect_left(self.terms, w)
+            if j == len(self.terms) or self.terms[j] != w: return []
+            exact.append(self.postings(j))
+        exact.sort(key=len)
+        # Titles with fewer words than the query needs rank first; skip them.
+        needed = len(words) + (prefix is not None and not any(w.startswith(prefix) for w in words))
+        start = int(np.searchsorted(self.word_counts, needed))
+
+        if prefix is None:
+            return conjunction(exact, start, limit)
+        # Testing the prefix chunk by chunk along the shortest posting list
+        # takes about limit * titles / count candidates, expanding it up front
+        # takes count; pick the cheaper.
+        count = self.prefix_count(prefix)
+        if count < len(exact[0]) and count * count < PREFIX_EXPANSION * limit * len(self.titles):
+            return conjunction([self.__prefix_union(prefix, start)] + exact, start, limit)
+        lo, hi = self.__term_range(prefix)
+        return conjunction(exact, start, limit, lambda ranks: self.__has_term_in(ranks, lo, hi))
+
+    def complete(self, query, limit=COMPLETION_LIMIT):
+        return [self.titles[r] for r in self.complete_ranks(query, limit)]
+
+
+class SubstringIndex:
+    # Trigram index for substring search over texts. A substring of three or
+    # more characters can only occur in texts holding all of its trigrams, so
+    # the intersection of their posting lists narrows the texts confirmed
+    # with `in`; shorter substrings check every text.
+
+    def __init__(self, texts):
+        self.texts = texts
+        postings = {}
+        for i, text in enumerate(texts):
+            for gram in {text[j:j + TRIGRAM_LENGTH] for j in range(len(text) - TRIGRAM_LENGTH + 1)}:
+                postings.setdefault(gram, []).append(i)
+        self.postings = {gram: np.array(ordinals, dtype=np.int32) for gram, ordinals in postings.items()}
+
+    def candidates(self, substring):
+        if len(substring) < TRIGRAM_LENGTH: return range(len(self.texts))
+        grams = {substring[j:j + TRIGRAM_LENGTH] for j in range(len(substring) - TRIGRAM_LENGTH + 1)}
+        lists = sorted((self.postings.get(gram, NO_POSTINGS) for gram in grams), key=len)
+        ordinals = lists[0]
+        for p in lists[1:]:
+            if not len(ordinals): break
+            ordinals = ordinals[np.isin(ordinals, p, assume_unique=True)]
+        return ordinals.tolist()
+
+    def matching_ordinals(self, substring):
+        # Positions of every text containing substring, ascending.
+        return [i for i in self.candidates(substring) if substring in self.texts[i]]
+
+
+def conjunction(postings, start, limit, accept=None):
+    # The first limit ranks >= start present in every posting list (shortest
+    # first) and passing accept. The shortest list is checked against the
+    # others in doubling chunks, so early matches never touch most of it.
+    driver, others = postings[0], postings[1:]
+    i, size = int(np.searchsorted(driver, start)), SCAN_CHUNK_SIZE
+    ranks = []
+    while i < len(driver) and len(ranks) < limit:
+        chunk = driver[i:i + size]
+        i, size = i + size, size * 2
+        for p in others:
+            chunk = chunk[p[np.minimum(np.searchsorted(p, chunk), len(p) - 1)] == chunk]
+            if not len(chunk): break
+        if accept is not None and len(chunk): chunk = chunk[accept(chunk)]
+        ranks.extend(chunk[:limit - len(ranks)].tolist())
+    return ranks
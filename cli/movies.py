@@ -1,7 +1,6 @@
-
-import json
-import string 
-from nltk.stem import PorterStemmer
+from lib.analyzer import Analyzer
+from lib.document_store import load_documents
+from lib.title_index import TitleIndex, SubstringIndex, COMPLETION_LIMIT
 
 class Movies:
     
@@ -9,31 +8,39 @@ class Movies:
         self.movies_json_file_path = "data/movies.json"
         self.stopwords_file_path = "data/stopwords.txt"
         self.movies = self.load_movies()
-        self.stopwords = self.load_stopwords()
+        self.analyzer = Analyzer(self.stopwords_file_path)
+        self.stopwords = self.analyzer.stopwords
+        self.title_index = None
+        self.substring_index = None
 
     def load_movies(self):
-        with open(self.movies_json_file_path) as f: 
-            return json.load(f)
+        return {"movies": load_documents(self.movies_json_file_path)}
 
     def load_stopwords(self): 
-        with open(self.stopwords_file_path) as f: 
-            return f.read().split()
+        return self.analyzer.load_stopwords()
+
+    def load_title_index(self):
+        if self.title_index is None:
+            self.title_index = TitleIndex([m['title'] for m in self.movies['movies']], self.analyzer)
+        return self.title_index
+
+    def load_substring_index(self):
+        if self.substring_index is None:
+            self.substring_index = SubstringIndex([self.analyzer.normalize(m['title']) for m in self.movies['movies']])
+        return self.substring_index
 
     def search_movies(self, query):
-        found = []
-        stemmer = PorterStemmer()
-        translation = str.maketrans({c:'' for c in string.punctuation})
-        for m in self.movies['movies']:
-            title = m['title']
-            translated = title.lower().translate(translation)
-            q = query.lower().split()
-
-            for w in q:
-                w = stemmer.stem(w)
-                if w in self.stopwords:
-                    continue
-                if w in translated:
-                    found.append(title)
-                    break
-
-        return found
\ No newline at end of file
+        # Titles containing any stemmed query word, in catalog order.
+        substring_index = self.load_substring_index()
+        q = [self.analyzer.stem(w) for w in query.lower().split()]
+        q = [w for w in q if w not in self.stopwords]
+
+        found = set()
+        for w in set(q):
+            found.update(substring_index.matching_ordinals(w))
+        movies = self.movies['movies']
+        return [movies[i]['title'] for i in sorted(found)]
+
+    def complete_titles(self, prefix, limit=COMPLETION_LIMIT):
+        # Type-ahead: best ranked titles whose words complete what was typed so far.
+        return self.load_title_index().complete(prefix, limit)
@@ -2,6 +2,7 @@ import argparse
 import mimetypes
 import lib.semantic_search as SS
 import lib.multimodal_search as MMS
+import lib.model_registry as MR
 
 
 def main():
@@ -11,8 +12,12 @@ def main():
     verify_parser.add_argument("path", type=str, help="Image path")
     image_search_parser = subparsers.add_parser("image_search", help="Search by image") 
     image_search_parser.add_argument("path", type=str, help="Image path")
+    image_search_parser.add_argument("--precision", type=str, choices=SS.PRECISIONS, default="float32", help="In-memory precision of text embeddings")
+    image_search_parser.add_argument("--int8", action="store_true", help="Encode with int8 dynamically quantized linear layers (CPU)")
+    image_search_parser.add_argument("--threads", type=int, help="torch intra-op threads")
     
     args = parser.parse_args()
+    MR.configure_inference(getattr(args, "threads", None))
 
     match args.command:
         case "verify_image_embedding":       
@@ -22,7 +27,7 @@ def main():
             print(f"Embedding shape: {embedding.shape[0]} dimensions")
         case "image_search":
             documents = SS.load_movies()
-            mms = MMS.MultimodalSearch(documents)
+            mms = MMS.MultimodalSearch(documents, precision=args.precision, quantized=args.int8)
             result = mms.search_with_image(args.path)
             for i in range(len(result)):
                 print(f"{i+1}. {result[i][1]['title']} (similarity: {result[i][0]:.3f})")
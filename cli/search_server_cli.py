@@ -0,0 +1,59 @@
+import json
+import time
+import argparse
+import lib.semantic_search as SS
+import lib.hybrid_search as HS
+import lib.model_registry as MR
+import lib.search_server as SearchServer
+import lib.reranker as RR
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search Server CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+    serve_parser = subparsers.add_parser("serve", help="Load models and indexes once and serve searches on [--host]:[--port]")
+    serve_parser.add_argument("--host", type=str, default=SearchServer.SERVER_HOST, help="Interface to listen on")
+    serve_parser.add_argument("--port", type=int, default=SearchServer.SERVER_PORT, help="Port to listen on")
+    serve_parser.add_argument("--ann", action="store_true", help="Approximate semantic search with the IVF index")
+    serve_parser.add_argument("--precision", type=str, choices=SS.PRECISIONS, default="float32", help="In-memory precision of chunk embeddings")
+    serve_parser.add_argument("--depth", type=int, default=HS.CANDIDATE_DEPTH, help=f"Candidates taken from each leg before fusing (default limit * {HS.WEIGHTED_DEPTH_FACTOR} weighted, limit * {HS.RRF_DEPTH_FACTOR} RRF)")
+    serve_parser.add_argument("--leg-timeout", type=float, default=HS.LEG_TIMEOUT_S, help="Seconds a leg may take before results fall back to the other leg")
+    serve_parser.add_argument("--int8", action="store_true", help="Encode queries and rerank with int8 dynamically quantized linear layers (CPU)")
+    serve_parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    serve_parser.add_argument("--interop-threads", type=int, help="torch inter-op threads")
+    serve_parser.add_argument("--rerank-batch-size", type=int, default=RR.RERANK_BATCH_SIZE, help="Pairs per cross-encoder forward pass")
+    serve_parser.add_argument("--rerank-top-n", type=int, default=RR.RERANK_TOP_N, help="Leading results the cross-encoder reranks when a request does not say (default all)")
+    serve_parser.add_argument("--no-cross-encoder", action="store_true", help="Load the cross-encoder on its first rerank instead of at start-up")
+    stats_parser = subparsers.add_parser("stats", help="Cache and model statistics of a running server")
+    stats_parser.add_argument("--server", type=str, help=f"Server URL (default ${SearchServer.SERVER_ENV} or the default port)")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "serve":
+            MR.configure_inference(args.threads, args.interop_threads)
+            start = time.perf_counter()
+            hs = HS.HybridSearch(SS.load_movies(), args.ann, args.precision, args.int8)
+            hs.candidate_depth = args.depth
+            hs.leg_timeout_s = args.leg_timeout
+            reranker = RR.shared_reranker(args.int8)
+            reranker.batch_size = args.rerank_batch_size
+            reranker.top_n = args.rerank_top_n
+            hs.warm_up(cross_encoder=not args.no_cross_encoder)
+            server = SearchServer.SearchServer(hs, args.host, args.port)
+            print(f"Loaded in {time.perf_counter() - start:.1f}s, serving on {server.url} (export {SearchServer.SERVER_ENV}={server.url})")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+        case "stats":
+            client = SearchServer.connect(args.server) or SearchServer.SearchClient(f"http://{SearchServer.SERVER_HOST}:{SearchServer.SERVER_PORT}")
+            print(json.dumps(client.stats(), indent=2))
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
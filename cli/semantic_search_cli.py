@@ -1,23 +1,34 @@
 #!/usr/bin/env python3
 
+import os
 import argparse
+import random
 import re
 import lib.semantic_search as SS
+import lib.model_registry as MR
 import lib.chunked_semantic_search as CSS
 
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
+    inference_parser = argparse.ArgumentParser(add_help=False)
+    inference_parser.add_argument("--int8", action="store_true", help="encode with int8 dynamically quantized linear layers (CPU)")
+    inference_parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    inference_parser.add_argument("--interop-threads", type=int, help="torch inter-op threads")
     verify_parser = subparsers.add_parser("verify", help="Verify Semantic Search model")
     verify_embeddings_parser = subparsers.add_parser("verify_embeddings", help="verify movies.json embeddings")
-    embed_text_parser = subparsers.add_parser("embed_text", help="Generate text embedding <text>")
+    verify_embeddings_parser.add_argument("--batch-size", type=int, default=SS.EMBED_BATCH_SIZE, help="texts per encode batch")
+    verify_embeddings_parser.add_argument("--workers", type=int, default=1, help="encode in N CPU processes (0 = all cores)")
+    embed_text_parser = subparsers.add_parser("embed_text", parents=[inference_parser], help="Generate text embedding <text>")
     embed_text_parser.add_argument("text", type=str, help="text")
     embedquery_parser = subparsers.add_parser("embedquery", help="Generate text embedding <text>")
     embedquery_parser.add_argument("text", type=str, help="text")
-    search_parser = subparsers.add_parser("search", help="search <text> in movies")
+    search_parser = subparsers.add_parser("search", parents=[inference_parser], help="search <text> in movies")
     search_parser.add_argument("text", type=str, help="text")
     search_parser.add_argument("--limit", type=int, default=5, help="number of results")
+    search_parser.add_argument("--precision", type=str, choices=SS.PRECISIONS, default="float32", help="in-memory precision of embeddings")
+    search_parser.add_argument("--no-rescore", action="store_true", help="keep quantized scores instead of rescoring at full precision")
     chunk_parser = subparsers.add_parser("chunk", help="chunk <text> in to [--chunk-size] token count parts")
     chunk_parser.add_argument("text", type=str, help="text")
     chunk_parser.add_argument("--chunk-size", type=int, default=200, help="chunk tokens count")
@@ -26,21 +37,43 @@ def main():
     semantic_chunk_parser.add_argument("text", type=str, help="text")
     semantic_chunk_parser.add_argument("--max-chunk-size", type=int, default=4, help="text")
     semantic_chunk_parser.add_argument("--overlap", type=int, default=0, help="text")
-    embed_text_parser = subparsers.add_parser("embed_chunks", help="Generate movies chunks embeddings")
-    search_chunked_parser = subparsers.add_parser("search_chunked", help="search <text> in chunked movies")
+    embed_chunks_parser = subparsers.add_parser("embed_chunks", parents=[inference_parser], help="Generate movies chunks embeddings")
+    embed_chunks_parser.add_argument("--batch-size", type=int, default=SS.EMBED_BATCH_SIZE, help="texts per encode batch")
+    embed_chunks_parser.add_argument("--workers", type=int, default=1, help="encode in N CPU processes (0 = all cores)")
+    search_chunked_parser = subparsers.add_parser("search_chunked", parents=[inference_parser], help="search <text> in chunked movies")
     search_chunked_parser.add_argument("text", type=str, help="text")
     search_chunked_parser.add_argument("--limit", type=int, default=5, help="number of results")
+    search_chunked_parser.add_argument("--ann", action="store_true", help="approximate search with the IVF index")
+    search_chunked_parser.add_argument("--nprobe", type=int, default=CSS.DEFAULT_NPROBE, help="IVF lists scanned per query")
+    search_chunked_parser.add_argument("--precision", type=str, choices=SS.PRECISIONS, default="float32", help="in-memory precision of chunk embeddings")
+    search_chunked_parser.add_argument("--no-rescore", action="store_true", help="keep quantized scores instead of rescoring at full precision")
+    search_chunked_parser.add_argument("--aggregate", type=str, choices=CSS.AGGREGATIONS, default="max", help="how a movie's chunk scores combine")
+    search_chunked_parser.add_argument("--top-n", type=int, default=CSS.TOP_N, help="chunks summed per movie by top_n_sum")
+    build_ann_parser = subparsers.add_parser("build_ann", help="Build the IVF index over chunk embeddings")
+    build_ann_parser.add_argument("--lists", type=int, help="number of IVF lists (default 4 * sqrt(chunks))")
+    ann_recall_parser = subparsers.add_parser("ann_recall", help="recall@[--limit] of IVF search vs exact search for [--queries N] movie titles")
+    ann_recall_parser.add_argument("--queries", type=int, default=100, help="number of sampled movie titles")
+    ann_recall_parser.add_argument("--limit", type=int, default=10, help="k of recall@k")
+    ann_recall_parser.add_argument("--nprobe", type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help="IVF lists scanned per query")
+    precision_recall_parser = subparsers.add_parser("precision_recall", help="recall@[--limit] of quantized chunk embeddings vs float32 for [--queries N] movie titles")
+    precision_recall_parser.add_argument("--queries", type=int, default=100, help="number of sampled movie titles")
+    precision_recall_parser.add_argument("--limit", type=int, default=10, help="k of recall@k")
+    drift_parser = subparsers.add_parser("quantization_drift", parents=[inference_parser], help="embedding drift and recall@[--limit] of int8 vs float32 encoding for [--queries N] movie titles")
+    drift_parser.add_argument("--queries", type=int, default=100, help="number of sampled movie titles")
+    drift_parser.add_argument("--limit", type=int, default=10, help="k of recall@k")
     
 
     args = parser.parse_args()
+    MR.configure_inference(getattr(args, "threads", None), getattr(args, "interop_threads", None))
 
     match args.command:
         case "verify":
             SS.verify_model()
         case "verify_embeddings":
-            SS.verify_embeddings()
+            SS.verify_embeddings(args.batch_size, args.workers or os.cpu_count())
         case "embed_text":
             ss = SS.SemanticSearch()
+            ss.quantized = args.int8
             embedding = ss.generate_embedding(args.text)
             print(f"Text: {args.text}")
             print(f"First 3 dimensions: {embedding[:3]}")
@@ -50,6 +83,7 @@ def main():
         case "search":
             documents = SS.load_movies()
             ss = SS.SemanticSearch()
+            ss.precision, ss.rescore, ss.quantized = args.precision, not args.no_rescore, args.int8
             ss.load_or_create_embeddings(documents)
             result = ss.search(args.text, args.limit)
             for i in range(len(result)):
@@ -67,17 +101,60 @@ def main():
         case "embed_chunks":
             documents = SS.load_movies()
             css = CSS.ChunkedSemanticSearch()
+            css.embed_batch_size, css.embed_workers = args.batch_size, args.workers or os.cpu_count()
+            css.quantized = args.int8
             chunk_embeddings = css.load_or_create_chunk_embeddings(documents)
             print(f"Generated {len(chunk_embeddings)} chunked embeddings")
         case "search_chunked":
             documents = SS.load_movies()
             css = CSS.ChunkedSemanticSearch()
+            css.precision, css.rescore, css.quantized = args.precision, not args.no_rescore, args.int8
+            css.aggregation, css.top_n = args.aggregate, args.top_n
             css.load_or_create_chunk_embeddings(documents)
+            if args.ann: css.load_or_create_ann_index()
+            css.nprobe = args.nprobe
             result = css.search_chunks(args.text, args.limit)
             for i in range(len(result)):
                 r = result[i]
                 print(f"\n{i+1}.  {r['title']} (score: {r['score']:.4f})")
                 print(f"    {r['document']}...")
+        case "build_ann":
+            documents = SS.load_movies()
+            css = CSS.ChunkedSemanticSearch()
+            css.load_or_create_chunk_embeddings(documents)
+            index = css.build_ann_index(args.lists)
+            print(f"Built IVF index: {len(index.list_ids)} chunks in {index.n_lists} lists")
+        case "ann_recall":
+            documents = SS.load_movies()
+            css = CSS.ChunkedSemanticSearch()
+            css.load_or_create_chunk_embeddings(documents)
+            css.load_or_create_ann_index()
+            sample = random.Random(0).sample(range(len(documents)), min(args.queries, len(documents)))
+            report = css.ann_recall([documents[i]["title"] for i in sample], args.limit, args.nprobe)
+            print(f"IVF lists: {css.ann_index.n_lists}, queries: {len(sample)}")
+            for r in report:
+                print(f"  nprobe {r['nprobe']:4d}:  recall@{args.limit} {r['recall']:.3f}  {r['latency_ms']:.2f} ms/query")
+        case "precision_recall":
+            documents = SS.load_movies()
+            css = CSS.ChunkedSemanticSearch()
+            css.load_or_create_chunk_embeddings(documents)
+            sample = random.Random(0).sample(range(len(documents)), min(args.queries, len(documents)))
+            report = css.precision_recall([documents[i]["title"] for i in sample], args.limit)
+            print(f"Chunks: {len(css.chunk_embeddings)}, queries: {len(sample)}")
+            for r in report:
+                rescored = "rescored" if r["rescore"] else "        "
+                print(f"  {r['precision']:>8} {rescored}:  recall@{args.limit} {r['recall']:.3f}  {r['latency_ms']:.2f} ms/query  {r['megabytes']:.1f} MiB")
+        case "quantization_drift":
+            documents = SS.load_movies()
+            css = CSS.ChunkedSemanticSearch()
+            css.load_or_create_chunk_embeddings(documents)
+            sample = random.Random(0).sample(range(len(documents)), min(args.queries, len(documents)))
+            r = css.quantization_drift([documents[i]["title"] for i in sample], args.limit)
+            print(f"int8 vs float32 encoding, queries: {r['queries']}, chunks: {r['chunks']}")
+            print(f"  query cosine:  mean {r['query_cosine_mean']:.4f}  min {r['query_cosine_min']:.4f}")
+            print(f"  chunk cosine:  mean {r['chunk_cosine_mean']:.4f}  min {r['chunk_cosine_min']:.4f}")
+            print(f"  recall@{args.limit} of movies: {r['recall']:.3f}")
+            print(f"  encode latency: float32 {r['float32_ms']:.2f} ms/query, int8 {r['int8_ms']:.2f} ms/query")
         case _:
             parser.print_help()
 
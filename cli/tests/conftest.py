@@ -0,0 +1,32 @@
+import json
+import random
+import pytest
+
+STOPWORDS = ["the", "a", "of", "and", "in"]
+VOCABULARY = [f"w{i}" for i in range(200)] + STOPWORDS
+CORPUS_SIZE = 400
+
+
+def make_movies(count, seed=0, first_id=1):
+    # Zipf-like word frequencies, so postings lengths vary as in real text.
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+    words = lambda k: " ".join(rng.choices(VOCABULARY, weights, k=k))
+    return [{"id": first_id + i, "title": words(rng.randint(1, 4)).title(), "description": words(rng.randint(5, 40)) + "."}
+            for i in range(count)]
+
+def write_movies(movies):
+    with open("data/movies.json", "w") as f:
+        json.dump({"movies": movies}, f)
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    # A small catalog in data/ of a scratch working directory, where the
+    # search components look for it.
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "data" / "stopwords.txt").write_text("\n".join(STOPWORDS))
+    movies = make_movies(CORPUS_SIZE)
+    write_movies(movies)
+    return movies
@@ -0,0 +1,66 @@
+import numpy as np
+from lib.embedding_store import update_embeddings, open_embeddings, load_keys, fingerprints, normalize_rows
+
+DIM = 8
+
+
+def vector(text):
+    # Stands in for the model: a fixed pseudo-random row per text.
+    return np.random.default_rng(list(text.encode())).standard_normal(DIM).astype(np.float32)
+
+class Encoder:
+    def __init__(self):
+        self.texts = []
+        self.encoded = []
+
+    def update(self, embeddings_file, texts):
+        self.texts = texts
+        return update_embeddings(embeddings_file, fingerprints(texts, "model"), self.encode)
+
+    def encode(self, missing):
+        self.encoded.extend(self.texts[i] for i in missing)
+        return np.array([vector(self.texts[i]) for i in missing], dtype=np.float32).reshape(-1, DIM)
+
+def assert_rows(embeddings_file, texts):
+    expected = normalize_rows(np.array([vector(t) for t in texts]))
+    np.testing.assert_allclose(open_embeddings(embeddings_file).rows(), expected, atol=1e-6)
+
+
+def test_only_new_and_changed_texts_are_encoded(tmp_path):
+    embeddings_file = str(tmp_path / "embeddings.npy")
+    encoder = Encoder()
+    texts = [f"text {i}" for i in range(10)]
+    assert encoder.update(embeddings_file, texts) == 10
+    assert_rows(embeddings_file, texts)
+
+    encoder.encoded.clear()
+    assert encoder.update(embeddings_file, texts) == 0
+    assert encoder.encoded == []
+
+    changed = ["new text"] + texts[:3] + ["text 3 changed"] + texts[5:] + [texts[0]]
+    assert encoder.update(embeddings_file, changed) == 2
+    assert encoder.encoded == ["new text", "text 3 changed"]
+    assert_rows(embeddings_file, changed)
+    assert np.array_equal(load_keys(embeddings_file), fingerprints(changed, "model"))
+
+def test_model_change_encodes_again(tmp_path):
+    embeddings_file = str(tmp_path / "embeddings.npy")
+    texts = ["a", "b"]
+    update_embeddings(embeddings_file, fingerprints(texts, "model"), lambda missing: np.ones((len(missing), DIM)))
+    encoder = Encoder()
+    encoder.texts = texts
+    assert update_embeddings(embeddings_file, fingerprints(texts, "other model"), encoder.encode) == 2
+
+def test_file_without_keys_is_encoded_in_full(tmp_path):
+    embeddings_file = str(tmp_path / "embeddings.npy")
+    np.save(embeddings_file, np.ones((3, DIM), dtype=np.float32))
+    encoder = Encoder()
+    texts = ["a", "b", "c"]
+    assert encoder.update(embeddings_file, texts) == 3
+    assert_rows(embeddings_file, texts)
+
+def test_normalize_rows_leaves_its_input(tmp_path):
+    embeddings = np.full((2, DIM), 3.0, dtype=np.float32)
+    normalized = normalize_rows(embeddings)
+    assert np.all(embeddings == 3.0)
+    np.testing.assert_allclose(np.linalg.norm(normalized, axis=1), 1.0, rtol=1e-6)
@@ -0,0 +1,120 @@
+import os
+import random
+import pytest
+from lib.keyword_search import KeywordSearch
+from lib.segmented_index import MAX_DELETED_RATIO
+from conftest import VOCABULARY, make_movies, write_movies
+
+LIMITS = [1, 5, 20, 1000]
+
+
+def keyword_search():
+    ks = KeywordSearch()
+    ks.result_cache = None
+    return ks
+
+def queries(count, seed=1):
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(VOCABULARY, k=rng.randint(1, 8))) for _ in range(count)]
+
+def scores(ks, query):
+    return {r["id"]: r["score"] for r in ks.bm25_search(query, limit=10**6)}
+
+def assert_same_scores(ks, expected, query):
+    got, want = scores(ks, query), scores(expected, query)
+    assert got.keys() == want.keys()
+    for doc_id, score in want.items():
+        assert got[doc_id] == pytest.approx(score)
+
+def rebuilt(movies):
+    write_movies(movies)
+    ks = keyword_search()
+    ks.build()
+    return ks
+
+
+def test_wand_matches_exhaustive(corpus):
+    ks = keyword_search()
+    ks.build()
+    exhaustive = pruned = 0
+    for query in queries(200):
+        for limit in LIMITS:
+            expected = ks.bm25_search(query, limit)
+            exhaustive += ks.scored_documents
+            assert ks.bm25_search(query, limit, pruned=True) == expected
+            pruned += ks.scored_documents
+    assert pruned < exhaustive
+
+def test_wand_matches_exhaustive_across_segments(corpus):
+    ks = keyword_search()
+    ks.build()
+    for movie in make_movies(20, seed=2, first_id=10_000):
+        ks.add_document(movie)
+    for doc_id in range(1, 60, 3):
+        ks.delete_document(doc_id)
+    assert len(ks.index.segments) > 1
+    for query in queries(100):
+        for limit in LIMITS:
+            assert ks.bm25_search(query, limit, pruned=True) == ks.bm25_search(query, limit)
+
+def test_tombstones_score_like_a_rebuild(corpus):
+    ks = keyword_search()
+    ks.build()
+    movies = {m["id"]: m for m in corpus}
+    for doc_id in range(1, 120, 2):
+        ks.delete_document(doc_id)
+        del movies[doc_id]
+    for doc_id, movie in zip(range(2, 22, 2), make_movies(10, seed=3)):
+        movie["id"] = doc_id
+        ks.update_document(movie)
+        movies[movie["id"]] = movie
+    for movie in make_movies(15, seed=4, first_id=5000):
+        ks.add_document(movie)
+        movies[movie["id"]] = movie
+
+    expected = rebuilt(list(movies.values()))
+    assert ks.index.doc_count == expected.index.doc_count
+    assert sorted(ks.index.iter_doc_ids()) == sorted(movies)
+    for query in queries(50):
+        assert_same_scores(ks, expected, query)
+
+    ks.merge_segments(force=True)
+    assert len(ks.index.segments) == 1
+    assert ks.index.ordinal_count == ks.index.doc_count
+    for query in queries(50):
+        assert_same_scores(ks, expected, query)
+
+def test_merge_policy_compacts_deleted_segments(corpus):
+    ks = keyword_search()
+    ks.build()
+    for doc_id in range(1, len(corpus) // 2):
+        ks.delete_document(doc_id)
+    assert ks.index.merge_candidates() == []
+    assert ks.index.ordinal_count < len(corpus)
+    assert all(len(s.deleted) <= MAX_DELETED_RATIO * s.index.doc_count for s in ks.index.segments)
+
+def test_manifest_save_and_reopen(corpus):
+    ks = keyword_search()
+    ks.build()
+    for movie in make_movies(5, seed=5, first_id=9000):
+        ks.add_document(movie)
+    for doc_id in (3, 9000, 42):
+        ks.delete_document(doc_id)
+    ks.save()
+
+    reopened = keyword_search()
+    assert reopened.load()
+    assert [s.name for s in reopened.index.segments] == [s.name for s in ks.index.segments]
+    assert sorted(reopened.index.iter_doc_ids()) == sorted(ks.index.iter_doc_ids())
+    assert reopened.docmap[9001]["title"] == ks.docmap[9001]["title"]
+    for query in queries(50):
+        assert reopened.bm25_search(query, 10) == ks.bm25_search(query, 10)
+
+    reopened.merge_segments(force=True)
+    reopened.save()
+    on_disk = sorted(name for name in os.listdir("cache/keyword_index") if name.startswith("seg-"))
+    assert on_disk == [s.name for s in reopened.index.segments]
+    again = keyword_search()
+    assert again.load()
+    for query in queries(50):
+        assert again.bm25_search(query, 10) == ks.bm25_search(query, 10)
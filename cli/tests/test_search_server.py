@@ -0,0 +1,91 @@
+import threading
+import json
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+import lib.search_server as SearchServer
+from lib.hybrid_search import PartialResult
+
+
+class FakeHybridSearch:
+    # Echoes its arguments, so a round trip shows what reached the server.
+
+    def weighted_search(self, query, alpha, limit=5):
+        return {7: {"title": query, "alpha": alpha, "limit": limit, "hybrid_score": np.float32(0.5)}}
+
+    def rrf_search(self, query, k=60, limit=5):
+        if query == "bug": raise KeyError("internal")
+        if query == "slow": raise TimeoutError("leg timed out")
+        return PartialResult({8: {"title": query, "k": k}}, ["semantic"])
+
+    def weighted_search_many(self, queries, alpha, limit=5):
+        return [self.weighted_search(q, alpha, limit) for q in queries]
+
+    def rrf_search_many(self, queries, k=60, limit=5):
+        return [self.rrf_search(q, k, limit) for q in queries]
+
+    def rerank(self, result, query, method, limit=5, top_n=None):
+        return dict(reversed(list(result.items())))
+
+    def answer(self, mode, query, limit=5):
+        return {9: {"title": query}}, f"{mode} answer"
+
+    def stats(self):
+        return {"result_cache": None}
+
+
+@pytest.fixture
+def client():
+    server = SearchServer.SearchServer(FakeHybridSearch(), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield SearchServer.SearchClient(server.url)
+    server.shutdown()
+    server.server_close()
+
+
+def test_search_round_trips(client):
+    result = client.weighted_search("alien", 0.3, 2)
+    assert result == {7: {"title": "alien", "alpha": 0.3, "limit": 2, "hybrid_score": 0.5}}
+    result = client.rrf_search("alien", 10, 3)
+    assert result == {8: {"title": "alien", "k": 10}}
+    assert result.missing_legs == ["semantic"]
+    assert client.weighted_search_many(["a", "b"], 0.5) == [client.weighted_search(q, 0.5) for q in ["a", "b"]]
+    assert [r.missing_legs for r in client.rrf_search_many(["a", "b"])] == [["semantic"], ["semantic"]]
+
+def test_rerank_and_answer_round_trips(client):
+    result = {1: {"title": "x"}, 2: {"title": "y"}}
+    assert list(client.rerank(result, "q", "cross_encoder", top_n=2)) == [2, 1]
+    assert client.answer("rag", "q") == ({9: {"title": "q"}}, "rag answer")
+    assert client.stats() == {"result_cache": None}
+    assert client.health() == {"status": "ok"}
+
+def test_bad_requests_are_value_errors(client):
+    with pytest.raises(ValueError, match="query"):
+        client.weighted_search(5, 0.5)
+    with pytest.raises(ValueError, match="alpha"):
+        client.weighted_search("q", True)
+    with pytest.raises(ValueError, match="queries"):
+        client.rrf_search_many(["q", None])
+    with pytest.raises(ValueError, match="method"):
+        client.rerank({1: {}}, "q", "unknown")
+    with pytest.raises(ValueError, match="mode"):
+        client.answer("unknown", "q")
+
+def test_server_errors_are_not_value_errors(client):
+    with pytest.raises(RuntimeError, match="500"):
+        client.rrf_search("bug")
+    with pytest.raises(TimeoutError):
+        client.rrf_search("slow")
+
+def test_malformed_bodies(client):
+    for path, body in [("/rrf_search", b"not json"), ("/rrf_search", b"[1]"), ("/rrf_search", b"{}")]:
+        request = urllib.request.Request(client.url + path, data=body)
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(request)
+        assert e.value.code == 400
+        assert "error" in json.load(e.value)
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(client.url + "/missing")
+    assert e.value.code == 404